@@ -3,3 +3,7 @@ from django.apps import AppConfig
 
 class DcManagementConfig(AppConfig):
     name = 'dc_management'
+
+    def ready(self):
+        # recompute cached project costs when their inputs change
+        from . import signals
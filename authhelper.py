@@ -6,7 +6,7 @@ import os
 
 from django.conf import settings
 
-import requests
+from dc_management.outlookservice import graph_client
 
 # Client ID and secret
 #client_id = os.environ["OUTLOOK_APP_ID"]     #'YOUR APP ID HERE'
@@ -53,7 +53,7 @@ def get_token_from_code(auth_code, redirect_uri):
                 'client_secret': client_secret
               }
 
-  r = requests.post(token_url, data = post_data)
+  r = graph_client().token_request(post_data, token_url)
 
   try:
     return r.json()
@@ -70,12 +70,11 @@ def get_token_from_refresh_token(refresh_token, redirect_uri):
                 'client_secret': client_secret
               }
 
-  r = requests.post(token_url, data = post_data)
-
+  # cached by refresh token: a user's requests arriving together refresh once
   try:
-    return r.json()
-  except:
-    return 'Error retrieving token: {0} - {1}'.format(r.status_code, r.text)
+    return graph_client().user_token(post_data, token_url)
+  except ValueError as e:
+    return str(e)
     
 def get_access_token(request, redirect_uri):
   try:
@@ -113,7 +112,8 @@ def get_access_token(request, redirect_uri):
     # Subtract 5 minutes to allow for clock differences
     try:
         expiration = int(time.time()) + new_tokens['expires_in'] - 300
-    except KeyError:
+    except (KeyError, TypeError):
+        # an error, not a token
         return ''
         
     # Save the token in the session
@@ -0,0 +1,183 @@
+"""
+Monthly invoices (ProjectBillingRecord) for many projects at once.
+
+Invoices are priced the way the project billing form prices a single bill,
+but from the shared RateTable snapshot and per-project inputs read in a few queries
+for the whole set of projects, so a month's invoices can be built for
+thousands of projects and written with bulk_create.
+
+billing_rollup() totals the invoices by account, project and month in the
+database, for the roll-up report and its CSV export.
+"""
+import datetime
+
+from django.db.models import Count, Sum
+from django.db.models.functions import TruncMonth
+
+from .costengine import BASE_CPU, RateTable
+from .models import Project, ProjectBillingRecord
+
+# (storage record field prefix, storage type keyword, project field)
+STORAGE_LINES = (
+    ('storage_1', 'primary', 'fileshare_storage'),
+    ('storage_2', 'derivative', 'fileshare_derivative'),
+    ('storage_3', 'direct', 'direct_attach_storage'),
+    ('storage_4', 'archiv', 'backup_storage'),
+)
+
+
+def billing_month(value=None):
+    """
+    first day of the month containing value (default: today)
+    """
+    value = value or datetime.date.today()
+    return value.replace(day=1)
+
+def next_month(month):
+    """
+    first day of the month after month
+    """
+    return (month.replace(day=28) + datetime.timedelta(days=4)).replace(day=1)
+
+def _billable_user_counts(projects):
+    # {project pk: number of users, not counting data core staff} in one query
+    return dict(Project.users.through.objects.filter(
+                                    project__in=projects.order_by().values('pk')
+                                    ).exclude(person__role__name__icontains='data core'
+                                    ).order_by(
+                                    ).values_list('project_id'
+                                    ).annotate(Count('pk')))
+
+def _installed_software(projects):
+    # {project pk: [software, ...]} in one query
+    installed = {}
+    rows = Project.software_installed.through.objects.filter(
+                                    project__in=projects.order_by().values('pk')
+                                    ).select_related('software').order_by('pk')
+    for row in rows:
+        installed.setdefault(row.project_id, []).append(row.software)
+    return installed
+
+def _storage_lines(prj, rates, record):
+    for prefix, keyword, field in STORAGE_LINES:
+        st_type, st_rate = rates.storage(keyword)
+        st_value = getattr(prj, field) or 0
+        setattr(record, prefix + '_type', st_type)
+        setattr(record, prefix + '_value', st_value)
+        setattr(record, prefix + '_rate', st_rate)
+        setattr(record, prefix + '_expense', st_rate * st_value)
+
+def build_invoices(projects, billing_date, author, rates=None):
+    """
+    Unsaved ProjectBillingRecords for billing_date, for each project in the
+    projects queryset that has something to charge. Running projects are
+    billed in full, all others for their storage only.
+    """
+    rates = rates or RateTable.current()
+    running = projects.filter(status='RU')
+    user_counts = _billable_user_counts(running)
+    installed = _installed_software(running)
+    # projects whose database setup fee has already been invoiced
+    setup_billed = set(ProjectBillingRecord.objects.filter(
+                                    project__in=running.filter(db__isnull=False
+                                                    ).order_by().values('pk'),
+                                    db_setup__gt=0,
+                                    ).values_list('project_id', flat=True))
+
+    records = []
+    for prj in projects:
+        record = ProjectBillingRecord(record_author=author,
+                                      project=prj,
+                                      billing_date=billing_date,
+                                      invoice_month=billing_month(billing_date),
+                                      multiplier=1,
+                                      account=prj.account_number,
+                                      )
+        _storage_lines(prj, rates, record)
+
+        if prj.status == 'RU':
+            user_num = user_counts.get(prj.pk, 0)
+            record.base_value = user_num
+            if prj.env_type == 'CL':
+                # classrooms pay the single user rate for the PI and the extra
+                # user rate for each student (none if the class has no users)
+                record.base_rate = (rates.user_rates.get(1, 0) +
+                                    max(user_num - 1, 0) * rates.extra_user)
+            else:
+                record.base_rate = rates.user_cost(user_num)
+            record.base_expense = record.base_rate
+
+            sw_list = installed.get(prj.pk, [])
+            sw_costs = [rates.software_rates.get(sw.pk, 0) * user_num for sw in sw_list]
+            record.sw_value = "; ".join([sw.name for sw in sw_list])
+            record.sw_rates = "; ".join(["${:.2f}".format(c) for c in sw_costs])
+            record.sw_expense = sum(sw_costs)
+
+            extra_cpu = max((prj.requested_cpu or 0) - BASE_CPU, 0)
+            record.hosting_value = extra_cpu
+            record.hosting_rate = rates.extra_cpu_rates.get(extra_cpu, 0) if extra_cpu else 0
+            record.hosting_expense = record.hosting_rate
+
+            if prj.db_id:
+                record.db_value = 1
+                record.db_rate = rates.db_cost
+                record.db_setup = 0 if prj.pk in setup_billed else rates.db_setup
+            else:
+                record.db_value = 0
+                record.db_rate = 0
+                record.db_setup = 0
+            record.db_expense = record.db_rate
+
+        # bulk_create does not call save(), so store the total here
+        record.total = record.monthly_total()
+        if record.total or record.db_setup:
+            records.append(record)
+    return records
+
+
+# columns of the roll-up report: (heading, row key)
+ROLLUP_COLUMNS = (
+    ('Account', 'account'),
+    ('Project', 'project__dc_prj_id'),
+    ('Month', 'month'),
+    ('Invoices', 'invoices'),
+    ('Total', 'amount'),
+    ('DB setup', 'setup'),
+)
+
+def billing_records(start=None, end=None, account=None):
+    """
+    Invoices billed between the start and end dates (inclusive), optionally
+    for a single account.
+    """
+    records = ProjectBillingRecord.objects.all()
+    if start:
+        records = records.filter(billing_date__gte=start)
+    if end:
+        records = records.filter(billing_date__lte=end)
+    if account:
+        records = records.filter(account=account)
+    return records
+
+def billing_rollup(start=None, end=None, account=None):
+    """
+    Invoice totals per account, project and month, aggregated in the database.
+    Takes the same filters as billing_records().
+    """
+    return billing_records(start, end, account).annotate(month=TruncMonth('billing_date')
+                    ).values('account', 'project__dc_prj_id', 'project', 'month'
+                    ).annotate(invoices=Count('pk'),
+                               amount=Sum('total'),
+                               setup=Sum('db_setup'),
+                    ).order_by('account', 'project__dc_prj_id', 'month')
+
+def rollup_csv_rows(rollup):
+    """
+    Generate the CSV rows (heading first) of a billing_rollup() queryset,
+    reading it from the database in chunks.
+    """
+    yield [heading for heading, key in ROLLUP_COLUMNS]
+    for row in rollup.iterator():
+        row['month'] = row['month'].strftime('%Y-%m')
+        yield [row[key] if row[key] is not None else '' for heading, key in ROLLUP_COLUMNS]
+
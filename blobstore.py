@@ -0,0 +1,169 @@
+"""
+Content-addressed storage for governance document uploads.
+
+ContentAddressedStorage hashes each upload while streaming it to disk and
+keeps every distinct content once, as BLOB_DIR/<2 hex digits>/<sha256>. The
+names documents are saved under (<dc_prj_id>/<filename>) are hard links to
+their blob, so the rest of the app, and the web server, read them as plain
+files. Saving content a name already refers to reuses that name.
+
+Deleting a document's file only removes its name; blobs no name refers to
+any more (link count 1) are removed by `manage.py dedupemedia` once
+BLOB_GRACE has passed, which also moves plain files (not links to a blob)
+into the blob store.
+"""
+import hashlib
+import os
+import tempfile
+import time
+
+from django.core.files import File
+from django.core.files.storage import FileSystemStorage
+from django.utils.deconstruct import deconstructible
+
+# directory under the storage root holding the blobs
+BLOB_DIR = 'blobs'
+
+# bytes hashed at a time when reading files back
+CHUNK_SIZE = 64 * 1024
+
+# seconds a blob is kept after it was last stored, though no name links to it
+# (yet: an upload links its name to the blob after storing it)
+BLOB_GRACE = 60 * 60
+
+
+def file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as fh:
+        for chunk in iter(lambda: fh.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+@deconstructible
+class ContentAddressedStorage(FileSystemStorage):
+    """
+    FileSystemStorage keeping one blob per distinct content, with saved
+    names as hard links to it
+    """
+    def blob_name(self, digest):
+        return '{}/{}/{}'.format(BLOB_DIR, digest[:2], digest)
+
+    def _makedirs(self, name):
+        directory = os.path.dirname(self.path(name))
+        if self.directory_permissions_mode is not None:
+            # as FileSystemStorage: os.makedirs() does not apply the mode to
+            # intermediate directories
+            old_umask = os.umask(0o777 & ~self.directory_permissions_mode)
+            try:
+                os.makedirs(directory, self.directory_permissions_mode, exist_ok=True)
+            finally:
+                os.umask(old_umask)
+        else:
+            os.makedirs(directory, exist_ok=True)
+
+    def store_blob(self, content):
+        """
+        Write content to its blob, unless it is already stored, hashing it
+        on the way. Returns the blob's name.
+        """
+        self._makedirs(self.blob_name('tmp'))
+        digest = hashlib.sha256()
+        fd, tmp_path = tempfile.mkstemp(dir=self.path(BLOB_DIR), prefix='.upload-')
+        try:
+            with os.fdopen(fd, 'wb') as fh:
+                for chunk in content.chunks():
+                    if isinstance(chunk, str):
+                        chunk = chunk.encode()
+                    digest.update(chunk)
+                    fh.write(chunk)
+            name = self.blob_name(digest.hexdigest())
+            if self.exists(name):
+                os.unlink(tmp_path)
+                # stored again: not to be removed before it is linked
+                os.utime(self.path(name))
+            else:
+                self._makedirs(name)
+                if self.file_permissions_mode is not None:
+                    os.chmod(tmp_path, self.file_permissions_mode)
+                os.replace(tmp_path, self.path(name))
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            raise
+        return name
+
+    def refers_to(self, name, blob):
+        """
+        True if the saved name is a link to the blob
+        """
+        try:
+            return os.path.samefile(self.path(name), self.path(blob))
+        except FileNotFoundError:
+            return False
+
+    def link(self, blob, name):
+        """
+        Save the blob under name (or the next free name). Returns the name.
+        """
+        self._makedirs(name)
+        while True:
+            try:
+                os.link(self.path(blob), self.path(name))
+                return name
+            except FileExistsError:
+                # taken since get_available_name()
+                name = self.get_available_name(name)
+
+    def save(self, name, content, max_length=None):
+        if name is None:
+            name = content.name
+        if not hasattr(content, 'chunks'):
+            content = File(content, name)
+        blob = self.store_blob(content)
+        if not self.refers_to(name, blob):
+            name = self.link(blob, self.get_available_name(name, max_length=max_length))
+        # as Storage.save(): names use forward slashes on every platform
+        return name.replace('\\', '/')
+
+    def _save(self, name, content):
+        return self.link(self.store_blob(content), name)
+
+    def adopt(self, name, blob):
+        """
+        Make the file saved as name (a plain file, not a link, holding
+        the blob's content) the blob
+        """
+        self._makedirs(blob)
+        os.link(self.path(name), self.path(blob))
+
+    def relink(self, name, blob):
+        """
+        Replace the file saved as name (holding the blob's content) with a
+        link to the blob
+        """
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(self.path(name)),
+                                        prefix='.relink-')
+        os.close(fd)
+        os.unlink(tmp_path)
+        os.link(self.path(blob), tmp_path)
+        try:
+            os.replace(tmp_path, self.path(name))
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    def unreferenced_blobs(self, grace=BLOB_GRACE):
+        """
+        (name, size) of the blobs no saved name links to any more, other
+        than those stored within the last `grace` seconds
+        """
+        root = self.path(BLOB_DIR)
+        stored_before = time.time() - grace
+        for directory, dirs, files in os.walk(root):
+            for filename in files:
+                path = os.path.join(directory, filename)
+                stat = os.stat(path)
+                if (stat.st_nlink == 1 and not filename.startswith('.') and
+                        stat.st_mtime < stored_before):
+                    yield os.path.relpath(path, self.location).replace(os.sep, '/'), stat.st_size
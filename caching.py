@@ -0,0 +1,41 @@
+"""
+Lifetime of the version stamps and cached entries kept in Django's cache.
+
+The rate tables (costengine.py), the dashboard sections (dashboard.py) and
+the in-memory search and name indexes (search.py, nameindex.py) are kept in
+memory or in the cache under a version stamp or generation counter that a
+change replaces, so a change reaches every process that reads the same
+cache. With a cache each process keeps to itself (LocMemCache, the default),
+a change made in one process never reaches the others; there, the stamps and
+entries expire after LOCAL_TIMEOUT seconds instead of living on, so every
+process catches up on its own within that time. Use a shared cache
+(memcached, redis or the database) when running several processes to see
+changes at once.
+"""
+from django.conf import settings
+
+# backends whose entries are only seen by the process that set them
+LOCAL_BACKENDS = ('django.core.cache.backends.locmem.LocMemCache',
+                  'django.core.cache.backends.dummy.DummyCache')
+
+# seconds a stamp or entry lasts in a cache that is not shared
+LOCAL_TIMEOUT = getattr(settings, 'DC_LOCAL_CACHE_TIMEOUT', 60)
+
+
+def shared_cache():
+    """
+    Whether the default cache is shared between processes
+    """
+    backend = settings.CACHES.get('default', {}).get('BACKEND', LOCAL_BACKENDS[0])
+    return backend not in LOCAL_BACKENDS
+
+def timeout(shared_timeout=None):
+    """
+    The timeout to give a stamp or entry that would last shared_timeout
+    seconds (None: forever) in a shared cache
+    """
+    if shared_cache():
+        return shared_timeout
+    if shared_timeout is None:
+        return LOCAL_TIMEOUT
+    return min(shared_timeout, LOCAL_TIMEOUT)
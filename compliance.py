@@ -0,0 +1,176 @@
+"""
+Governance compliance of every project, materialized in ComplianceStatus
+and UserComplianceStatus.
+
+ComplianceScan works out which projects lack a current IRB or DUA, and
+which users are not covered by their project's documents, for any set of
+projects with a fixed number of queries; save() replaces the stored rows of
+those projects:
+
+- `manage.py scancompliance` scans every project (nightly, since documents
+  expire with the date)
+- signals.py schedules a scan of a project when its documents, the people
+  named on them or its users change, run when the transaction commits
+"""
+from collections import defaultdict
+from datetime import date
+
+from django.db import transaction
+from django.db.models import Exists, OuterRef, Q
+
+from persons.models import Person
+
+from .dashboard import bump_generation
+from .models import ComplianceStatus, Governance_Doc, Project, UserComplianceStatus
+from .oncommit import OnCommitBatch
+
+# document types a user of a project may need to be named on
+USER_DOC_TYPES = ('IR', 'DU', 'DC')
+
+
+class ComplianceScan:
+    """
+    Compliance of every project in a queryset on `today`.
+
+    Construction only reads: `statuses` holds an unsaved ComplianceStatus
+    per project and `user_statuses` the UserComplianceStatus rows, until
+    save().
+    """
+    def __init__(self, projects, today=None):
+        self.today = today or date.today()
+        self.project_pks = projects.order_by().values('pk')
+        users = self._users()
+        self.user_statuses = [UserComplianceStatus(project_id=project_pk,
+                                                   person_id=person_pk, **flags)
+                              for (project_pk, person_pk), flags in sorted(users.items())]
+        without_dcua = defaultdict(int)
+        for u in self.user_statuses:
+            if u.on_project and not u.dcua_current:
+                without_dcua[u.project_id] += 1
+        self.statuses = [ComplianceStatus(project_id=row['pk'],
+                                          checked_on=self.today,
+                                          users_without_dcua=without_dcua[row['pk']],
+                                          irb_valid=row['irb_valid'],
+                                          has_dua=row['has_dua'],
+                                          dua_valid=row['dua_valid'],
+                                          documented=row['documented'],
+                                          )
+                         for row in self._projects()]
+
+    def _projects(self):
+        # the document checks of each project, from a single query
+        docs = Governance_Doc.objects.filter(project=OuterRef('pk'))
+        duas = docs.filter(governance_type='DU')
+        return Project.objects.filter(pk__in=self.project_pks).annotate(
+                    irb_valid=Exists(docs.filter(Q(governance_type='IR',
+                                                   expiry_date__gte=self.today) |
+                                                 Q(governance_type='IX'))),
+                    has_dua=Exists(duas),
+                    dua_valid=Exists(duas.filter(expiry_date__gte=self.today)),
+                    documented=Exists(docs),
+                    ).order_by('pk'
+                    ).values('pk', 'irb_valid', 'has_dua', 'dua_valid', 'documented')
+
+    def _current_types(self):
+        """
+        {project pk: types of its documents that neither defer to nor are
+        superseded by another}
+        """
+        types = defaultdict(set)
+        for project_pk, doc_type in Governance_Doc.objects.filter(
+                                        project__in=self.project_pks,
+                                        defers_to_doc__isnull=True,
+                                        superseded_by__isnull=True,
+                                        ).values_list('project_id', 'governance_type'):
+            types[project_pk].add(doc_type)
+        return types
+
+    def _users(self):
+        """
+        {(project pk, person pk): UserComplianceStatus fields}, from one query
+        over the project users and one over the people named on documents
+        """
+        users = defaultdict(lambda: dict(on_project=False, irb=False, dua=False,
+                                         dcua=False, dcua_current=False,
+                                         validated=False))
+        for project_pk, person_pk in Project.users.through.objects.filter(
+                                        project__in=self.project_pks,
+                                        ).values_list('project_id', 'person_id'):
+            users[(project_pk, person_pk)]['on_project'] = True
+        named = Governance_Doc.users_permitted.through.objects.filter(
+                                        governance_doc__project__in=self.project_pks,
+                                        governance_doc__governance_type__in=USER_DOC_TYPES,
+                                        ).values_list('governance_doc__project_id',
+                                                      'person_id',
+                                                      'governance_doc__governance_type',
+                                                      'governance_doc__expiry_date')
+        flag = {'IR': 'irb', 'DU': 'dua', 'DC': 'dcua'}
+        for project_pk, person_pk, doc_type, expiry in named:
+            flags = users[(project_pk, person_pk)]
+            flags[flag[doc_type]] = True
+            if doc_type == 'DC' and expiry >= self.today:
+                flags['dcua_current'] = True
+        # as on the project page: an IRB exemption needs only the DCUA, and
+        # the DUA is only needed where the project has one
+        current_types = self._current_types()
+        for (project_pk, person_pk), flags in users.items():
+            types = current_types[project_pk]
+            if 'IX' in types:
+                flags['validated'] = flags['dcua']
+            elif 'DU' not in types:
+                flags['validated'] = flags['irb'] and flags['dcua']
+            else:
+                flags['validated'] = flags['irb'] and flags['dua'] and flags['dcua']
+        return users
+
+    def save(self):
+        """
+        Replace the stored statuses of the scanned projects. Returns the
+        number of projects.
+        """
+        with transaction.atomic():
+            # no delete signals are connected for these models (see
+            # signals.py), so Django deletes them without fetching the rows;
+            # the generations are bumped once below
+            for model in (ComplianceStatus, UserComplianceStatus):
+                model.objects.filter(project__in=self.project_pks).delete()
+            ComplianceStatus.objects.bulk_create(self.statuses)
+            UserComplianceStatus.objects.bulk_create(self.user_statuses)
+        # bulk changes send no signals: start new dashboard generations here
+        bump_generation(ComplianceStatus)
+        bump_generation(UserComplianceStatus)
+        return len(self.statuses)
+
+
+def project_compliance(project):
+    """
+    The ComplianceStatus of project and its UserComplianceStatus rows (with
+    their people, by person pk): the stored ones, or if the project has not
+    been scanned yet, worked out now without saving them (signals.py and
+    scancompliance store them)
+    """
+    try:
+        status = ComplianceStatus.objects.get(project=project)
+    except ComplianceStatus.DoesNotExist:
+        scan = ComplianceScan(Project.objects.filter(pk=project.pk))
+        people = Person.objects.in_bulk([u.person_id for u in scan.user_statuses])
+        for u in scan.user_statuses:
+            u.person = people[u.person_id]
+        return scan.statuses[0], scan.user_statuses
+    return status, list(project.user_compliance.select_related('person'
+                                                ).order_by('person_id'))
+
+
+def _scan(project_pks):
+    ComplianceScan(Project.objects.filter(pk__in=project_pks)).save()
+
+# projects waiting for a compliance scan
+_pending = OnCommitBatch(_scan)
+
+def schedule_scan(project_pks):
+    """
+    Scan the projects once the current transaction commits (immediately
+    under autocommit). Requests made within one transaction are merged into
+    a single scan; those of a transaction rolled back are dropped.
+    """
+    _pending.add(project_pks)
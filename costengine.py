@@ -0,0 +1,316 @@
+"""
+Batch computation of the projected monthly cost of projects.
+
+The RateTable reads the rate tables once, and ProjectCosts prices a whole
+set of projects in one pass over NumPy arrays (one array per cost column),
+writing the cached cost fields back with a single bulk_update.
+
+Costs are recomputed when their inputs change (see schedule_recompute and
+signals.py) or by the recomputecosts command, so pages showing costs only read.
+"""
+import threading
+import uuid
+
+import numpy as np
+
+from django.core.cache import cache
+from django.db.models import Count
+
+from . import caching
+from .oncommit import OnCommitBatch
+from .models import (Project, SoftwareCost, StorageCost, UserCost,
+                     ExtraResourceCost, DatabaseCost)
+
+# the cached cost fields on Project, in the order they are written back
+COST_FIELDS = [ 'user_cost',
+                'host_cost',
+                'db_cost',
+                'fileshare_cost',
+                'direct_attach_cost',
+                'backup_cost',
+                'software_cost',
+                'project_total_cost',
+                ]
+
+# CPUs and GB RAM included in the base price of a project
+BASE_CPU = 4
+BASE_RAM = 16
+
+# cache key holding the version stamp of the rate tables. With a cache shared
+# between processes, a rate change reaches every process; with a per-process
+# cache, the stamp expires so every process reloads the rates within
+# caching.LOCAL_TIMEOUT seconds.
+RATES_VERSION_KEY = 'dc_management:rates_version'
+
+# (version, RateTable) shared by all threads of the process
+_rates_snapshot = None
+_rates_lock = threading.Lock()
+
+
+class RateTable:
+    """
+    In-memory copy of the UserCost, SoftwareCost, StorageCost,
+    ExtraResourceCost and DatabaseCost tables.
+    """
+    def __init__(self, user_rates, software_rates, storage_rates,
+                 extra_cpu_rates=None, db_rates=None):
+        # {number of users: cost}. The zero user rate is the cost of each user
+        # beyond the most users priced.
+        self.user_rates = user_rates
+        # {software pk: cost per user}
+        self.software_rates = software_rates
+        # [(storage type, cost per GB), ...]
+        self.storage_rates = storage_rates
+        # {number of extra CPUs: cost}
+        self.extra_cpu_rates = extra_cpu_rates or {}
+        # (monthly cost, setup cost) of hosting a database
+        self.db_cost, self.db_setup = db_rates or (0, 0)
+
+        if user_rates:
+            self.max_quantity = max(user_rates)
+            self.max_cost = user_rates[self.max_quantity]
+        else:
+            self.max_quantity = 0
+            self.max_cost = 0
+        self.extra_user = user_rates.get(0, 0)
+
+    @classmethod
+    def load(cls):
+        """
+        Read the rate tables, one query per table.
+        """
+        user_rates = dict(UserCost.objects.order_by('pk'
+                                         ).values_list('user_quantity', 'user_cost'))
+        software_rates = {sw: cost or 0 for sw, cost in
+                          SoftwareCost.objects.order_by('pk'
+                                     ).values_list('software_id', 'software_cost')
+                          }
+        storage_rates = list(StorageCost.objects.order_by('pk'
+                                     ).values_list('storage_type', 'st_cost_per_gb'))
+        extra_cpu_rates = dict(ExtraResourceCost.objects.order_by('pk'
+                                     ).values_list('extra_cpu', 'cpu_cost'))
+        # the first database cost record holds the current database rates
+        db_rates = DatabaseCost.objects.order_by('pk'
+                                     ).values_list('db_cost', 'setup_cost').first()
+        if db_rates:
+            db_rates = (db_rates[0] or 0, db_rates[1] or 0)
+        return cls(user_rates, software_rates, storage_rates,
+                   extra_cpu_rates, db_rates)
+
+    @classmethod
+    def current(cls):
+        """
+        The rate tables as of the latest rate change. The snapshot is shared
+        by the whole process and only reloaded when the version stamp in the
+        cache changes (see invalidate_rates), so most callers query nothing.
+        """
+        global _rates_snapshot
+        version = cache.get(RATES_VERSION_KEY)
+        if version is None:
+            cache.add(RATES_VERSION_KEY, uuid.uuid4().hex, caching.timeout())
+            version = cache.get(RATES_VERSION_KEY)
+        snapshot = _rates_snapshot
+        if snapshot is None or snapshot[0] != version:
+            with _rates_lock:
+                if _rates_snapshot is None or _rates_snapshot[0] != version:
+                    _rates_snapshot = (version, cls.load())
+                snapshot = _rates_snapshot
+        return snapshot[1]
+
+    def storage(self, keyword):
+        """
+        (storage type, cost per GB) of the first storage type containing keyword,
+        or (None, 0)
+        """
+        keyword = keyword.lower()
+        for storage_type, rate in self.storage_rates:
+            if keyword in storage_type.lower():
+                return storage_type, rate or 0
+        return None, 0
+
+    def storage_rate(self, keyword):
+        """
+        cost per GB of the first storage type containing keyword, or 0
+        """
+        return self.storage(keyword)[1]
+
+    def user_cost(self, user_num):
+        """
+        cost of a (non-classroom) project with user_num users
+        """
+        return float(self.user_cost_lookup(user_num)[user_num])
+
+    def user_cost_lookup(self, max_users):
+        """
+        array of the (non-classroom) user cost, indexed by number of users
+        """
+        # projects with more users than any priced quantity (legacy pricing)
+        overflow = self.max_cost + self.extra_user * self.max_quantity
+        lookup = np.full(max(max_users, self.max_quantity) + 1, overflow, dtype=float)
+        for quantity, cost in self.user_rates.items():
+            if quantity >= 0:
+                lookup[quantity] = cost
+        return lookup
+
+
+class ProjectCosts:
+    """
+    Cost components for every project in a queryset.
+
+    Construction only reads: each project gains `user_num`, `sw_costs`
+    [(software name, cost), ...] and `compute_costs`
+    ((extra CPUs, 'CPUs', cost), (extra RAM, 'GB RAM', cost)), while the new
+    value of each cached cost field is kept in `columns` until save().
+    """
+    def __init__(self, projects, rates=None):
+        self.rates = rates or RateTable.current()
+        self.projects = list(projects.select_related('pi', 'db'
+                                    ).annotate(user_num=Count('users')))
+        self._compute(projects)
+
+    def _software(self, projects, index):
+        # software installed on each project, from a single query
+        installed = Project.software_installed.through.objects.filter(
+                                    project__in=projects.order_by().values('pk')
+                                    ).order_by('pk'
+                                    ).values_list('project_id',
+                                                  'software_id',
+                                                  'software__name',
+                                                  )
+        sw_rows = [[] for _ in self.projects]
+        for project_id, software_id, name in installed:
+            sw_rows[index[project_id]].append((name, software_id))
+        return sw_rows
+
+    def _compute(self, projects):
+        rates = self.rates
+        prjs = self.projects
+        index = {prj.pk: i for i, prj in enumerate(prjs)}
+        sw_rows = self._software(projects, index)
+
+        def column(values):
+            return np.array(values, dtype=float).reshape(len(prjs))
+
+        # inputs
+        users = np.array([prj.user_num for prj in prjs], dtype=int).reshape(len(prjs))
+        active = column([prj.status != 'CO' for prj in prjs]).astype(bool)
+        classroom = column([prj.env_type == 'CL' for prj in prjs]).astype(bool)
+        fileshare = column([prj.fileshare_storage or 0 for prj in prjs])
+        derivative = column([prj.fileshare_derivative or 0 for prj in prjs])
+        direct = column([prj.direct_attach_storage or 0 for prj in prjs])
+        db_cpu = column([prj.db.processor_num if prj.db_id else 0 for prj in prjs])
+        hosted = column([prj.host_id is not None for prj in prjs]).astype(bool)
+        cpu = column([prj.requested_cpu or 0 for prj in prjs])
+        ram = column([prj.requested_ram or 0 for prj in prjs])
+        sw_rate = column([sum(rates.software_rates.get(sw, 0) for name, sw in row)
+                          for row in sw_rows])
+
+        # storage is charged for every project
+        fileshare_cost = fileshare * rates.storage_rate('primary')
+        backup_cost = derivative * rates.storage_rate('derivative')
+
+        # users: classrooms pay the single user rate for the PI and the extra user
+        # rate for everyone else (no one else in a class without users)
+        lookup = rates.user_cost_lookup(int(users.max()) if len(prjs) else 0)
+        user_cost = np.where(classroom,
+                             np.maximum(users - 1, 0) * rates.extra_user +
+                             rates.user_rates.get(1, 0),
+                             lookup[users],
+                             )
+        direct_attach_cost = direct * rates.storage_rate('direct')
+        software_cost = sw_rate * users
+        db_cost = db_cpu / 2 * rates.storage_rate('db')
+
+        # resources beyond the base CPU and RAM of the host
+        xtra_cpu = np.where(hosted, np.maximum(cpu - BASE_CPU, 0), 0)
+        xtra_ram = np.where(hosted, np.maximum(ram - BASE_RAM, 0), 0)
+        cpu_cost = xtra_cpu / 2 * rates.storage_rate('CPU')
+        ram_cost = xtra_ram / 8 * rates.storage_rate('RAM')
+        host_cost = np.maximum(cpu_cost, ram_cost)
+
+        # completed projects only have storage costs, ie no compute costs
+        for col in (user_cost, direct_attach_cost, software_cost, db_cost,
+                    host_cost, xtra_cpu, xtra_ram, cpu_cost, ram_cost):
+            col[~active] = 0
+
+        total = (backup_cost + fileshare_cost + direct_attach_cost + user_cost +
+                 software_cost + db_cost + host_cost)
+        self.grand_total = float(total.sum())
+
+        columns = dict(zip(COST_FIELDS, (user_cost, host_cost, db_cost,
+                                         fileshare_cost, direct_attach_cost,
+                                         backup_cost, software_cost, total)))
+        # {field: [value for each project]}
+        self.columns = {field: col.tolist() for field, col in columns.items()}
+        compute = zip(xtra_cpu.astype(int).tolist(), cpu_cost.tolist(),
+                      xtra_ram.astype(int).tolist(), ram_cost.tolist())
+
+        for i, (prj, row, comp) in enumerate(zip(prjs, sw_rows, compute)):
+            if active[i]:
+                prj.sw_costs = [(name, rates.software_rates.get(sw, 0) * prj.user_num)
+                                for name, sw in row]
+            else:
+                prj.sw_costs = []
+            prj.compute_costs = ((comp[0], 'CPUs', comp[1]),
+                                 (comp[2], 'GB RAM', comp[3]),
+                                 )
+
+    def rows(self):
+        """
+        (project, software costs, compute costs) for each project, as used by
+        the finance report
+        """
+        return [(prj, prj.sw_costs, prj.compute_costs) for prj in self.projects]
+
+    def changed(self):
+        """
+        indices of the projects whose stored costs differ from the new ones
+        """
+        return [i for i, prj in enumerate(self.projects)
+                if any(getattr(prj, field) != values[i]
+                       for field, values in self.columns.items())
+                ]
+
+    def save(self):
+        """
+        Set the newly computed cost fields on the projects, and write those
+        whose costs changed back to the database. Returns the number of
+        projects updated.
+        """
+        changed = []
+        for i in self.changed():
+            prj = self.projects[i]
+            for field, values in self.columns.items():
+                setattr(prj, field, values[i])
+            changed.append(prj)
+        if changed:
+            Project.objects.bulk_update(changed, COST_FIELDS)
+        return len(changed)
+
+
+def invalidate_rates():
+    """
+    Give the rate tables a new version stamp, so the next RateTable.current()
+    in any process sharing the cache reloads them.
+    """
+    cache.set(RATES_VERSION_KEY, uuid.uuid4().hex, caching.timeout())
+
+
+def _recompute(project_pks):
+    if project_pks is None:
+        projects = Project.objects.all()
+    else:
+        projects = Project.objects.filter(pk__in=project_pks)
+    ProjectCosts(projects).save()
+
+# projects waiting for their costs to be recomputed
+_pending = OnCommitBatch(_recompute)
+
+def schedule_recompute(project_pks=None):
+    """
+    Recompute project costs once the current transaction commits (immediately
+    under autocommit). project_pks=None recomputes every project. Requests
+    made within one transaction are merged into a single recompute; those of
+    a transaction rolled back are dropped.
+    """
+    _pending.add(project_pks)
@@ -0,0 +1,268 @@
+"""
+The sections of the operations dashboard (the index page).
+
+Dashboard builds each section with date arithmetic and Exists subqueries in
+the database (the governance checks are read from ComplianceStatus, see
+compliance.py, or worked out from the documents of projects not scanned
+yet), annotated and prefetched for what its template shows, so the whole
+page costs a fixed number of queries.
+
+The sections are cached. Every model a section is built from has a
+generation counter in the cache, bumped by signals.py whenever one of its
+rows (or m2m links) changes; a section is cached under the generations of its
+models, so a change only rebuilds the sections that depend on it. Changes made
+with queryset.update() or bulk_update() send no signals, and are not seen
+until the section's entry expires (or bump_generation() is called).
+
+The counters only reach the processes sharing the cache: with a per-process
+cache (LocMemCache), sections expire after caching.LOCAL_TIMEOUT seconds,
+so a change made by another process shows within that time.
+"""
+from datetime import date, timedelta
+
+from django.core.cache import cache
+from django.db.models import Exists, OuterRef, Q
+
+from persons.models import Person, Role
+
+from . import caching
+from .models import CommentLog, Governance_Doc, MigrationLog, Project, Server, Software
+from .models import ComplianceStatus
+from .nodeindex import NodeUserIndex
+
+# days before expected completion that a project shows as expiring
+EXPIRING_DAYS = 60
+
+# days before expiry that a governance document needs attention
+ATTENTION_DAYS = 90
+
+# age (in days) of governance documentation after which a user needs auditing
+AUDIT_DAYS = 360
+
+# cache keys of the generation counters and of the cached sections
+GENERATION_KEY = 'dc_management:generation:{}'
+SECTION_KEY = 'dc_management:dashboard:{}:{}:{}'
+
+# seconds a cached section is kept in a shared cache (see caching.timeout).
+# Sections are also keyed by date, so entries from previous days are only left
+# to expire.
+SECTION_TIMEOUT = 60 * 60 * 24
+
+# what the project list sections show for each project
+_PROJECT_LIST = (Project, Project.users.through, Person, Role,
+                 Project.dynamic_comments.through, CommentLog)
+
+# section name -> models (or m2m through models) it is built from
+SECTION_MODELS = {
+    'server_list'        : (Server, Project, Project.users.through, Person, Role),
+    'onboarding_prj_list': _PROJECT_LIST + (MigrationLog,),
+    'onboarding_list'    : (MigrationLog, Project, Server),
+    'migration_list'     : (MigrationLog, Project, Server),
+    'expiring_list'      : _PROJECT_LIST,
+    'shutting_list'      : _PROJECT_LIST,
+    'attention_docs'     : (Governance_Doc, Project),
+    'undocumented_list'  : _PROJECT_LIST + (ComplianceStatus, Governance_Doc),
+    'irb_invalid'        : _PROJECT_LIST + (ComplianceStatus, Governance_Doc),
+    'dua_invalid'        : _PROJECT_LIST + (ComplianceStatus, Governance_Doc),
+    'undoc_user_list'    : (Person, Project, Project.users.through,
+                            Governance_Doc, Governance_Doc.users_permitted.through),
+}
+
+# every model whose changes bump a generation (see signals.py)
+WATCHED_MODELS = {m for models in SECTION_MODELS.values() for m in models}
+
+
+def generation_key(model):
+    return GENERATION_KEY.format(model._meta.label_lower)
+
+def bump_generation(model):
+    """
+    Start a new generation of the model's data, so that the cached sections
+    built from it are rebuilt on the next dashboard load.
+    """
+    key = generation_key(model)
+    try:
+        cache.incr(key)
+    except ValueError:
+        # not in the cache (yet, or any more)
+        cache.set(key, 1, None)
+
+
+class Dashboard:
+    """
+    Each section is a method returning a list; snapshot() returns them all,
+    from the cache where their models have not changed.
+    """
+    # section name -> method, in the order they appear on the page
+    SECTIONS = (
+        'server_list',
+        'onboarding_prj_list',
+        'onboarding_list',
+        'migration_list',
+        'expiring_list',
+        'shutting_list',
+        'attention_docs',
+        'undocumented_list',
+        'irb_invalid',
+        'dua_invalid',
+        'undoc_user_list',
+    )
+
+    def __init__(self, request=None, today=None):
+        self.request = request
+        self.today = today or date.today()
+
+    def project_list(self, projects):
+        # what the project list templates show for each project
+        return list(projects.with_user_counts(
+                            ).select_related('pi', 'prj_admin'
+                            ).prefetch_related('dynamic_comments'))
+
+    def still_running(self):
+        # all projects running and without a completed date
+        return Project.objects.filter(status='RU', completion_date__isnull=True)
+
+    def expiring_list(self):
+        return self.project_list(self.still_running().filter(
+                    expected_completion__lte=self.today + timedelta(days=EXPIRING_DAYS),
+                    ).order_by('expected_completion'))
+
+    def documents(self):
+        # the governance documents of the outer project
+        return Governance_Doc.objects.filter(project=OuterRef('pk'))
+
+    def unscanned(self, condition):
+        # projects without a ComplianceStatus (never scanned, or their scan
+        # not committed yet) are unknown: checked against their documents
+        return Q(compliance__isnull=True) & condition
+
+    def irb_invalid(self):
+        # running projects without a current IRB or an IRB exemption
+        current = self.documents().filter(Q(governance_type='IR',
+                                            expiry_date__gte=self.today) |
+                                          Q(governance_type='IX'))
+        return self.project_list(self.still_running().filter(
+                                    Q(compliance__irb_valid=False) |
+                                    self.unscanned(~Exists(current))
+                                    ).order_by('expected_completion'))
+
+    def dua_invalid(self):
+        # projects (not completed) with DUAs, none of which are current
+        duas = self.documents().filter(governance_type='DU')
+        return self.project_list(Project.objects.filter(
+                                    Q(compliance__has_dua=True, compliance__dua_valid=False) |
+                                    self.unscanned(Exists(duas) &
+                                                   ~Exists(duas.filter(expiry_date__gte=self.today)))
+                                    ).exclude(status='CO'
+                                    ).order_by('dc_prj_id'))
+
+    def undocumented_list(self):
+        return self.project_list(Project.objects.filter(
+                                    Q(compliance__documented=False) |
+                                    self.unscanned(~Exists(self.documents()))
+                                    ).order_by('dc_prj_id'))
+
+    def shutting_list(self):
+        return self.project_list(Project.objects.filter(status='SD',
+                                                        completion_date__isnull=True,
+                                    ).order_by('expected_completion'))
+
+    def onboarding_prj_list(self):
+        # onboarding projects not yet being migrated
+        migrations = MigrationLog.objects.filter(project=OuterRef('pk'))
+        return self.project_list(Project.objects.filter(status='ON'
+                                    ).filter(~Exists(migrations)
+                                    ).order_by('requested_launch'))
+
+    def migrations(self):
+        # migrations with steps left to confirm
+        return MigrationLog.objects.filter(Q(access_date__isnull=True) |
+                                           Q(envt_date__isnull=True) |
+                                           Q(data_date__isnull=True)
+                                    ).select_related('project',
+                                                     'node_origin',
+                                                     'node_destination',
+                                    ).order_by('record_creation')
+
+    def onboarding_list(self):
+        return list(self.migrations().filter(project__status='ON'))
+
+    def migration_list(self):
+        return list(self.migrations().exclude(project__status__in=['ON', 'SU']))
+
+    def attention_docs(self):
+        """
+        IRBs and DUAs of running projects expiring within ATTENTION_DAYS that
+        neither defer to nor are superseded by another document, each with its
+        `attention` level (see Governance_Doc.attention_required).
+        """
+        return list(Governance_Doc.objects.with_attention(self.today
+                    ).filter(
+                        project__status='RU',
+                        governance_type__in=['IR', 'DU'],
+                        expiry_date__lte=self.today + timedelta(days=ATTENTION_DAYS),
+                    ).exclude(attention='safe'
+                    ).select_related('project'
+                    ).order_by('project__dc_prj_id', 'pk'))
+
+    def undoc_user_list(self):
+        # users of active projects without recent governance documentation
+        active = Project.users.through.objects.filter(person=OuterRef('pk'),
+                                                      project__status__in=['RU', 'SD'])
+        recent = Governance_Doc.users_permitted.through.objects.filter(
+                        person=OuterRef('pk'),
+                        governance_doc__date_issued__gte=self.today - timedelta(days=AUDIT_DAYS),
+                        )
+        return list(Person.objects.filter(Exists(active)
+                        ).exclude(Exists(recent)
+                        ).prefetch_related('project_set'
+                        ).order_by('first_name'))
+
+    def server_list(self):
+        # for finding users assigned more than once
+        if self.request is not None:
+            index = NodeUserIndex.for_request(self.request)
+        else:
+            index = NodeUserIndex()
+        servers = index.attach(Server.objects.filter(status="ON", function="PR"
+                                    ).order_by('node'))
+        # find the duplicates now, so the cached servers answer without queries
+        for s in servers:
+            s.duplicate_users()
+        return servers
+
+    def sw_list(self):
+        return Software.objects.with_usage(
+                                ).select_related('license_type'
+                                ).order_by('-seat_count', 'name')
+
+    def section_keys(self):
+        """
+        {section name: cache key} for the current generations of its models
+        """
+        gen_keys = {m: generation_key(m) for m in WATCHED_MODELS}
+        generations = cache.get_many(gen_keys.values())
+        keys = {}
+        for name in self.SECTIONS:
+            stamp = '.'.join(str(generations.get(gen_keys[m], 0))
+                             for m in SECTION_MODELS[name])
+            keys[name] = SECTION_KEY.format(name, self.today.isoformat(), stamp)
+        return keys
+
+    def snapshot(self):
+        """
+        {section name: list} for every section of the dashboard. Sections
+        found in the cache are not rebuilt.
+        """
+        keys = self.section_keys()
+        cached = cache.get_many(keys.values())
+        sections = {}
+        rebuilt = {}
+        for name in self.SECTIONS:
+            if keys[name] in cached:
+                sections[name] = cached[keys[name]]
+            else:
+                sections[name] = rebuilt[keys[name]] = getattr(self, name)()
+        if rebuilt:
+            cache.set_many(rebuilt, caching.timeout(SECTION_TIMEOUT))
+        return sections
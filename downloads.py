@@ -0,0 +1,124 @@
+"""
+Serving stored files (governance documents) to the browser.
+
+file_response() streams the file in chunks, answers single byte ranges
+(honouring If-Range), sends ETag and Last-Modified from the file's stat and
+answers conditional requests with 304 (or 412), so a download never holds
+the whole file in memory.
+
+With settings.DC_SENDFILE set, the bytes are left to the web server:
+
+- 'X-Sendfile': Apache mod_xsendfile (or lighttpd) sends the file at the
+  path in the X-Sendfile header
+- 'X-Accel-Redirect': nginx sends the file at the internal location
+  settings.DC_SENDFILE_PREFIX followed by its path under MEDIA_ROOT
+"""
+import os
+import re
+from urllib.parse import quote
+
+from django.conf import settings
+from django.http import HttpResponse, StreamingHttpResponse
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, parse_http_date_safe
+
+# bytes read from the file at a time
+CHUNK_SIZE = 64 * 1024
+
+# a single byte range: 'bytes=first-last', 'bytes=first-' or 'bytes=-suffix'
+RANGE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+def file_etag(stat):
+    return '"{:x}-{:x}"'.format(stat.st_mtime_ns, stat.st_size)
+
+
+def content_disposition(disposition, filename):
+    """
+    Content-Disposition header value for filename, which may be non-ASCII
+    """
+    try:
+        filename.encode('ascii')
+    except UnicodeEncodeError:
+        return "{}; filename*=utf-8''{}".format(disposition, quote(filename))
+    return '{}; filename="{}"'.format(disposition,
+                                      filename.replace('\\', '\\\\').replace('"', r'\"'))
+
+
+def byte_range(request, size, etag, last_modified):
+    """
+    (first, last) byte of the single range requested, None for the whole file
+    (no Range, one we do not handle or that is invalid, or an If-Range the
+    file no longer matches), or False if the range is unsatisfiable.
+    """
+    match = RANGE.match(request.META.get('HTTP_RANGE', '').replace(' ', ''))
+    if not match or match.group(1) == match.group(2) == '':
+        return None
+    if_range = request.META.get('HTTP_IF_RANGE')
+    if if_range and if_range != etag and parse_http_date_safe(if_range) != last_modified:
+        return None
+    first, last = match.groups()
+    if first and last and int(last) < int(first):
+        # invalid, so ignored (RFC 9110 14.2)
+        return None
+    if first == '':
+        # the last `last` bytes
+        first, last = max(size - int(last), 0), size - 1
+    else:
+        first, last = int(first), min(int(last), size - 1) if last else size - 1
+    if first > last or first >= size:
+        return False
+    return first, last
+
+
+def read_chunks(path, first, length):
+    with open(path, 'rb') as fh:
+        fh.seek(first)
+        while length > 0:
+            chunk = fh.read(min(CHUNK_SIZE, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+
+
+def file_response(request, path, content_type, disposition='inline', filename=None):
+    """
+    Response serving the file at path. Raises FileNotFoundError if it does
+    not exist.
+    """
+    stat = os.stat(path)
+    etag = file_etag(stat)
+    last_modified = int(stat.st_mtime)
+    response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    if response is None:
+        mode = getattr(settings, 'DC_SENDFILE', None)
+        if mode:
+            response = HttpResponse(content_type=content_type)
+            if mode == 'X-Accel-Redirect':
+                relative = os.path.relpath(path, settings.MEDIA_ROOT)
+                response[mode] = quote(settings.DC_SENDFILE_PREFIX.rstrip('/') + '/' +
+                                       relative.replace(os.sep, '/'))
+            else:
+                response[mode] = path
+        else:
+            size = stat.st_size
+            span = byte_range(request, size, etag, last_modified)
+            if span is False:
+                response = HttpResponse(status=416)
+                response['Content-Range'] = 'bytes */{}'.format(size)
+                return response
+            first, last = span or (0, size - 1)
+            response = StreamingHttpResponse(read_chunks(path, first, last - first + 1),
+                                             content_type=content_type,
+                                             status=206 if span else 200)
+            response['Content-Length'] = str(last - first + 1)
+            if span:
+                response['Content-Range'] = 'bytes {}-{}/{}'.format(first, last, size)
+        response['Accept-Ranges'] = 'bytes'
+        response['Content-Disposition'] = content_disposition(
+                                            disposition,
+                                            filename or os.path.basename(path))
+    response['ETag'] = etag
+    response['Last-Modified'] = http_date(last_modified)
+    return response
@@ -19,8 +19,9 @@ from .models import Server, Person, Software_Log, Project
 from .models import DCUAGenerator, Storage_Log, StorageCost, Governance_Doc
 from .models import FileTransfer, MigrationLog, CommentLog, Storage
 from .models import DataCoreUserAgreement
-from .models import ProjectBillingRecord, UserCost, SoftwareCost, DatabaseCost
-from .models import ExtraResourceCost, SFTP
+from .models import ProjectBillingRecord
+from .models import SFTP
+from .costengine import RateTable
 
 """
 class CommentForm(forms.Form):
@@ -41,10 +42,10 @@ class AddUserToProjectForm(forms.Form):
                                         url='dc_management:autocomplete-user'
                                         ),
                                 )
-    project = forms.ModelChoiceField(
+    projects = forms.ModelMultipleChoiceField(
                                 queryset=Project.objects.exclude(status="CO"), 
-                                label="Project",
-                                widget = autocomplete.ModelSelect2(
+                                label="Projects",
+                                widget = autocomplete.ModelSelect2Multiple(
                                         url='dc_management:autocomplete-project'
                                         ),
                                 )
@@ -59,7 +60,7 @@ class AddUserToProjectForm(forms.Form):
         widgets =  {'dcusers' : autocomplete.ModelSelect2Multiple(
                                         url='dc_management:autocomplete-user'
                                         ),
-                    'project' : autocomplete.ModelSelect2(
+                    'projects' : autocomplete.ModelSelect2Multiple(
                                         url='dc_management:autocomplete-project'
                                         ),
                     }
@@ -69,9 +70,12 @@ class RemoveUserFromProjectForm(forms.Form):
                                 queryset=Person.objects.none(), 
                                 label="Data Core User",
                                     )
-    project = forms.ModelChoiceField(
+    projects = forms.ModelMultipleChoiceField(
                                 queryset=Project.objects.all(), 
-                                label="Project"
+                                label="Projects",
+                                widget = autocomplete.ModelSelect2Multiple(
+                                        url='dc_management:autocomplete-project'
+                                        ),
                                     )
     email_comment = forms.CharField(required=False, label="Comment for SN ticket",)                            
     comment = forms.CharField(required=False, label="Comment for db log",)
@@ -83,7 +87,7 @@ class RemoveUserFromProjectForm(forms.Form):
         super(RemoveUserFromProjectForm, self).__init__(*args, **kwargs)
         self.fields['dcusers'].queryset = qs
     class Meta:
-        widgets = {'project' : autocomplete.ModelSelect2(
+        widgets = {'projects' : autocomplete.ModelSelect2Multiple(
                                         url='dc_management:autocomplete-project'
                                         ),
                     }
@@ -382,9 +386,9 @@ project_dates = Layout(Fieldset('<div class="alert alert-info">Project dates</di
                 ),  
 )           
 
-def get_storage_costs(storage_type, project):
-    st = StorageCost.objects.get(storage_type__icontains=storage_type)
-    st_type = st.storage_type               # kind of storage 
+def get_storage_costs(storage_type, project, rates=None):
+    rates = rates or RateTable.current()
+    st_type, st_rate = rates.storage(storage_type)  # kind of storage, rate per GB
     
     if storage_type == 'archiv':
         st_value = project.backup_storage
@@ -397,8 +401,6 @@ def get_storage_costs(storage_type, project):
     else:
         st_value = 0
     
-    st_rate = st.st_cost_per_gb                 # rate per 100 GB
-    st_rate =  (st_rate if st_rate else 0 )     # remove null values
     st_value =  (st_value if st_value else 0 )  # remove null values
     st_expense = st_rate * st_value             # cost
     return st_type, st_value, st_rate, st_expense
@@ -413,7 +415,10 @@ class ProjectBillingForm(forms.ModelForm):
         #prj = Project.objects.get(pk=ppk)
         
         #ppk = self.kwargs['ppk']
-        prj = Project.objects.get(pk=ppk)
+        prj = Project.objects.prefetch_related('software_installed').get(pk=ppk)
+        
+        # rates come from the shared snapshot, so are not queried per form
+        rates = RateTable.current()
         
         self.fields['billing_date'].initial = datetime.date.today()
         
@@ -422,30 +427,30 @@ class ProjectBillingForm(forms.ModelForm):
         self.fields['base_value'].label = "Number of users"
         self.fields['base_value'].initial = user_number
 
-        user_rate = UserCost.objects.get(user_quantity=user_number).user_cost
+        user_rate = rates.user_cost(user_number)
         self.fields['base_rate'].initial = user_rate
         self.fields['base_expense'].initial = user_rate
         
         # get the storage charges
-        st1_type, st1_value, st1_rate, st1_expense = get_storage_costs("primary", prj)
+        st1_type, st1_value, st1_rate, st1_expense = get_storage_costs("primary", prj, rates)
         self.fields['storage_1_type'].initial    = st1_type
         self.fields['storage_1_value'].initial   = st1_value
         self.fields['storage_1_rate'].initial    = st1_rate
         self.fields['storage_1_expense'].initial = st1_expense
         
-        st2_type, st2_value, st2_rate, st2_expense = get_storage_costs("derivative", prj)
+        st2_type, st2_value, st2_rate, st2_expense = get_storage_costs("derivative", prj, rates)
         self.fields['storage_2_type'].initial    = st2_type
         self.fields['storage_2_value'].initial   = st2_value
         self.fields['storage_2_rate'].initial    = st2_rate
         self.fields['storage_2_expense'].initial = st2_expense
 
-        st3_type, st3_value, st3_rate, st3_expense = get_storage_costs("direct", prj)
+        st3_type, st3_value, st3_rate, st3_expense = get_storage_costs("direct", prj, rates)
         self.fields['storage_3_type'].initial    = st3_type
         self.fields['storage_3_value'].initial   = st3_value
         self.fields['storage_3_rate'].initial    = st3_rate
         self.fields['storage_3_expense'].initial = st3_expense
 
-        st4_type, st4_value, st4_rate, st4_expense = get_storage_costs("archiv", prj)
+        st4_type, st4_value, st4_rate, st4_expense = get_storage_costs("archiv", prj, rates)
         self.fields['storage_4_type'].initial    = st4_type
         self.fields['storage_4_value'].initial   = st4_value
         self.fields['storage_4_rate'].initial    = st4_rate
@@ -456,7 +461,7 @@ class ProjectBillingForm(forms.ModelForm):
         
         sw_costs = []
         for sw in prj.software_installed.all():
-            sw_rate = SoftwareCost.objects.get(software=sw.pk).software_cost
+            sw_rate = rates.software_rates.get(sw.pk, 0)
             sw_cost = sw_rate * user_number
             sw_costs.append(sw_cost)
         x = np.array(sw_costs)
@@ -471,8 +476,7 @@ class ProjectBillingForm(forms.ModelForm):
         # get extra computation costs
         if prj.requested_cpu and prj.requested_cpu > 4:
             prj_erc = prj.requested_cpu - 4
-            erc = ExtraResourceCost.objects.get(extra_cpu=prj_erc)
-            erc_cost = erc.cpu_cost
+            erc_cost = rates.extra_cpu_rates.get(prj_erc, 0)
         else:
             prj_erc = 0
             erc_cost = 0
@@ -484,9 +488,9 @@ class ProjectBillingForm(forms.ModelForm):
         self.fields['hosting_expense'].initial = erc_cost
 
         # get db costs
-        if prj.db:
+        if prj.db_id:
             db_value = 1
-            db_rate = DatabaseCost.objects.get(pk=1).db_cost
+            db_rate = rates.db_cost
         else:
             db_value = 0
             db_rate = 0
@@ -1114,12 +1118,13 @@ class AddSoftwareToProjectForm(forms.ModelForm):
                     }
 
 class BulkUserUploadForm(forms.Form):
-    # To be updated for bulk upload of users:
     users_csv = forms.FileField(
                                 label="CSV file of users for upload"
                                     )
     comment = forms.CharField(required=False, 
                     label="Comment (will be appended to all users' comment fields)")
+    update_existing = forms.BooleanField(required=False,
+                    label="Update users whose CWID already exists (otherwise they are skipped)")
  
 class FileTransferForm(forms.ModelForm):
     def __init__(self, *args, **kwargs):
@@ -0,0 +1,133 @@
+"""
+Pages of the log tables (access, software, storage, ... logs) of a project,
+person or server, for the log tabs of their pages.
+
+Each table is loaded from LogPageView when its tab is opened, a page at a
+time. Pages are keyset-paginated on (date, pk), newest first: the next page
+starts after the last row shown instead of at an OFFSET, so any page costs
+the same however long the history is.
+"""
+import datetime
+
+from django.db.models import Q
+
+from .models import Access_Log, External_Access_Log, Software_Log, Storage_Log
+from .models import FileTransfer, Audit_Log, MigrationLog, Server_Change_Log
+
+# rows per page of a log table
+PAGE_SIZE = 25
+
+
+def parse_cursor(value):
+    """
+    (date, pk) from a cursor made by LogPage.next_cursor, or None for the
+    first page. Raises ValueError for a malformed cursor.
+    """
+    if not value:
+        return None
+    day, pk = value.split('.')
+    return datetime.datetime.strptime(day, '%Y-%m-%d').date(), int(pk)
+
+
+class LogPage:
+    """
+    One page of log rows, with the cursor of the page after it (or None)
+    """
+    def __init__(self, rows, next_cursor=None):
+        self.rows = rows
+        self.next_cursor = next_cursor
+
+
+class LogTable:
+    """
+    A log model listed for the owner (project, person or server) its `owner`
+    foreign keys point at, newest `date_field` first.
+    """
+    def __init__(self, model, owner, date_field, template, related=()):
+        self.model = model
+        self.owner = owner
+        self.date_field = date_field
+        self.template = template
+        self.related = related
+
+    def rows(self, owner_pk):
+        match = Q()
+        for field in self.owner:
+            match |= Q(**{field: owner_pk})
+        return self.model.objects.filter(match).select_related(*self.related)
+
+    def page(self, owner_pk, after=None, size=PAGE_SIZE):
+        """
+        The LogPage of up to `size` rows following the (date, pk) cursor `after`
+        """
+        rows = self.rows(owner_pk)
+        if after is not None:
+            day, pk = after
+            rows = rows.filter(Q(**{self.date_field + '__lt': day}) |
+                               Q(**{self.date_field: day, 'pk__lt': pk}))
+        # one row more than the page shows, to know if there is a next page
+        rows = list(rows.order_by('-' + self.date_field, '-pk')[:size + 1])
+        if len(rows) <= size:
+            return LogPage(rows)
+        last = rows[size - 1]
+        cursor = '{}.{}'.format(getattr(last, self.date_field).isoformat(), last.pk)
+        return LogPage(rows[:size], cursor)
+
+
+# owner -> log name -> LogTable
+LOG_TABLES = {
+    'project': {
+        'access': LogTable(Access_Log, ('prj_affected',), 'record_creation',
+                           'dc_management/log_access.html',
+                           ('dc_user', 'record_author')),
+        'external_access': LogTable(External_Access_Log, ('project_connected',),
+                           'record_creation',
+                           'dc_management/log_external_access.html'),
+        'software': LogTable(Software_Log, ('applied_to_prj',), 'change_date',
+                           'dc_management/log_software.html',
+                           ('software_changed',)),
+        'storage': LogTable(Storage_Log, ('project',), 'record_creation',
+                           'dc_management/log_storage.html',
+                           ('storage_type',)),
+        'file_transfer': LogTable(FileTransfer, ('source', 'destination'), 'change_date',
+                           'dc_management/log_file_transfer.html',
+                           ('source', 'destination')),
+        'audit': LogTable(Audit_Log, ('project',), 'record_creation',
+                           'dc_management/log_audit.html',
+                           ('dc_user',)),
+        'migration': LogTable(MigrationLog, ('project',), 'record_creation',
+                           'dc_management/log_migration.html',
+                           ('project', 'node_origin', 'node_destination')),
+    },
+    'person': {
+        'access': LogTable(Access_Log, ('dc_user',), 'record_creation',
+                           'dc_management/log_access.html',
+                           ('prj_affected',)),
+        'external_access': LogTable(External_Access_Log, ('user_requesting',),
+                           'record_creation',
+                           'dc_management/log_external_access.html'),
+        'software': LogTable(Software_Log, ('applied_to_user',), 'change_date',
+                           'dc_management/log_software.html',
+                           ('software_changed',)),
+        'file_transfer': LogTable(FileTransfer, ('requester',), 'change_date',
+                           'dc_management/log_file_transfer.html',
+                           ('source', 'destination')),
+        'audit': LogTable(Audit_Log, ('dc_user',), 'record_creation',
+                           'dc_management/log_audit.html',
+                           ('dc_user',)),
+    },
+    'server': {
+        'change': LogTable(Server_Change_Log, ('node_changed',), 'change_date',
+                           'dc_management/log_server_change.html'),
+        'software': LogTable(Software_Log, ('applied_to_node',), 'change_date',
+                           'dc_management/log_software.html',
+                           ('software_changed', 'applied_to_prj')),
+        'audit': LogTable(Audit_Log, ('node',), 'record_creation',
+                           'dc_management/log_audit.html',
+                           ('dc_user',)),
+        'migration': LogTable(MigrationLog, ('node_origin', 'node_destination'),
+                           'record_creation',
+                           'dc_management/log_migration.html',
+                           ('project', 'node_origin', 'node_destination')),
+    },
+}
@@ -0,0 +1,141 @@
+import datetime
+import time
+
+from django.core.management.base import BaseCommand
+
+from django.contrib.auth.models import User
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+
+from persons.models import Person
+
+from dc_management.costengine import ProjectCosts
+from dc_management.models import   (Project,
+                                    Server,
+                                    Software,
+                                    Software_License_Type,
+                                    SoftwareCost,
+                                    UserCost,
+                                    StorageCost,
+                                    EnvtSubtype,
+                                    SubFunction,
+                                    )
+
+class Command(BaseCommand):
+    help = ('Times the project cost engine against synthetic projects. '
+            'All synthetic records are rolled back when the run completes.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('sizes', nargs='*', type=int, default=[100, 1000, 10000])
+        parser.add_argument('--users', type=int, default=4,
+                            help='users per project')
+        parser.add_argument('--software', type=int, default=3,
+                            help='software packages per project')
+
+    def handle(self, *args, **options):
+        self.stdout.write("{:>8} {:>10} {:>10} {:>8} {:>10} {:>10} {:>8}".format(
+                            'projects', 'price (s)', 'queries', 'saved',
+                            'reprice (s)', 'queries', 'saved'))
+        with transaction.atomic():
+            self.make_fixtures(options['users'], options['software'])
+            created = 0
+            for size in sorted(options['sizes']):
+                self.make_projects(created, size, options['users'],
+                                   options['software'])
+                created = size
+                # first pass writes every project, the second finds nothing changed
+                results = [self.run_once() for i in range(2)]
+                self.stdout.write(
+                        "{:>8} {:>10.3f} {:>10} {:>8} {:>10.3f} {:>10} {:>8}".format(
+                            size, *results[0], *results[1]))
+                # start the next size from unpriced projects again
+                Project.objects.filter(dc_prj_id__startswith='bm'
+                                      ).update(project_total_cost=None)
+            transaction.set_rollback(True)
+
+    def run_once(self):
+        with CaptureQueriesContext(connection) as queries:
+            start = time.perf_counter()
+            costs = ProjectCosts(Project.objects.filter(dc_prj_id__startswith='bm'))
+            saved = costs.save()
+            elapsed = time.perf_counter() - start
+        return elapsed, len(queries), saved
+
+    def make_fixtures(self, users, software):
+        author = User.objects.create(username='benchmarkcosts')
+        self.people = [Person.objects.create(first_name='bench',
+                                             last_name=str(i),
+                                             cwid='bm{:05d}'.format(i),
+                                             ) for i in range(max(users, 1) * 10)]
+        self.env = EnvtSubtype.objects.create(name='benchmarkcosts')
+        subfn = SubFunction.objects.create(name='benchmarkcosts')
+        self.hosts = [Server.objects.create(status="ON",
+                                            function="PR",
+                                            node="BMK{:03d}".format(i),
+                                            sub_function=subfn,
+                                            name_address="bm{}.invalid".format(i),
+                                            ip_address="10.255.255.{}".format(i),
+                                            processor_num=16,
+                                            ram=64,
+                                            disk_storage=100,
+                                            other_storage=100,
+                                            ) for i in range(10)]
+        lic = Software_License_Type.objects.create(name='benchmarkcosts',
+                                                   user_assigned=False,
+                                                   concurrent=True,
+                                                   monitored=False,
+                                                   )
+        self.software = [Software.objects.create(name='bm{}'.format(i),
+                                                 vendor='bm',
+                                                 version='1',
+                                                 license_type=lic,
+                                                 ) for i in range(max(software, 1) * 3)]
+        SoftwareCost.objects.bulk_create([
+                        SoftwareCost(record_author=author, software=sw, software_cost=i)
+                        for i, sw in enumerate(self.software)
+                        ])
+        UserCost.objects.bulk_create([
+                        UserCost(record_author=author, user_quantity=i, user_cost=100 + i)
+                        for i in range(users + 1)
+                        ])
+        StorageCost.objects.bulk_create([
+                        StorageCost(record_author=author, storage_type=st, st_cost_per_gb=1)
+                        for st in ('primary', 'derivative', 'direct', 'db', 'CPU', 'RAM')
+                        ])
+
+    def make_projects(self, start, stop, users, software):
+        today = datetime.date.today()
+        # bulk_create only returns pks on some backends, so read them back
+        Project.objects.bulk_create([
+                Project(dc_prj_id='bm{:05d}'.format(i),
+                        title='benchmark',
+                        pi=self.people[0],
+                        env_subtype=self.env,
+                        expected_completion=today,
+                        requested_launch=today,
+                        status=('RU', 'RU', 'ON', 'CO')[i % 4],
+                        host=self.hosts[i % len(self.hosts)],
+                        requested_cpu=4 + i % 8,
+                        requested_ram=16 + i % 32,
+                        fileshare_storage=i % 500,
+                        fileshare_derivative=i % 100,
+                        direct_attach_storage=i % 200,
+                        )
+                for i in range(start, stop)
+                ], batch_size=500)
+        pks = Project.objects.filter(dc_prj_id__gte='bm{:05d}'.format(start),
+                                     dc_prj_id__startswith='bm',
+                                     ).values_list('pk', flat=True)
+        user_links = []
+        sw_links = []
+        for n, pk in enumerate(pks):
+            for j in range(users):
+                person = self.people[(n + j) % len(self.people)]
+                user_links.append(Project.users.through(project_id=pk,
+                                                        person_id=person.pk))
+            for j in range(software):
+                sw = self.software[(n + j) % len(self.software)]
+                sw_links.append(Project.software_installed.through(project_id=pk,
+                                                                   software_id=sw.pk))
+        Project.users.through.objects.bulk_create(user_links, batch_size=500)
+        Project.software_installed.through.objects.bulk_create(sw_links, batch_size=500)
@@ -0,0 +1,39 @@
+import csv
+import datetime
+
+from django.core.management.base import BaseCommand, CommandError
+
+from dc_management.billing import billing_rollup, rollup_csv_rows
+
+class Command(BaseCommand):
+    help = 'Writes invoice totals by account, project and month as CSV'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--start', type=str, help='first month, as YYYY-MM')
+        parser.add_argument('--end', type=str, help='last month, as YYYY-MM')
+        parser.add_argument('--account', type=str, help='only this account')
+        parser.add_argument('--output', type=str,
+                            help='file to write (default: standard output)')
+
+    def parse_month(self, value):
+        try:
+            return datetime.datetime.strptime(value, '%Y-%m').date()
+        except ValueError:
+            raise CommandError('Month {} is not in YYYY-MM format'.format(value))
+
+    def handle(self, *args, **options):
+        start = end = None
+        if options['start']:
+            start = self.parse_month(options['start'])
+        if options['end']:
+            # up to the last day of the month
+            end = self.parse_month(options['end'])
+            end = (end + datetime.timedelta(days=31)).replace(day=1
+                                                    ) - datetime.timedelta(days=1)
+
+        rollup = billing_rollup(start, end, options['account'])
+        if options['output']:
+            with open(options['output'], 'w', newline='') as f:
+                csv.writer(f).writerows(rollup_csv_rows(rollup))
+        else:
+            csv.writer(self.stdout).writerows(rollup_csv_rows(rollup))
@@ -1,98 +1,79 @@
+import datetime
+import time
+
 from django.core.management.base import BaseCommand, CommandError
 
 from django.contrib.auth.models import User
+from django.db import transaction
+from django.db.models import Max
 
-from dc_management.models import   (Project, 
-                                    ProjectBillingRecord,
-                                    SoftwareCost,
-                                    UserCost, 
-                                    StorageCost,
-                                    ExtraResourceCost,
-                                    DatabaseCost,
-                                    )
+from dc_management.billing import billing_month, build_invoices, next_month
+from dc_management.models import Project, ProjectBillingRecord
 
 class Command(BaseCommand):
-    help = 'Creates an invoice for all projects'
+    help = ('Creates the monthly invoice of every billable project. Projects '
+            'already invoiced for the month are skipped, so the command can be '
+            'safely re-run.')
 
     def add_arguments(self, parser):
-        parser.add_argument('username', nargs='+', type=str)
+        parser.add_argument('username', type=str,
+                            help='user recorded as the author of the invoices')
+        parser.add_argument('--month', type=str,
+                            help='billing month as YYYY-MM (default: this month)')
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help='invoices inserted per query')
+        parser.add_argument('--dry-run', action='store_true',
+                            help='report the invoices without creating them')
 
     def handle(self, *args, **options):
-        # Try to get the user 
+        # Try to get the user
         try:
-            user = User.object.get(username=options['username'])
+            user = User.objects.get(username=options['username'])
         except User.DoesNotExist:
             raise CommandError('User {} does not exist'.format(options['username']))
-                            
-        # get active projects (full billing)
-        active_projects = Project.objects.filter(status='RU'
-                                        ).exclude(env_type='CL'
-                                        )
-        
-        active_classrooms = Project.objects.filter(status='RU', env_type='CL'
-                                        )
-        
-        # get completed, suspended or onboarding projects (charge storage only)
-        inactive_projects = Project.objects.exclude(status='RU')
-        
-        for p in active_projects:
-            # base charge
-            try: 
-                base_cost = UserCost.object.get(user_quantity=p.users.count()).user_cost
-            except UserCost.DoesNotExist:
-                base_cost = 0
-                self.stdout.write(self.style.ERROR(
-                    "Base rate not found for {} users ({})".format( p.users.count(), 
-                                                                    p,)
-                                                    )
-                )            
-            
-            ### storage costs
-            # primary
-            primary_rate = StorageCost.objects.get(storage_type__icontains='primary'
-                                             ).st_cost_per_gb
-            primary_cost = p.fileshare_storage * primary_rate
-            
-            # versioned backup costs
-            backup_rate = StorageCost.objects.get(storage_type__icontains='backup'
-                                             ).st_cost_per_gb
-            backup_cost = p.direct_attach_storage * backup_rate
-            
-            # direct-attach server storage costs
-            direct_rate = StorageCost.objects.get(storage_type__icontains='direct'
-                                             ).st_cost_per_gb
-            direct_cost = p.backup_storage * direct_rate
-        
-            # software costs
-            sw_total_cost = 0
-            for sw in p.software_installed:
-                cost_item = SoftwareCost.objects.get(software=sw.pk)
-                sw_total_cost += cost_item.software_cost
-            
-            # extra resources
-            extra_cpu = (p.requested_cpu - 4)
-            cpu_cost = ExtraResourceCost.objects.get(extra_cpu==extra_cpu).cpu_cost
-        
-            # databases
-            if p.db:
-                db_cost = DatabaseCost.db_cost
-        
-                # search to find if a db setup cost has been charged yet to project
-                try:
-                    db_setup_invoices = ProjectBillingRecord.objects.get(project=p.pk,
-                                                                db_setup>0
-                    )
-                except ProjectBillingRecord.DoesNotExist:
-                    db_setup = DatabaseCost.db_setup
-                    
-        for poll_id in options['poll_id']:
+
+        if options['month']:
             try:
-                poll = Poll.objects.get(pk=poll_id)
-            except Poll.DoesNotExist:
-                raise CommandError('Poll "%s" does not exist' % poll_id)
+                month = datetime.datetime.strptime(options['month'], '%Y-%m').date()
+            except ValueError:
+                raise CommandError('Month {} is not in YYYY-MM format'.format(
+                                                                options['month']))
+        else:
+            month = billing_month()
+
+        start = time.perf_counter()
+        with transaction.atomic():
+            # projects already billed this month, by an earlier run or by hand,
+            # are not billed again
+            invoiced = ProjectBillingRecord.objects.filter(billing_date__gte=month,
+                                                           billing_date__lt=next_month(month),
+                                                   ).values('project')
+            projects = Project.objects.exclude(pk__in=invoiced).order_by('dc_prj_id')
+            skipped = Project.objects.filter(pk__in=invoiced).count()
 
-            poll.opened = False
-            poll.save()
+            records = build_invoices(projects, month, user)
 
-            self.stdout.write(self.style.SUCCESS('Successfully closed poll "%s"' % poll_id))
+            if not options['dry_run']:
+                last = ProjectBillingRecord.objects.aggregate(last=Max('pk'))['last'] or 0
+                # the invoices of a run overlapping this one are left alone
+                # (one invoice per project and month, see invoice_month)
+                ProjectBillingRecord.objects.bulk_create(
+                                            records,
+                                            batch_size=options['batch_size'],
+                                            ignore_conflicts=True,
+                                            )
+                records = list(ProjectBillingRecord.objects.filter(invoice_month=month,
+                                                                   pk__gt=last))
+            total = sum(r.total + (r.db_setup or 0) for r in records)
 
+        verb = 'Would create' if options['dry_run'] else 'Created'
+        self.stdout.write(self.style.SUCCESS(
+            '{} {} invoices for {:%B %Y} totalling ${:,.2f} ({} already invoiced) '
+            'in {:.2f}s'.format(verb,
+                                len(records),
+                                month,
+                                total,
+                                skipped,
+                                time.perf_counter() - start,
+                                )
+        ))
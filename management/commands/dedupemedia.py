@@ -0,0 +1,67 @@
+import os
+
+from django.core.management.base import BaseCommand
+from django.template.defaultfilters import filesizeformat
+
+from dc_management.blobstore import file_digest
+from dc_management.models import Governance_Doc
+
+class Command(BaseCommand):
+    help = ('Moves governance documents saved before content-addressed storage '
+            'into the blob store, replaces duplicate copies with links to one '
+            'blob, removes blobs no document refers to, and reports the space '
+            'reclaimed')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true',
+                            help='report what would be reclaimed without changing files')
+
+    def handle(self, *args, **options):
+        dry_run = options['dry_run']
+        storage = Governance_Doc._meta.get_field('documentation').storage
+        names = (Governance_Doc.objects.exclude(documentation__isnull=True)
+                                       .exclude(documentation='')
+                                       .order_by('documentation')
+                                       .values_list('documentation', flat=True)
+                                       .distinct())
+
+        scanned = deduplicated = missing = reclaimed = 0
+        # blobs the documents are (or, on a dry run, would be) linked to
+        used = set()
+        for name in names:
+            try:
+                stat = os.stat(storage.path(name))
+            except FileNotFoundError:
+                self.stderr.write('{}: missing'.format(name))
+                missing += 1
+                continue
+            scanned += 1
+            blob = storage.blob_name(file_digest(storage.path(name)))
+            if storage.refers_to(name, blob):
+                used.add(blob)
+                continue
+            if blob in used or storage.exists(blob):
+                deduplicated += 1
+                if stat.st_nlink == 1:
+                    reclaimed += stat.st_size
+                if not dry_run:
+                    storage.relink(name, blob)
+            elif not dry_run:
+                storage.adopt(name, blob)
+            used.add(blob)
+
+        pruned = 0
+        for blob, size in list(storage.unreferenced_blobs()):
+            if blob in used:
+                continue
+            pruned += 1
+            reclaimed += size
+            if not dry_run:
+                storage.delete(blob)
+
+        self.stdout.write(self.style.SUCCESS(
+            '{}{} files scanned ({} missing), {} duplicates linked, {} unreferenced '
+            'blobs removed: {} bytes ({}) reclaimed'.format(
+                'Dry run: ' if dry_run else '', scanned, missing, deduplicated,
+                pruned, reclaimed, filesizeformat(reclaimed))
+        ))
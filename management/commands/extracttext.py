@@ -0,0 +1,35 @@
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from django.core.management.base import BaseCommand
+
+from dc_management.models import DocumentText, Governance_Doc
+from dc_management.textextract import extract_documents
+
+class Command(BaseCommand):
+    help = ('Extracts the text of the governance document files not extracted '
+            'yet (or changed since), for search, and removes the texts no '
+            'document uses any more')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=None,
+                            help='processes parsing files (default: one per CPU)')
+        parser.add_argument('--retry', action='store_true',
+                            help='extract again the files that failed before '
+                                 '(eg after installing pypdf)')
+
+    def handle(self, *args, **options):
+        start = time.perf_counter()
+        if options['retry']:
+            DocumentText.objects.exclude(error='').delete()
+        with ProcessPoolExecutor(options['workers']) as pool:
+            parsed = extract_documents(Governance_Doc.objects.all(), pool)
+        removed, deleted = DocumentText.objects.filter(documents__isnull=True).delete()
+        failed = DocumentText.objects.exclude(error='')
+        for text in failed:
+            self.stderr.write('{}: {}'.format(
+                ', '.join(d.documentation.name for d in text.documents.all()), text.error))
+        self.stdout.write(self.style.SUCCESS(
+            '{} files parsed, {} failed, {} unused texts removed ({:.2f}s)'.format(
+                parsed, failed.count(), removed, time.perf_counter() - start)
+        ))
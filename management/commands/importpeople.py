@@ -0,0 +1,42 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from dc_management.userimport import BATCH_SIZE, INVALID, PersonImport
+
+class Command(BaseCommand):
+    help = ('Creates people from a CSV file, in the format of the bulk user '
+            'upload page, listing the rows that could not be imported')
+
+    def add_arguments(self, parser):
+        parser.add_argument('csv_file')
+        parser.add_argument('--comment', default='',
+                            help="added to every person's comments")
+        parser.add_argument('--update', action='store_true',
+                            help='update the people whose cwid already exists '
+                                 '(default: skip them)')
+        parser.add_argument('--strict', action='store_true',
+                            help='import nothing if any row is invalid')
+        parser.add_argument('--batch-size', type=int, default=BATCH_SIZE)
+
+    def handle(self, *args, **options):
+        start = time.perf_counter()
+        try:
+            csv_file = open(options['csv_file'], 'rb')
+        except OSError as e:
+            raise CommandError(e)
+        with csv_file:
+            result = PersonImport(csv_file, options['comment'], options['update'],
+                                  options['batch_size']).run(options['strict'])
+        for row in result.rows:
+            if row.status == INVALID:
+                self.stderr.write('line {}: {}'.format(row.line, row.message))
+        counts = result.counts()
+        if options['strict'] and counts[INVALID]:
+            raise CommandError('{} invalid rows: nothing imported'.format(counts[INVALID]))
+        self.stdout.write(self.style.SUCCESS(
+            '{created} created, {updated} updated, {exists} skipped, {invalid} invalid '
+            '({seconds:.2f}s)'.format(seconds=time.perf_counter() - start,
+                                      **{status: counts[status] for status in
+                                         ('created', 'updated', 'exists', 'invalid')})
+        ))
@@ -0,0 +1,24 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from dc_management.search import get_backend, rebuild_index
+
+class Command(BaseCommand):
+    help = ('Rewrites the search entries of every project, person, governance '
+            'document, log entry and comment. Signals keep them up to date after that.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help='objects indexed per query')
+
+    def handle(self, *args, **options):
+        start = time.perf_counter()
+        count = rebuild_index(batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(
+            '{} search entries written for {} ({:.2f}s)'.format(
+                                                    count,
+                                                    type(get_backend()).__name__,
+                                                    time.perf_counter() - start,
+                                                    )
+        ))
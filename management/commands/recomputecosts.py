@@ -0,0 +1,36 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from dc_management.costengine import ProjectCosts
+from dc_management.models import Project
+
+class Command(BaseCommand):
+    help = 'Recomputes the cached monthly costs of projects'
+
+    def add_arguments(self, parser):
+        parser.add_argument('dc_prj_id', nargs='*', type=str,
+                            help='projects to recompute (default: all)')
+        parser.add_argument('--dry-run', action='store_true',
+                            help='report how many projects would change')
+
+    def handle(self, *args, **options):
+        projects = Project.objects.all()
+        if options['dc_prj_id']:
+            projects = projects.filter(dc_prj_id__in=options['dc_prj_id'])
+
+        start = time.perf_counter()
+        costs = ProjectCosts(projects)
+        if options['dry_run']:
+            changed = len(costs.changed())
+            verb = 'would be updated'
+        else:
+            changed = costs.save()
+            verb = 'updated'
+        self.stdout.write(self.style.SUCCESS(
+            '{} of {} projects {} ({:.2f}s)'.format(changed,
+                                                    len(costs.projects),
+                                                    verb,
+                                                    time.perf_counter() - start,
+                                                    )
+        ))
@@ -0,0 +1,43 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from dc_management.compliance import ComplianceScan
+from dc_management.models import Project
+
+class Command(BaseCommand):
+    help = ('Rescans the governance compliance of projects (run nightly), and '
+            'lists the running projects with an expired IRB, DUAs none of which '
+            'are current, or users without a current DCUA')
+
+    def add_arguments(self, parser):
+        parser.add_argument('dc_prj_id', nargs='*', type=str,
+                            help='projects to scan (default: all)')
+
+    def handle(self, *args, **options):
+        projects = Project.objects.all()
+        if options['dc_prj_id']:
+            projects = projects.filter(dc_prj_id__in=options['dc_prj_id'])
+
+        start = time.perf_counter()
+        scan = ComplianceScan(projects)
+        scanned = scan.save()
+
+        running = {p.pk: p.dc_prj_id for p in projects.filter(status='RU')}
+        for status in sorted(scan.statuses, key=lambda s: running.get(s.project_id, '')):
+            if status.project_id not in running:
+                continue
+            problems = []
+            if not status.irb_valid:
+                problems.append('no current IRB')
+            if status.dua_invalid():
+                problems.append('no current DUA')
+            if status.users_without_dcua:
+                problems.append('{} users without a current DCUA'.format(
+                                                    status.users_without_dcua))
+            if problems:
+                self.stdout.write('{}: {}'.format(running[status.project_id],
+                                                  ', '.join(problems)))
+        self.stdout.write(self.style.SUCCESS(
+            '{} projects scanned ({:.2f}s)'.format(scanned, time.perf_counter() - start)
+        ))
@@ -0,0 +1,46 @@
+import time
+from collections import Counter
+
+from django.core.management.base import BaseCommand, CommandError
+
+from dc_management.models import OutboxMessage
+from dc_management.outbox import BATCH_SIZE, WORKERS, Dispatcher, outbox_enabled
+
+class Command(BaseCommand):
+    help = ('Sends the queued operations emails that are due (run every few '
+            'minutes, or with --loop), retrying failed ones with backoff')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=WORKERS,
+                            help='messages sent at once')
+        parser.add_argument('--limit', type=int, default=BATCH_SIZE,
+                            help='messages sent per dispatch')
+        parser.add_argument('--loop', type=float, default=0, metavar='SECONDS',
+                            help='keep dispatching, waiting SECONDS when nothing is due')
+
+    def handle(self, *args, **options):
+        if not outbox_enabled():
+            raise CommandError('settings.DC_OUTBOX_SENDER is not set')
+        dispatcher = Dispatcher(workers=options['workers'])
+        while True:
+            start = time.perf_counter()
+            messages = dispatcher.dispatch(options['limit'])
+            if messages:
+                counts = Counter(m.status for m in messages)
+                for m in messages:
+                    if m.status != OutboxMessage.DELIVERED:
+                        self.stderr.write('{} ({} attempts): {}'.format(m, m.attempts,
+                                                                         m.last_error))
+                self.stdout.write(self.style.SUCCESS(
+                    '{} sent, {} to retry, {} failed ({:.2f}s)'.format(
+                        counts[OutboxMessage.DELIVERED], counts[OutboxMessage.PENDING],
+                        counts[OutboxMessage.FAILED], time.perf_counter() - start)
+                ))
+                if options['verbosity'] > 1:
+                    for name, timing in sorted(dispatcher.client.stats().items()):
+                        self.stdout.write('{}: {calls} calls, {seconds:.2f}s, '
+                                          '{average:.3f}s on average'.format(name, **timing))
+            if not options['loop']:
+                break
+            if len(messages) < options['limit']:
+                time.sleep(options['loop'])
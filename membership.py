@@ -0,0 +1,89 @@
+"""
+Adding people to and removing them from projects in bulk.
+
+add_users() and remove_users() read the current memberships of every
+project and person with one query, change each project's users with a
+single add() or remove(), and bulk_create the Access_Log entries (and
+DataCoreUserAgreements), all in one transaction. The m2m signals fire once
+per project, so costs, compliance and the dashboard follow the change.
+"""
+from datetime import date, timedelta
+
+from django.db import transaction
+
+from .models import Access_Log, DataCoreUserAgreement, Project
+
+# days a DataCoreUserAgreement created for a new user runs
+DCUA_DAYS = 365
+
+
+def memberships(projects, people):
+    """
+    (project pk, person pk) of the people who are users of the projects
+    """
+    return set(Project.users.through.objects.filter(
+                            project__in=[p.pk for p in projects],
+                            person__in=[p.pk for p in people],
+                            ).values_list('project_id', 'person_id'))
+
+def add_users(projects, people, author, locations_allowed='', today=None):
+    """
+    Make the people users of each project, logging the change and creating a
+    DataCoreUserAgreement for them to sign. Returns {project: [people added]},
+    leaving out the people already on a project.
+    """
+    today = today or date.today()
+    with transaction.atomic():
+        current = memberships(projects, people)
+        added = {prj: [p for p in people if (prj.pk, p.pk) not in current]
+                 for prj in projects}
+        logs = []
+        dcuas = []
+        for prj, new_users in added.items():
+            if not new_users:
+                continue
+            prj.users.add(*new_users)
+            for person in new_users:
+                logs.append(Access_Log(record_author=author,
+                                       date_changed=today,
+                                       dc_user=person,
+                                       prj_affected=prj,
+                                       change_type=Access_Log.ADD_ACCESS,
+                                       ))
+                dcuas.append(DataCoreUserAgreement(record_author=author,
+                                                   attestee=person,
+                                                   project=prj,
+                                                   start_date=today,
+                                                   end_date=today + timedelta(days=DCUA_DAYS),
+                                                   locations_allowed=locations_allowed,
+                                                   ))
+        # the logs have no ticket yet, so nothing for search to index
+        Access_Log.objects.bulk_create(logs)
+        DataCoreUserAgreement.objects.bulk_create(dcuas)
+    return added
+
+def remove_users(projects, people, author, today=None):
+    """
+    Remove the people from the users of each project, logging the change.
+    Returns {project: [people removed]}, leaving out the people not on a
+    project.
+    """
+    today = today or date.today()
+    with transaction.atomic():
+        current = memberships(projects, people)
+        removed = {prj: [p for p in people if (prj.pk, p.pk) in current]
+                   for prj in projects}
+        logs = []
+        for prj, old_users in removed.items():
+            if not old_users:
+                continue
+            prj.users.remove(*old_users)
+            logs.extend(Access_Log(record_author=author,
+                                   date_changed=today,
+                                   dc_user=person,
+                                   prj_affected=prj,
+                                   change_type=Access_Log.REMOVE_ACCESS,
+                                   )
+                        for person in old_users)
+        Access_Log.objects.bulk_create(logs)
+    return removed
@@ -0,0 +1,48 @@
+# Generated by Django 3.2 on 2026-10-18 09:00
+
+from django.db import migrations, models
+
+
+EXPENSE_FIELDS = ('base_expense',
+                  'storage_1_expense',
+                  'storage_2_expense',
+                  'storage_3_expense',
+                  'storage_4_expense',
+                  'sw_expense',
+                  'hosting_expense',
+                  'db_expense',
+                  )
+
+def store_totals(apps, schema_editor):
+    # same sum as ProjectBillingRecord.monthly_total, which is not available on
+    # the historical model
+    ProjectBillingRecord = apps.get_model('dc_management', 'ProjectBillingRecord')
+    batch = []
+    for record in ProjectBillingRecord.objects.only('pk', 'multiplier', *EXPENSE_FIELDS
+                                        ).iterator():
+        total = sum(getattr(record, f) for f in EXPENSE_FIELDS
+                    if getattr(record, f) is not None)
+        if record.multiplier:
+            total = total * record.multiplier
+        record.total = total
+        batch.append(record)
+        if len(batch) == 500:
+            ProjectBillingRecord.objects.bulk_update(batch, ['total'])
+            batch = []
+    ProjectBillingRecord.objects.bulk_update(batch, ['total'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dc_management', '0074_project_servers'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='projectbillingrecord',
+            name='total',
+            field=models.FloatField(blank=True, editable=False, null=True),
+        ),
+        migrations.RunPython(store_totals, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,77 @@
+# Generated by Django 3.2 on 2026-10-18 11:00
+
+from django.db import DatabaseError, migrations, models, transaction
+
+
+# the full-text index of SearchEntry.text, as search.py expects it when the
+# migration was written (kept here so later changes to search.py do not change
+# what this migration does)
+FTS_TABLE = 'dc_management_searchentry_fts'
+FTS_SQL = (
+    "CREATE VIRTUAL TABLE IF NOT EXISTS {fts} USING fts5(text, "
+    "content='dc_management_searchentry', content_rowid='id')",
+    "CREATE TRIGGER IF NOT EXISTS {fts}_ai AFTER INSERT ON dc_management_searchentry "
+    "BEGIN INSERT INTO {fts}(rowid, text) VALUES (new.id, new.text); END",
+    "CREATE TRIGGER IF NOT EXISTS {fts}_ad AFTER DELETE ON dc_management_searchentry "
+    "BEGIN INSERT INTO {fts}({fts}, rowid, text) VALUES ('delete', old.id, old.text); END",
+    "CREATE TRIGGER IF NOT EXISTS {fts}_au AFTER UPDATE ON dc_management_searchentry "
+    "BEGIN INSERT INTO {fts}({fts}, rowid, text) VALUES ('delete', old.id, old.text); "
+    "INSERT INTO {fts}(rowid, text) VALUES (new.id, new.text); END",
+    "INSERT INTO {fts}({fts}) VALUES ('rebuild')",
+)
+TSVECTOR_INDEX = 'dc_management_searchentry_tsv'
+
+
+def install_index(apps, schema_editor):
+    conn = schema_editor.connection
+    with conn.cursor() as cursor:
+        if conn.vendor == 'postgresql':
+            cursor.execute(
+                "CREATE INDEX IF NOT EXISTS {} ON dc_management_searchentry "
+                "USING GIN (to_tsvector('simple', text))".format(TSVECTOR_INDEX))
+        elif conn.vendor == 'sqlite':
+            try:
+                with transaction.atomic(using=conn.alias):
+                    for sql in FTS_SQL:
+                        cursor.execute(sql.format(fts=FTS_TABLE))
+            except DatabaseError:
+                # SQLite built without FTS5: searches use PythonBackend
+                pass
+
+def uninstall_index(apps, schema_editor):
+    conn = schema_editor.connection
+    with conn.cursor() as cursor:
+        if conn.vendor == 'postgresql':
+            cursor.execute("DROP INDEX IF EXISTS {}".format(TSVECTOR_INDEX))
+        elif conn.vendor == 'sqlite':
+            for trigger in ('ai', 'ad', 'au'):
+                cursor.execute("DROP TRIGGER IF EXISTS {}_{}".format(FTS_TABLE, trigger))
+            cursor.execute("DROP TABLE IF EXISTS {}".format(FTS_TABLE))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dc_management', '0075_projectbillingrecord_total'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SearchEntry',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(max_length=16)),
+                ('object_id', models.IntegerField()),
+                ('field', models.CharField(max_length=32)),
+                ('weight', models.FloatField()),
+                ('text', models.TextField()),
+            ],
+            options={
+                'verbose_name': 'Search Entry',
+                'verbose_name_plural': 'Search Entries',
+                'unique_together': {('kind', 'object_id', 'field')},
+            },
+        ),
+        # the entries are filled by `manage.py rebuildsearchindex`
+        migrations.RunPython(install_index, uninstall_index),
+    ]
@@ -0,0 +1,52 @@
+# Generated by Django 3.2 on 2026-10-18 14:00
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('persons', '0001_initial'),
+        ('dc_management', '0076_searchentry'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ComplianceStatus',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('checked_on', models.DateField()),
+                ('irb_valid', models.BooleanField()),
+                ('has_dua', models.BooleanField()),
+                ('dua_valid', models.BooleanField()),
+                ('documented', models.BooleanField()),
+                ('users_without_dcua', models.IntegerField()),
+                ('project', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='compliance', to='dc_management.project')),
+            ],
+            options={
+                'verbose_name': 'Compliance Status',
+                'verbose_name_plural': 'Compliance Statuses',
+            },
+        ),
+        migrations.CreateModel(
+            name='UserComplianceStatus',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('on_project', models.BooleanField()),
+                ('irb', models.BooleanField()),
+                ('dua', models.BooleanField()),
+                ('dcua', models.BooleanField()),
+                ('dcua_current', models.BooleanField()),
+                ('validated', models.BooleanField()),
+                ('person', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='persons.person')),
+                ('project', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='user_compliance', to='dc_management.project')),
+            ],
+            options={
+                'verbose_name': 'User Compliance Status',
+                'verbose_name_plural': 'User Compliance Statuses',
+                'unique_together': {('project', 'person')},
+            },
+        ),
+        # the statuses are filled by `manage.py scancompliance`
+    ]
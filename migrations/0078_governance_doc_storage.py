@@ -0,0 +1,20 @@
+# Generated by Django 3.2 on 2026-10-18 15:00
+
+import dc_management.blobstore
+import dc_management.models
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dc_management', '0077_compliancestatus'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='governance_doc',
+            name='documentation',
+            field=models.FileField(blank=True, null=True, storage=dc_management.blobstore.ContentAddressedStorage(), upload_to=dc_management.models.project_directory_path),
+        ),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 3.2 on 2026-10-18 16:00
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dc_management', '0078_governance_doc_storage'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DocumentText',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('digest', models.CharField(max_length=64, unique=True)),
+                ('text', models.TextField(blank=True)),
+                ('extracted_on', models.DateTimeField(auto_now=True)),
+                ('error', models.CharField(blank=True, max_length=255)),
+            ],
+            options={
+                'verbose_name': 'Document Text',
+                'verbose_name_plural': 'Document Texts',
+            },
+        ),
+        migrations.AddField(
+            model_name='governance_doc',
+            name='document_text',
+            field=models.ForeignKey(blank=True, editable=False, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='documents', to='dc_management.documenttext'),
+        ),
+        # the texts are extracted by `manage.py extracttext`
+    ]
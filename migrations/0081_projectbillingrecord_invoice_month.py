@@ -0,0 +1,22 @@
+# Generated by Django 3.2 on 2026-10-18 18:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dc_management', '0080_outboxmessage'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='projectbillingrecord',
+            name='invoice_month',
+            field=models.DateField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddConstraint(
+            model_name='projectbillingrecord',
+            constraint=models.UniqueConstraint(fields=('project', 'invoice_month'), name='dc_one_invoice_per_month'),
+        ),
+    ]
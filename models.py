@@ -3,16 +3,18 @@ from django.db import models
 
 from django.contrib.auth.models import User
 from django.utils import timezone
-from django.db.models import Q
+from django.db.models import Q, Sum, Count, OuterRef, Subquery, Exists, Case, When, Value
+from django.db.models.functions import Coalesce
 
 import datetime
 from datetime import date
 
-import numpy as np
 
 from persons.models import Person, Department, Organization, Role 
 from datacatalog.models import Dataset, DataUseAgreement, DataAccess
 
+from .blobstore import ContentAddressedStorage
+
 ############################
 ####  Comment Models    ####
 ############################
@@ -103,6 +105,25 @@ class Software_License_Type(models.Model):
         verbose_name = 'Software License Type'
         verbose_name_plural = 'Software License Types'
 
+class SoftwareQuerySet(models.QuerySet):
+    def with_usage(self):
+        """
+        Annotate each software with the counts shown on the software pages:
+        seat_count  - users summed over every project (not completed) it is installed on
+        user_count  - distinct users of running or onboarding projects with it installed
+        project_count - projects it is installed on
+        """
+        return self.annotate(
+                    seat_count=Count('software_installed__users',
+                                     filter=~Q(software_installed__status='CO'),
+                                     ),
+                    user_count=Count('software_installed__users',
+                                     filter=Q(software_installed__status__in=['RU', 'ON']),
+                                     distinct=True,
+                                     ),
+                    project_count=Count('software_installed', distinct=True),
+        )
+
 class Software(models.Model):
     """
     This model defines software packages or applications.  
@@ -141,11 +162,18 @@ class Software(models.Model):
         return sw_users
 
     def seatcount(self):
-        sw_prjs = Project.objects.filter(software_installed=self.pk
-                                        ).exclude(status="CO")    
-        usercount = [ prj.users.count() for prj in sw_prjs ]
-        return sum(usercount)
-
+        """
+        number of users summed over all projects (not completed) with this software.
+        Uses the with_usage() annotation when present.
+        """
+        if hasattr(self, 'seat_count'):
+            return self.seat_count
+        return Project.users.through.objects.filter(
+                                        project__software_installed=self.pk
+                                        ).exclude(project__status="CO"
+                                        ).count()
+
+    objects = SoftwareQuerySet.as_manager()
         
     class Meta:
         verbose_name = 'Software'
@@ -355,44 +383,36 @@ class Server(models.Model):
     def __str__(self):
             return self.node
 
+    def node_user_index(self):
+        """
+        return the NodeUserIndex serving this node. Views attach a fleet-wide
+        index to their servers; otherwise a single-node index is built once.
+        """
+        from .nodeindex import NodeUserIndex
+
+        index = getattr(self, '_node_user_index', None)
+        if index is None:
+            index = NodeUserIndex(server_pks=[self.pk])
+            self._node_user_index = index
+        return index
+
     def get_all_active_users(self):
         """
-        pull all users from all projects. Return users/projects when a user
-        is present in more than one project on the node
+        pull all users from all running, suspended or onboarding projects.
+        Return a dict of user: [projects]
         """
-        mounted_projects = Project.objects.filter(host=self.pk
-                                                ).filter(
-                                                    Q(status='RU') |
-                                                    Q(status='SU') |
-                                                    Q(status='ON')
-                                                )
-        user_projects = {}
-        for p in mounted_projects:
-            for u in p.users.all():
-                if u in user_projects:
-                    user_projects[u].append(p)
-                else:
-                    user_projects[u] = [p]
-        return user_projects
-    
-    def duplicate_users(self):    
+        if not hasattr(self, '_active_users'):
+            self._active_users = self.node_user_index().active_users(self.pk)
+        return self._active_users
+
+    def duplicate_users(self):
         """
         return only those users/projects where there are more than one project,
         and the user is not data core staff
         """
-        user_projects = self.get_all_active_users()
-        duplicate_user_dict = {}
-        for u in user_projects:
-            if (len(user_projects[u]) > 1):
-                if u.role:
-                    if u.role.name[:9] == 'Data Core':
-                        continue
-                    else:
-                        duplicate_user_dict[u] = user_projects[u]
-                else:
-                    duplicate_user_dict[u] = user_projects[u]
-                
-        return duplicate_user_dict
+        if not hasattr(self, '_duplicate_users'):
+            self._duplicate_users = self.node_user_index().duplicates(self.pk)
+        return self._duplicate_users
         
     def get_absolute_url(self):
         return reverse('dc_management:node', kwargs={'pk': self.pk})
@@ -456,6 +476,23 @@ class Storage(models.Model):
         return reverse('dc_management:storage', kwargs={'pk': self.pk})
 
 
+class ProjectQuerySet(models.QuerySet):
+    def with_user_counts(self):
+        """
+        Annotate each project with user_num (all users) and billable_user_num
+        (users who are not data core staff, as in Project.billable_users).
+        """
+        billable = Project.users.through.objects.filter(project=OuterRef('pk')
+                                ).exclude(person__role__name__icontains='data core'
+                                ).order_by(
+                                ).values('project'
+                                ).annotate(n=Count('pk')
+                                ).values('n')
+        return self.annotate(
+                    user_num=Count('users', distinct=True),
+                    billable_user_num=Coalesce(Subquery(billable), 0),
+        )
+
 class Project(models.Model):
     # date the record was created
     record_creation = models.DateField(auto_now_add=True)
@@ -685,6 +722,8 @@ class Project(models.Model):
                                               related_name='project_comments'
                                               )
     
+    objects = ProjectQuerySet.as_manager()
+    
     def __str__(self):
             return "{} ({})".format(self.dc_prj_id, self.nickname)
     
@@ -703,24 +742,77 @@ class Project(models.Model):
                             ).exclude(role__name__icontains='data core'
                             )
     
-    def valid_nodes(self):
+    def billable_user_count(self):
+        """
+        number of billable users. Uses the with_user_counts() annotation when present.
+        """
+        if hasattr(self, 'billable_user_num'):
+            return self.billable_user_num
+        return self.billable_users().count()
+    
+    def user_count(self):
+        """
+        number of users. Uses the with_user_counts() annotation when present.
+        """
+        if hasattr(self, 'user_num'):
+            return self.user_num
+        return self.users.count()
+    
+    def valid_nodes(self, rank=False):
         """
         Find all nodes for which there are no users in common.
-        for performance, this should be called explicitly, not every time the project 
-        view is loaded.
+
+        Node users come from a NodeUserIndex (shared with the rest of the request if
+        a view has attached one), so the answer costs a fixed number of queries
+        however many nodes there are. Each node is annotated with its free
+        CPU/RAM/direct attach headroom; with rank=True the nodes with the most
+        headroom come first. Results are memoized on the instance, so templates
+        can call this freely.
         """
-        node_pool = Server.objects.filter(status="ON", function="PR")
+        from .nodeindex import ACTIVE_STATUSES, NodeUserIndex
+
+        if not hasattr(self, '_valid_nodes'):
+            self._valid_nodes = {}
+        if rank in self._valid_nodes:
+            return self._valid_nodes[rank]
+
+        index = getattr(self, '_node_user_index', None)
+        if index is None:
+            index = NodeUserIndex()
+            self._node_user_index = index
+
         # get set of pks for all users in this project
         # this could be changed to potential users later!
-        this_prj = set(self.users.values_list('id', flat=True))
+        this_prj = {u.pk for u in self.users.all()}
+
+        active = Q(project__status__in=ACTIVE_STATUSES)
+        node_pool = Server.objects.filter(status="ON", function="PR"
+                                ).annotate(
+                                    used_cpu=Sum('project__requested_cpu',
+                                                 filter=active),
+                                    used_ram=Sum('project__requested_ram',
+                                                 filter=active),
+                                    used_storage=Sum('project__direct_attach_storage',
+                                                     filter=active),
+                                    project_count=Count('project'),
+                                ).order_by('node')
 
         valid_node_list = []
-        for node in node_pool:
-            node_users = node.get_all_active_users()  # running, suspended, or onboarding
-            that_node = set([u.pk  for u in list(node_users.keys())])
-            if len(this_prj.intersection(that_node)) == 0:
+        for node in index.attach(node_pool):
+            node_users = index.user_pks(node.pk)  # running, suspended, or onboarding
+            if this_prj.isdisjoint(node_users):
+                node.active_user_count = len(node_users)
+                node.free_cpu = node.processor_num - (node.used_cpu or 0)
+                node.free_ram = node.ram - (node.used_ram or 0)
+                node.free_storage = node.other_storage - (node.used_storage or 0)
                 valid_node_list.append(node)
 
+        if rank:
+            valid_node_list.sort(key=lambda n: (n.free_cpu, n.free_ram, n.free_storage),
+                                 reverse=True,
+                                 )
+
+        self._valid_nodes[rank] = valid_node_list
         return valid_node_list
     	    
 class AccessPermission(models.Model):
@@ -738,6 +830,31 @@ def project_directory_path(instance, filename):
 #### Governance Models  ####
 ############################
 
+class GovernanceDocQuerySet(models.QuerySet):
+    def with_attention(self, today=None):
+        """
+        Annotate each document with `superseded` (another document supersedes
+        it) and its `attention` level, as in Governance_Doc.attention_required,
+        worked out in the same query.
+        """
+        today = today or datetime.date.today()
+        successors = Governance_Doc.objects.filter(supersedes_doc=OuterRef('pk'))
+        return self.annotate(superseded=Exists(successors)
+                  ).annotate(attention=Case(
+                        # no expiry date: nothing to renew
+                        When(expiry_date__isnull=True, then=Value('safe')),
+                        When(expiry_date__gt=today + datetime.timedelta(days=90),
+                             then=Value('safe')),
+                        When(governance_type='DC', then=Value('safe')),
+                        When(defers_to_doc__isnull=False, then=Value('safe')),
+                        When(superseded=True, then=Value('safe')),
+                        When(expiry_date__lte=today, then=Value('danger')),
+                        When(expiry_date__lte=today + datetime.timedelta(days=10),
+                             then=Value('warning')),
+                        default=Value('primary'),
+                        output_field=models.CharField(),
+                  ))
+
 class Governance_Doc(models.Model):
     """
     This class is the original holder of governance document meta data. This class will be replaced with the
@@ -790,6 +907,7 @@ class Governance_Doc(models.Model):
     
     documentation = models.FileField(
                             upload_to=project_directory_path, 
+                            storage=ContentAddressedStorage(),
                             null=True,
                             blank=True,
     )
@@ -800,6 +918,16 @@ class Governance_Doc(models.Model):
                                               related_name='govdoc_comments'
                                               )
     isolate_data = models.BooleanField(null=True)
+    # text extracted from the documentation file (see textextract.py)
+    document_text = models.ForeignKey('DocumentText',
+                                      on_delete=models.SET_NULL,
+                                      null=True,
+                                      blank=True,
+                                      editable=False,
+                                      related_name='documents',
+                                      )
+
+    objects = GovernanceDocQuerySet.as_manager()
 
     def __str__(self):
             return "{4}_{0}_{2}_{1}_{3}".format(self.governance_type, 
@@ -812,9 +940,27 @@ class Governance_Doc(models.Model):
     def allowed_user_string(self):
         return  ", ".join([u.cwid for u in self.users_permitted.all()])
 
+    def is_superseded(self):
+        """
+        True if another document supersedes this one. Annotated by
+        with_attention(), otherwise looked up once.
+        """
+        if not hasattr(self, 'superseded'):
+            self.superseded = len(self.superseded_by.all()) > 0
+        return self.superseded
+
     def attention_required(self):
+        """
+        safe, primary, warning or danger. Annotated by with_attention(),
+        otherwise worked out once.
+        """
+        if hasattr(self, 'attention'):
+            return self.attention
+        if self.expiry_date is None:
+            # no expiry date: nothing to renew
+            self.attention = "safe"
+            return self.attention
         td = self.expiry_date - datetime.date.today() 
-        #print(self, len(Governance_Doc.objects.filter(supersedes_doc=self)))
         if td.days >  90:
             status = "safe"
         
@@ -823,9 +969,9 @@ class Governance_Doc(models.Model):
             status = "safe"
         
         # if doc defers to another doc, then we need not pay attention to this one:
-        elif self.defers_to_doc:
+        elif self.defers_to_doc_id:
             status = "safe"
-        elif len(Governance_Doc.objects.filter(supersedes_doc=self)) > 0:
+        elif self.is_superseded():
             status = "safe"
         
         # if not deferring, not DCUA:
@@ -833,10 +979,9 @@ class Governance_Doc(models.Model):
             status = "danger"
         elif td.days <= 10:
             status = "warning"
-        elif td.days <= 90:
-            status = "primary"
         else:
-            status = "danger"
+            status = "primary"
+        self.attention = status
         return status
     
     def get_absolute_url(self):
@@ -847,6 +992,25 @@ class Governance_Doc(models.Model):
         verbose_name = 'Governance Document'
         verbose_name_plural = 'Governance Documents'
 
+class DocumentText(models.Model):
+    """
+    The text extracted from the content of a governance document file, shared
+    by every document uploaded with that content
+    """
+    # sha256 of the file content
+    digest = models.CharField(max_length=64, unique=True)
+    text = models.TextField(blank=True)
+    extracted_on = models.DateTimeField(auto_now=True)
+    # why no text could be extracted, if so
+    error = models.CharField(max_length=255, blank=True)
+
+    def __str__(self):
+        return self.digest
+
+    class Meta:
+        verbose_name = 'Document Text'
+        verbose_name_plural = 'Document Texts'
+
 class AnnualProjectAttestation(models.Model):
     """
     A class to capture a yearly acknowledgement from the PI that the users listed on 
@@ -1259,23 +1423,33 @@ class ProjectBillingRecord(models.Model):
                                       related_name='billing_comments'
                                       )
     
+    # total of all billable fields (see monthly_total), stored on save so that
+    # totals can be summed in the database
+    total = models.FloatField(null=True, blank=True, editable=False)
+    
+    # month (its first day) of the monthly invoice this record is, set by
+    # createinvoices only: a project has one invoice per month, even if two
+    # runs overlap. Bills entered by hand leave it empty.
+    invoice_month = models.DateField(null=True, blank=True, editable=False)
+    
+    class Meta:
+        constraints = [models.UniqueConstraint(fields=['project', 'invoice_month'],
+                                               name='dc_one_invoice_per_month')]
+    
     def monthly_total(self):
         """
         This function returns the total of all billable fields for instance.
         """
-        # convert values to array:
-        x = np.array([self.base_expense,
-                      self.storage_1_expense,
-                      self.storage_2_expense, 
-                      self.storage_3_expense,
-                      self.storage_4_expense,
-                      self.sw_expense,
-                      self.hosting_expense,
-                      self.db_expense,
-        ])
-        
-        # remove NaN values and get sum:
-        total = x[x != np.array(None)].sum()
+        # sum the values that are present:
+        total = sum(x for x in (self.base_expense,
+                                self.storage_1_expense,
+                                self.storage_2_expense, 
+                                self.storage_3_expense,
+                                self.storage_4_expense,
+                                self.sw_expense,
+                                self.hosting_expense,
+                                self.db_expense,
+                                ) if x is not None)
         
         # modify if multiplier is present:
         if self.multiplier:
@@ -1283,6 +1457,10 @@ class ProjectBillingRecord(models.Model):
             
         return total
     
+    def save(self, *args, **kwargs):
+        self.total = self.monthly_total()
+        super(ProjectBillingRecord, self).save(*args, **kwargs)
+    
     def get_absolute_url(self): 
         return reverse('dc_management:project', kwargs={'pk': self.project.pk})
         
@@ -1816,6 +1994,148 @@ class MigrationLog(models.Model):
     def get_absolute_url(self):
         return reverse('dc_management:project', kwargs={'pk': self.project.pk})
 
+############################
+####   Search Models    ####
+############################
+
+class SearchEntry(models.Model):
+    """
+    The text of one searchable field of a project, person, governance
+    document, log entry or comment, kept up to date by signals (see
+    search.py).
+    """
+    # search source the object belongs to (eg 'project')
+    kind = models.CharField(max_length=16)
+    object_id = models.IntegerField()
+    field = models.CharField(max_length=32)
+    # rank given to objects matching in this field
+    weight = models.FloatField()
+    text = models.TextField()
+
+    def __str__(self):
+        return "{} {} {}".format(self.kind, self.object_id, self.field)
+
+    class Meta:
+        unique_together = ('kind', 'object_id', 'field')
+        verbose_name = 'Search Entry'
+        verbose_name_plural = 'Search Entries'
+
+############################
+#### Compliance Models  ####
+############################
+
+class ComplianceStatus(models.Model):
+    """
+    The governance compliance of a project as of `checked_on`, materialized
+    by compliance.ComplianceScan: nightly for every project by `manage.py
+    scancompliance`, and for a project when its documents or users change.
+    """
+    project = models.OneToOneField(Project,
+                                   on_delete=models.CASCADE,
+                                   related_name='compliance',
+                                   )
+    checked_on = models.DateField()
+    # a current IRB, or an IRB exemption
+    irb_valid = models.BooleanField()
+    has_dua = models.BooleanField()
+    # at least one current DUA
+    dua_valid = models.BooleanField()
+    # any governance document at all
+    documented = models.BooleanField()
+    # users of the project not named on a current DCUA of it
+    users_without_dcua = models.IntegerField()
+
+    def dua_invalid(self):
+        return self.has_dua and not self.dua_valid
+
+    def __str__(self):
+        return "{} {}".format(self.project_id, self.checked_on)
+
+    class Meta:
+        verbose_name = 'Compliance Status'
+        verbose_name_plural = 'Compliance Statuses'
+
+class UserComplianceStatus(models.Model):
+    """
+    The governance documents a person is named on for a project, for every
+    user of the project and everyone named on its IRBs, DUAs and DCUAs.
+    Materialized with the project's ComplianceStatus.
+    """
+    project = models.ForeignKey(Project,
+                                on_delete=models.CASCADE,
+                                related_name='user_compliance',
+                                )
+    person = models.ForeignKey(Person, on_delete=models.CASCADE)
+    # a user of the project
+    on_project = models.BooleanField()
+    # named on an IRB, DUA or DCUA of the project
+    irb = models.BooleanField()
+    dua = models.BooleanField()
+    dcua = models.BooleanField()
+    # named on a DCUA that has not expired
+    dcua_current = models.BooleanField()
+    # named on every type of document the project's current documents require
+    validated = models.BooleanField()
+
+    def __str__(self):
+        return "{} {}".format(self.project_id, self.person_id)
+
+    class Meta:
+        unique_together = ('project', 'person')
+        verbose_name = 'User Compliance Status'
+        verbose_name_plural = 'User Compliance Statuses'
+
+########################
+#### Outbox Models  ####
+########################
+
+class OutboxMessage(models.Model):
+    """
+    An operations email (eg a ServiceNow ticket request) waiting to be sent,
+    or sent, by `manage.py sendoutbox` (see outbox.py)
+    """
+    PENDING = 'PE'
+    SENDING = 'SE'
+    DELIVERED = 'DE'
+    FAILED = 'FA'
+    STATUS_CHOICES = (
+                    (PENDING, "Pending"),
+                    (SENDING, "Sending"),
+                    (DELIVERED, "Delivered"),
+                    (FAILED, "Failed"),
+    )
+    created = models.DateTimeField(auto_now_add=True)
+    # the user whose change the email requests
+    record_author = models.ForeignKey(User,
+                                      on_delete=models.SET_NULL,
+                                      null=True,
+                                      blank=True,
+                                      )
+    to_email = models.CharField(max_length=254)
+    subject = models.TextField()
+    body = models.TextField()
+    status = models.CharField(max_length=2,
+                              choices=STATUS_CHOICES,
+                              default=PENDING,
+                              )
+    attempts = models.IntegerField(default=0)
+    # when to (re)try sending; while SENDING, when a dispatcher that died
+    # is given up on
+    next_attempt = models.DateTimeField(default=timezone.now)
+    # the dispatcher run sending it
+    claimed_by = models.CharField(max_length=32, blank=True)
+    sent_on = models.DateTimeField(null=True, blank=True)
+    last_error = models.TextField(blank=True)
+
+    def __str__(self):
+        return "{} {}".format(self.pk, self.subject)
+
+    class Meta:
+        indexes = [models.Index(fields=['status', 'next_attempt'],
+                                name='dc_outbox_due_idx')]
+        verbose_name = 'Outbox Message'
+        verbose_name_plural = 'Outbox Messages'
+
 ## end ##
 #########
 
@@ -0,0 +1,194 @@
+"""
+In-memory prefix index of people's names, for the user autocompletes.
+
+A NameIndex keeps the words of each row's identifier (cwid or username) and
+names in one sorted list, so the rows with a word starting with a typed
+prefix are found by bisection without touching the database. Only the best
+RESULT_LIMIT matches are returned, an exact identifier first.
+
+Each process keeps its own index. Saving or deleting a row (see signals.py)
+bumps a version number in the cache and records the row's pk under that
+version; an index behind the current version re-reads just the recorded
+rows, and reloads the whole table only when it has never been loaded or has
+fallen too far behind. With a per-process cache the version expires after
+caching.LOCAL_TIMEOUT seconds, so changes made by other processes are picked
+up by a reload.
+"""
+import bisect
+import heapq
+import random
+import threading
+
+from django.contrib.auth.models import User
+from django.core.cache import cache
+
+from persons.models import Person
+
+from . import caching
+from .search import words
+
+# matches returned for a query
+RESULT_LIMIT = 50
+
+# changes an index catches up on one at a time before reloading instead
+MAX_REPLAY = 200
+
+# seconds the pk changed at each version is kept
+CHANGE_TIMEOUT = 24 * 60 * 60
+
+
+class NameIndex:
+    """
+    Prefix index of the `fields` of a model: the identifier field, then the
+    first and last name fields. Matches are ordered exact identifier first,
+    then by last and first name.
+    """
+    def __init__(self, name, model, fields):
+        self.model = model
+        self.fields = fields
+        self.version_key = 'dc_management:nameindex:{}'.format(name)
+        self.change_key = 'dc_management:nameindex:{}:{{}}'.format(name)
+        self._lock = threading.Lock()
+        self._version = None
+        # (sorted (word, pk) of every word of every row,
+        #  {pk: lower case (identifier, first name, last name)}), replaced
+        # as a whole by refresh() so lookups read a consistent pair without
+        # the lock
+        self._index = ([], {})
+
+    #### Maintenance ####
+
+    def changed(self, pk):
+        """
+        Record that row pk was saved or deleted
+        """
+        try:
+            version = cache.incr(self.version_key)
+        except ValueError:
+            # no version in the cache: start from a number no index is at
+            version = random.getrandbits(48)
+            cache.set(self.version_key, version, caching.timeout())
+        cache.set(self.change_key.format(version), pk, CHANGE_TIMEOUT)
+
+    def changed_many(self, pks):
+        """
+        Record that the rows were saved or deleted in bulk
+        """
+        if len(pks) > MAX_REPLAY:
+            # more than an index would replay: have every index reload
+            cache.set(self.version_key, random.getrandbits(48), caching.timeout())
+        else:
+            for pk in pks:
+                self.changed(pk)
+
+    def current_version(self):
+        version = cache.get(self.version_key)
+        if version is None:
+            cache.add(self.version_key, random.getrandbits(48), caching.timeout())
+            version = cache.get(self.version_key)
+        return version
+
+    def _changes(self, version):
+        """
+        pks of the rows changed since the index was loaded, or None if the
+        index has to be reloaded
+        """
+        if self._version is None or not 0 < version - self._version <= MAX_REPLAY:
+            return None
+        keys = [self.change_key.format(v) for v in range(self._version + 1, version + 1)]
+        changes = cache.get_many(keys)
+        if len(changes) != len(keys):
+            return None
+        return set(changes.values())
+
+    def _add(self, keys, all_names, pk, names):
+        all_names[pk] = names
+        for word in set(words(' '.join(names))):
+            bisect.insort(keys, (word, pk))
+
+    def _remove(self, keys, all_names, pk):
+        names = all_names.pop(pk, None)
+        if names is None:
+            return
+        for word in set(words(' '.join(names))):
+            i = bisect.bisect_left(keys, (word, pk))
+            if i < len(keys) and keys[i] == (word, pk):
+                del keys[i]
+
+    def _rows(self, pks=None):
+        rows = self.model.objects.all()
+        if pks is not None:
+            rows = rows.filter(pk__in=pks)
+        for row in rows.values_list('pk', *self.fields).iterator():
+            yield row[0], tuple((value or '').lower() for value in row[1:])
+
+    def refresh(self):
+        """
+        Bring the index up to the current version
+        """
+        version = self.current_version()
+        if version == self._version:
+            return
+        with self._lock:
+            if version == self._version:
+                return
+            changes = self._changes(version)
+            if changes is None:
+                names = dict(self._rows())
+                keys = sorted((word, pk) for pk, row_names in names.items()
+                              for word in set(words(' '.join(row_names))))
+            else:
+                # changed on copies: lookups keep reading the current index
+                keys, names = list(self._index[0]), dict(self._index[1])
+                for pk in changes:
+                    self._remove(keys, names, pk)
+                for pk, row_names in self._rows(changes):
+                    self._add(keys, names, pk, row_names)
+            self._index = (keys, names)
+            self._version = version
+
+    #### Lookup ####
+
+    def _prefixed(self, keys, prefix):
+        """
+        pks of the rows with a word starting with prefix
+        """
+        pks = set()
+        i = bisect.bisect_left(keys, (prefix,))
+        while i < len(keys) and keys[i][0].startswith(prefix):
+            pks.add(keys[i][1])
+            i += 1
+        return pks
+
+    def match(self, query, limit=RESULT_LIMIT):
+        """
+        pks of the best `limit` rows with a word starting with each word of
+        the query, best first
+        """
+        self.refresh()
+        keys, names = self._index
+        terms = words(query)
+        query = query.strip().lower()
+        if terms:
+            pks = self._prefixed(keys, terms[0])
+            for term in terms[1:]:
+                pks &= self._prefixed(keys, term)
+        else:
+            pks = names
+
+        def rank(pk):
+            identifier, first, last = names[pk]
+            return identifier != query, last, first, pk
+        return heapq.nsmallest(limit, pks, key=rank)
+
+    def lookup(self, query, limit=RESULT_LIMIT):
+        """
+        The best `limit` matching objects, best first
+        """
+        pks = self.match(query, limit)
+        objects = self.model.objects.in_bulk(pks)
+        return [objects[pk] for pk in pks if pk in objects]
+
+
+PERSON_INDEX = NameIndex('person', Person, ('cwid', 'first_name', 'last_name'))
+USER_INDEX = NameIndex('user', User, ('username', 'first_name', 'last_name'))
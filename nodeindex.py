@@ -0,0 +1,145 @@
+"""
+Fleet-wide index of the people who can reach each node.
+
+The NodeUserIndex reads the project-users table once for the whole fleet (or
+a chosen set of nodes), and answers the per-node and whole-fleet questions
+(who is on a node, who is on it through more than one project) from that
+snapshot, so pages listing duplicate users cost a fixed number of queries.
+"""
+from collections import defaultdict
+
+from persons.models import Person
+
+from .models import Project, Server
+
+# project statuses in which users still have access to the node
+ACTIVE_STATUSES = ('RU', 'SU', 'ON')
+
+
+def is_dcore_staff(role_name):
+    """
+    Data core staff are expected to be on many projects at once, and are not
+    reported as duplicates.
+    """
+    return bool(role_name) and role_name[:9] == 'Data Core'
+
+
+class NodeUserIndex:
+    """
+    (node, person) -> projects mapping for all active projects, built from a
+    single query over Project.users.through.
+
+    Person and Project instances are only loaded (in bulk) when a caller asks
+    for them, so the query count stays constant however many nodes are shown.
+    """
+    def __init__(self, server_pks=None):
+        rows = Project.users.through.objects.filter(
+                                    project__status__in=ACTIVE_STATUSES,
+                                    project__host__isnull=False,
+                                    )
+        if server_pks is not None:
+            rows = rows.filter(project__host__in=list(server_pks))
+        rows = rows.order_by('project_id').values_list('project__host_id',
+                                                        'person_id',
+                                                        'project_id',
+                                                        'person__role__name',
+                                                        )
+        # node pk -> {person pk: [project pk, ...]}
+        self.node_map = defaultdict(dict)
+        # person pks belonging to data core staff
+        self.staff = set()
+
+        for node_pk, person_pk, project_pk, role_name in rows:
+            self.node_map[node_pk].setdefault(person_pk, []).append(project_pk)
+            if is_dcore_staff(role_name):
+                self.staff.add(person_pk)
+
+        self._people = {}
+        self._projects = {}
+
+    @classmethod
+    def for_request(cls, request):
+        """
+        Return the index for this request, building it on first use.
+        """
+        index = getattr(request, '_node_user_index', None)
+        if index is None:
+            index = cls()
+            request._node_user_index = index
+        return index
+
+    def attach(self, servers):
+        """
+        Point each server at this index, so that templates calling
+        server.duplicate_users or server.get_all_active_users are served from
+        it instead of querying per server. Returns the servers as a list.
+        """
+        servers = list(servers)
+        for s in servers:
+            s._node_user_index = self
+        return servers
+
+    def user_pks(self, node_pk):
+        """
+        set of pks for all people with access to the node
+        """
+        return set(self.node_map.get(node_pk, {}))
+
+    def duplicate_pks(self, node_pk):
+        """
+        {person pk: [project pk, ...]} for non-staff people on more than one
+        project on the node
+        """
+        return {u: p_list for u, p_list in self.node_map.get(node_pk, {}).items()
+                if len(p_list) > 1 and u not in self.staff
+                }
+
+    def _load(self, person_pks, project_pks):
+        # fetch any instances not already loaded, one query per model
+        missing = set(person_pks) - set(self._people)
+        if missing:
+            self._people.update(Person.objects.in_bulk(missing))
+        missing = set(project_pks) - set(self._projects)
+        if missing:
+            self._projects.update(Project.objects.in_bulk(missing))
+
+    def _as_instances(self, pk_map):
+        self._load(pk_map, [p for p_list in pk_map.values() for p in p_list])
+        return {self._people[u]: [self._projects[p] for p in p_list]
+                for u, p_list in pk_map.items()
+                }
+
+    def active_users(self, node_pk):
+        """
+        {person: [project, ...]} for every person with access to the node
+        """
+        return self._as_instances(self.node_map.get(node_pk, {}))
+
+    def _fleet_duplicate_pks(self):
+        # duplicates for every node, with their instances loaded together on
+        # first use so that asking node by node does not query per node
+        if not hasattr(self, '_duplicate_pks'):
+            pk_maps = {n: self.duplicate_pks(n) for n in self.node_map}
+            self._duplicate_pks = {n: m for n, m in pk_maps.items() if m}
+            self._load([u for m in self._duplicate_pks.values() for u in m],
+                       [p for m in self._duplicate_pks.values()
+                            for p_list in m.values() for p in p_list
+                        ],
+            )
+        return self._duplicate_pks
+
+    def duplicates(self, node_pk):
+        """
+        {person: [project, ...]} for the people mounted twice on the node
+        """
+        return self._as_instances(self._fleet_duplicate_pks().get(node_pk, {}))
+
+    def fleet_duplicates(self):
+        """
+        {server: {person: [project, ...]}} for every node with duplicate users
+        """
+        pk_maps = self._fleet_duplicate_pks()
+        servers = Server.objects.in_bulk(pk_maps)
+        return {servers[n]: self._as_instances(m)
+                for n, m in sorted(pk_maps.items(), key=lambda i: servers[i[0]].node)
+                }
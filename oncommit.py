@@ -0,0 +1,71 @@
+"""
+Work run when the current transaction commits.
+
+OnCommitBatch collects keys (project or document pks) requested during a
+transaction and hands them to one call once it commits, dropping those of a
+transaction that rolls back. now_and_on_commit() runs a function at once and
+again on commit, for invalidations other processes must see.
+"""
+import functools
+import threading
+
+from django.db import transaction
+
+
+def now_and_on_commit(func):
+    """
+    Run func now, so the rest of this transaction sees its effect, and again
+    when the transaction commits, in case another process read the old state
+    in between (before the change was visible to it)
+    """
+    func()
+    transaction.on_commit(func)
+
+
+class OnCommitBatch:
+    """
+    Keys added within a transaction are passed to run(keys) once, when it
+    commits (at once under autocommit); add(None) asks for everything, passed
+    as run(None). Keys added in a transaction that rolls back are dropped
+    (those added in a savepoint rolled back within a transaction that
+    commits are not: the batch runs anyway, with them).
+    """
+    def __init__(self, run):
+        self.run = run
+        # the batch of the thread's current transaction
+        self._local = threading.local()
+
+    def add(self, keys=None):
+        state = getattr(self._local, 'state', None)
+        if state is None or not self._registered(state):
+            state = self._local.state = {'all': False, 'keys': set(), 'done': False}
+            state['callback'] = functools.partial(self._run_batch, state)
+        if keys is None:
+            state['all'] = True
+        else:
+            state['keys'].update(key for key in keys if key is not None)
+        # registered with every add, so the batch runs when any transaction
+        # (or savepoint) adding to it commits; the first callback to run does
+        # all the work, the rest find it done
+        transaction.on_commit(state['callback'])
+
+    def _registered(self, state):
+        # Whether the state's callback still waits for a commit. Django has no
+        # public way to ask: a rollback drops the callbacks registered since
+        # the transaction (or savepoint) began from the connection's
+        # run_on_commit list of (savepoint ids, callback[, robust]) entries,
+        # without running them, so a batch whose callbacks are all gone was
+        # rolled back and its keys are stale.
+        connection = transaction.get_connection()
+        return any(entry[1] is state['callback'] for entry in connection.run_on_commit)
+
+    def _run_batch(self, state):
+        if state['done']:
+            return
+        state['done'] = True
+        if getattr(self._local, 'state', None) is state:
+            del self._local.state
+        if state['all']:
+            self.run(None)
+        elif state['keys']:
+            self.run(state['keys'])
@@ -0,0 +1,191 @@
+"""
+Operations emails, queued in OutboxMessage and sent in the background.
+
+queue_email() stores the ServiceNow email of a change; `manage.py
+sendoutbox` runs a Dispatcher, which claims the messages due, sends them
+through the shared GraphClient (see outlookservice.py), BATCH_LIMIT to a
+$batch request, from a few threads, and records the outcome of each:
+failures Graph may recover from (throttling, server errors, network
+errors) are retried with exponential backoff, up to MAX_ATTEMPTS.
+
+Messages are sent as settings.DC_OUTBOX_SENDER, with an app-only token of
+the OUTLOOK_APP_ID application in the DC_OUTBOX_TENANT directory (which
+needs the Mail.Send application permission). Without DC_OUTBOX_SENDER
+nothing is queued, and SendMail shows the email to send by hand.
+"""
+import json
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+import requests
+
+from django.conf import settings
+from django.utils import timezone
+
+from .models import OutboxMessage
+from .outlookservice import BATCH_LIMIT, graph_client
+
+# $batch requests sent at once
+WORKERS = 4
+
+# messages claimed by one dispatch
+BATCH_SIZE = 100
+
+# attempts before a message is marked failed
+MAX_ATTEMPTS = 6
+
+# seconds before the first retry, doubled for each later one
+BACKOFF = 60
+
+# seconds after which a message claimed by a dispatcher that died is sent
+# again
+CLAIM_TIMEOUT = 10 * 60
+
+# responses worth retrying
+RETRY_STATUSES = {408, 429, 500, 502, 503, 504}
+
+
+def outbox_enabled():
+    return bool(getattr(settings, 'DC_OUTBOX_SENDER', None))
+
+def queue_email(email, author=None):
+    """
+    Queue an email (a dict with subject, body and to_email, as the views
+    keep in the session) for sending. Returns the OutboxMessage, or None if
+    the outbox is not configured.
+    """
+    if not outbox_enabled():
+        return None
+    return OutboxMessage.objects.create(record_author=author,
+                                        to_email=email['to_email'],
+                                        subject=email['subject'],
+                                        body=email['body'],
+                                        )
+
+def graph_message(message):
+    """
+    The sendMail payload of an OutboxMessage
+    """
+    return {
+        'message': {
+            'subject': message.subject,
+            'body': {'contentType': 'Text', 'content': message.body},
+            'toRecipients': [{'emailAddress': {'address': message.to_email}}],
+        },
+        'saveToSentItems': 'true',
+    }
+
+
+class DeliveryError(Exception):
+    """
+    A message was not sent. `retry` tells whether trying again later may
+    work, `retry_after` the seconds the server asked to wait, if any.
+    """
+    def __init__(self, message, retry=True, retry_after=None):
+        super().__init__(message)
+        self.retry = retry
+        self.retry_after = retry_after
+
+
+class Dispatcher:
+    """
+    Sends the due OutboxMessages as `sender` through a GraphClient, in
+    $batch requests of up to BATCH_LIMIT messages sent from `workers`
+    threads
+    """
+    def __init__(self, sender=None, client=None, workers=WORKERS,
+                 max_attempts=MAX_ATTEMPTS, backoff=BACKOFF):
+        self.sender = sender or settings.DC_OUTBOX_SENDER
+        self.client = client or graph_client()
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+
+    #### Sending ####
+
+    def deliver(self, messages):
+        """
+        Send OutboxMessages in one $batch. Returns, for each, None if it
+        was sent or the DeliveryError.
+        """
+        try:
+            responses = self.client.send_mails(self.sender,
+                                               [graph_message(m) for m in messages])
+        except (requests.RequestException, ValueError) as e:
+            return [DeliveryError(str(e)) for m in messages]
+        return [self._error(response) for response in responses]
+
+    def _error(self, response):
+        status = response['status']
+        if status is not None and 200 <= status < 300:
+            return None
+        body = response.get('body') or ''
+        if not isinstance(body, str):
+            body = json.dumps(body)
+        if status is None:
+            return DeliveryError(body)
+        headers = {k.lower(): v for k, v in (response.get('headers') or {}).items()}
+        retry_after = str(headers.get('retry-after', ''))
+        return DeliveryError('{}: {}'.format(status, body[:1000]),
+                             status in RETRY_STATUSES,
+                             int(retry_after) if retry_after.isdigit() else None)
+
+    #### Bookkeeping ####
+
+    def claim(self, limit=BATCH_SIZE):
+        """
+        Mark up to `limit` due messages as being sent by this dispatch, so
+        no other dispatcher sends them too. Returns them.
+        """
+        now = timezone.now()
+        due = OutboxMessage.objects.filter(status__in=(OutboxMessage.PENDING,
+                                                       OutboxMessage.SENDING),
+                                           next_attempt__lte=now)
+        pks = list(due.order_by('next_attempt', 'pk').values_list('pk', flat=True)[:limit])
+        claim = uuid.uuid4().hex
+        due.filter(pk__in=pks).update(status=OutboxMessage.SENDING,
+                                      next_attempt=now + timedelta(seconds=CLAIM_TIMEOUT),
+                                      claimed_by=claim)
+        return list(OutboxMessage.objects.filter(claimed_by=claim,
+                                                 status=OutboxMessage.SENDING
+                                                 ).order_by('pk'))
+
+    def record(self, message, error):
+        """
+        Save the outcome of an attempt to send message
+        """
+        now = timezone.now()
+        message.attempts += 1
+        message.claimed_by = ''
+        if error is None:
+            message.status = OutboxMessage.DELIVERED
+            message.sent_on = now
+            message.last_error = ''
+        else:
+            message.last_error = str(error)
+            if not error.retry or message.attempts >= self.max_attempts:
+                message.status = OutboxMessage.FAILED
+            else:
+                message.status = OutboxMessage.PENDING
+                delay = self.backoff * 2 ** (message.attempts - 1)
+                message.next_attempt = now + timedelta(seconds=max(delay,
+                                                                   error.retry_after or 0))
+        message.save(update_fields=['attempts', 'claimed_by', 'status', 'sent_on',
+                                    'last_error', 'next_attempt'])
+
+    def dispatch(self, limit=BATCH_SIZE):
+        """
+        Send the messages due. Returns the messages attempted, with their
+        new status.
+        """
+        messages = self.claim(limit)
+        if not messages:
+            return []
+        # the worker threads do HTTP only, no database
+        batches = [messages[i:i + BATCH_LIMIT] for i in range(0, len(messages), BATCH_LIMIT)]
+        with ThreadPoolExecutor(self.workers) as pool:
+            errors = [e for batch in pool.map(self.deliver, batches) for e in batch]
+        for message, error in zip(messages, errors):
+            self.record(message, error)
+        return messages
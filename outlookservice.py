@@ -1,47 +1,269 @@
-
 """
 all of our Outlook API functions are implemented in this file
+
+GraphClient keeps one pooled requests.Session for Graph and the token
+endpoint, caches the app-only access token and the signed-in users'
+(delegated) tokens until REFRESH_MARGIN seconds before they expire (renewed
+by one thread while the others wait), sends several requests in one round
+trip through Graph's $batch endpoint, and counts the calls made and the time
+they took, by call ('token', '$batch', 'sendMail', ...; see stats()).
+graph_client() is the one shared by the process.
 """
 
-import requests
+import threading
+import time
 import uuid
-import json
+from collections import defaultdict
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from django.conf import settings
 
 graph_endpoint = 'https://graph.microsoft.com/v1.0{0}'
 
+# The app-only token endpoint of a tenant
+app_token_url = 'https://login.microsoftonline.com/{0}/oauth2/v2.0/token'
+
+# connections kept open per host
+POOL_SIZE = 8
+
+# seconds before its expiry that a cached token is renewed
+REFRESH_MARGIN = 300
+
+# seconds to wait for an answer
+REQUEST_TIMEOUT = 30
+
+# requests Graph accepts in one $batch
+BATCH_LIMIT = 20
+
+
+class GraphClient:
+  """
+  Microsoft Graph (and token endpoint) calls over one pooled session
+  """
+  def __init__(self, endpoint='https://graph.microsoft.com/v1.0', token_url=None,
+               client_id=None, client_secret=None, pool_size=POOL_SIZE):
+    self.endpoint = endpoint.rstrip('/')
+    self.token_url = token_url or app_token_url.format(
+                                    getattr(settings, 'DC_OUTBOX_TENANT', 'common'))
+    self.client_id = client_id or settings.OUTLOOK_APP_ID
+    self.client_secret = client_secret or settings.OUTLOOK_APP_PW
+    self.session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size)
+    self.session.mount('https://', adapter)
+    self.session.mount('http://', adapter)
+    self._token = None
+    self._token_expires = 0
+    self._token_lock = threading.Lock()
+    # refresh token -> (token response, expiry time)
+    self._user_tokens = {}
+    # refresh token -> lock held while refreshing it, so one user's requests
+    # refresh once without waiting on other users' refreshes
+    self._user_locks = {}
+    self._user_locks_lock = threading.Lock()
+    # call name -> [calls, seconds]
+    self._timings = defaultdict(lambda: [0, 0.0])
+    self._timings_lock = threading.Lock()
+
+  #### Timing ####
+
+  def _request(self, name, method, url, **kwargs):
+    kwargs.setdefault('timeout', REQUEST_TIMEOUT)
+    start = time.perf_counter()
+    try:
+      return self.session.request(method, url, **kwargs)
+    finally:
+      elapsed = time.perf_counter() - start
+      with self._timings_lock:
+        timing = self._timings[name]
+        timing[0] += 1
+        timing[1] += elapsed
+
+  def stats(self):
+    """
+    {call name: {'calls', 'seconds', 'average'}} of the calls made so far
+    """
+    with self._timings_lock:
+      return {name: {'calls': calls,
+                     'seconds': seconds,
+                     'average': seconds / calls if calls else 0.0}
+              for name, (calls, seconds) in self._timings.items()}
+
+  #### Tokens ####
+
+  def token_request(self, post_data, token_url=None):
+    """
+    The token endpoint's response to a grant (authorization code, refresh
+    token or client credentials)
+    """
+    return self._request('token', 'POST', token_url or self.token_url, data=post_data)
+
+  def app_token(self, renew=False):
+    """
+    The app-only access token, renewed REFRESH_MARGIN seconds before it
+    expires (or now, with renew)
+    """
+    if not renew and self._token and time.time() < self._token_expires:
+      return self._token
+    with self._token_lock:
+      # another thread may have renewed it while this one waited
+      if renew or not self._token or time.time() >= self._token_expires:
+        r = self.token_request({'grant_type': 'client_credentials',
+                                'client_id': self.client_id,
+                                'client_secret': self.client_secret,
+                                'scope': 'https://graph.microsoft.com/.default'})
+        r.raise_for_status()
+        token = r.json()
+        self._token = token['access_token']
+        self._token_expires = time.time() + int(token.get('expires_in', 3600)) - REFRESH_MARGIN
+      return self._token
+
+  def user_token(self, post_data, token_url=None):
+    """
+    The token endpoint's response to a refresh token grant, cached by
+    refresh token until REFRESH_MARGIN seconds before the access token
+    expires, with expires_in counting down. Raises ValueError when the
+    endpoint does not answer with JSON.
+    """
+    refresh_token = post_data['refresh_token']
+    cached = self._cached_user_token(refresh_token)
+    if cached:
+      return cached
+    with self._user_locks_lock:
+      lock = self._user_locks.setdefault(refresh_token, threading.Lock())
+    try:
+      with lock:
+        # another thread may have refreshed it while this one waited
+        cached = self._cached_user_token(refresh_token)
+        if cached:
+          return cached
+        r = self.token_request(post_data, token_url)
+        try:
+          token = r.json()
+        except ValueError:
+          raise ValueError('Error retrieving token: {0} - {1}'.format(r.status_code, r.text))
+        if 'access_token' in token:
+          now = time.time()
+          expires = now + int(token.get('expires_in', 3600))
+          with self._user_locks_lock:
+            self._user_tokens = {key: entry for key, entry in self._user_tokens.items()
+                                 if entry[1] - REFRESH_MARGIN > now}
+            # the refresh token given back (possibly a new one) answers too
+            for key in {refresh_token, token.get('refresh_token', refresh_token)}:
+              self._user_tokens[key] = (token, expires)
+        return token
+    finally:
+      with self._user_locks_lock:
+        # the lock is only kept while it is held (a thread that took it just
+        # before finds the token cached once it has it)
+        if not lock.locked() and self._user_locks.get(refresh_token) is lock:
+          del self._user_locks[refresh_token]
+
+  def _cached_user_token(self, refresh_token):
+    entry = self._user_tokens.get(refresh_token)
+    if entry:
+      token, expires = entry
+      now = time.time()
+      if now < expires - REFRESH_MARGIN:
+        return dict(token, expires_in=int(expires - now))
+    return None
+
+  #### Calls ####
+
+  def call(self, method, url, token=None, user_email='', payload=None, parameters=None,
+           name=None):
+    """
+    Call Graph at url (or a path under the endpoint), with the given
+    access token or else the app-only one. The call is timed under name
+    (by default the last segment of the path, such as 'sendMail'). Returns
+    the requests response.
+    """
+    if url.startswith('/'):
+      url = self.endpoint + url
+    name = name or urlsplit(url).path.rstrip('/').rsplit('/', 1)[-1]
+    for renew in (False, True):
+      # Send these headers with all API calls
+      headers = { 'User-Agent' : 'dcore-connection/1.0',
+                  'Authorization' : 'Bearer {0}'.format(token or self.app_token(renew)),
+                  'Accept' : 'application/json',
+                  'X-AnchorMailbox' : user_email }
+
+      # Use these headers to instrument calls. Makes it easier
+      # to correlate requests and responses in case of problems
+      # and is a recommended best practice.
+      headers.update({ 'client-request-id' : str(uuid.uuid4()),
+                       'return-client-request-id' : 'true' })
+
+      r = self._request(name, method.upper(), url, headers = headers,
+                        json = payload, params = parameters)
+      # an app-only token revoked early is renewed once
+      if r.status_code != 401 or token:
+        return r
+    return r
+
+  def batch(self, requests_list, token=None):
+    """
+    Send Graph requests ({'method', 'url', 'body'}, url relative to the
+    endpoint) BATCH_LIMIT at a time through $batch. Returns the response of
+    each ({'status', 'headers', 'body'}), in order. A $batch call that fails
+    as a whole gives every request in it its status, and the response text
+    as body.
+    """
+    responses = []
+    for start in range(0, len(requests_list), BATCH_LIMIT):
+      chunk = requests_list[start:start + BATCH_LIMIT]
+      payload = {'requests': [dict(request, id=str(i),
+                                   headers={'Content-Type': 'application/json'})
+                              for i, request in enumerate(chunk)]}
+      try:
+        r = self.call('POST', '/$batch', token, payload = payload, name = '$batch')
+      except requests.RequestException as e:
+        responses.extend({'status': None, 'headers': {}, 'body': str(e)} for request in chunk)
+        continue
+      if not r.ok:
+        responses.extend({'status': r.status_code, 'headers': dict(r.headers), 'body': r.text}
+                         for request in chunk)
+        continue
+      # Graph may answer in any order
+      answered = {response['id']: response for response in r.json()['responses']}
+      responses.extend(answered.get(str(i), {'status': None, 'headers': {},
+                                             'body': 'no response'})
+                       for i in range(len(chunk)))
+    return responses
+
+  def send_mails(self, sender, messages, token=None):
+    """
+    Send sendMail payloads as the sender's mailbox, batched. Returns the
+    response of each.
+    """
+    url = '/users/{}/sendMail'.format(sender) if sender else '/me/sendMail'
+    return self.batch([{'method': 'POST', 'url': url, 'body': message}
+                       for message in messages], token)
+
+
+_client = None
+_client_lock = threading.Lock()
+
+def graph_client():
+  """
+  The GraphClient shared by the process
+  """
+  global _client
+  if _client is None:
+    with _client_lock:
+      if _client is None:
+        _client = GraphClient()
+  return _client
+
+
 # Generic API Sending
-def make_api_call(method, url, token, user_email, payload = None, parameters = None):
-  # Send these headers with all API calls
-  headers = { 'User-Agent' : 'dcore-connection/1.0',
-              'Authorization' : 'Bearer {0}'.format(token),
-              'Accept' : 'application/json',
-              'X-AnchorMailbox' : user_email }
-
-  # Use these headers to instrument calls. Makes it easier
-  # to correlate requests and responses in case of problems
-  # and is a recommended best practice.
-  request_id = str(uuid.uuid4())
-  instrumentation = { 'client-request-id' : request_id,
-                      'return-client-request-id' : 'true' }
-
-  headers.update(instrumentation)
-
-  response = None
-
-  if (method.upper() == 'GET'):
-      response = requests.get(url, headers = headers, params = parameters)
-  elif (method.upper() == 'DELETE'):
-      response = requests.delete(url, headers = headers, params = parameters)
-  elif (method.upper() == 'PATCH'):
-      headers.update({ 'Content-Type' : 'application/json' })
-      response = requests.patch(url, headers = headers, data = json.dumps(payload), params = parameters)
-  elif (method.upper() == 'POST'):
-      headers.update({ 'Content-Type' : 'application/json' })
-      response = requests.post(url, headers = headers, data = json.dumps(payload), params = parameters)
-
-  return response
-  
-  
+def make_api_call(method, url, token, user_email, payload = None, parameters = None,
+                  name = None):
+  return graph_client().call(method, url, token, user_email, payload, parameters, name)
+
+
 def get_me(access_token):
   get_me_url = graph_endpoint.format('/me')
 
@@ -49,25 +271,26 @@ def get_me(access_token):
   #  - Only return the displayName and mail fields
   query_parameters = {'$select': 'displayName,mail'}
 
-  r = make_api_call('GET', get_me_url, access_token, "", parameters = query_parameters)
+  r = make_api_call('GET', get_me_url, access_token, "", parameters = query_parameters,
+                    name = 'me')
 
   if (r.status_code == requests.codes.ok):
     return r.json()
   else:
     return "{0}: {1}".format(r.status_code, r.text)
-    
-    
+
+
 def send_message(access_token,user_email, payload):
-     get_messages_url = graph_endpoint.format('/Me/sendmail')      
+     get_messages_url = graph_endpoint.format('/Me/sendmail')
 
-     r = make_api_call('POST', 
-                        get_messages_url, 
-                        access_token, 
-                        user_email, 
+     r = make_api_call('POST',
+                        get_messages_url,
+                        access_token,
+                        user_email,
                         payload = payload,
+                        name = 'sendMail',
                         )
-     if (r.status_code == requests.codes.ok):
-        print(r.json())
-        return r.json()
+     if (r.status_code == requests.codes.accepted):
+        return r.text
      else:
-        return "{0}: {1}".format(r.status_code, r.text)  
\ No newline at end of file
+        return "{0}: {1}".format(r.status_code, r.text)
@@ -0,0 +1,612 @@
+"""
+Full-text search over projects, people, governance documents, logs and
+comments.
+
+The text of each searchable field is kept in a SearchEntry row per (kind,
+object, field), rewritten by signals.py whenever the object changes, and a
+SearchBackend finds the entries with a word starting with each query term:
+
+- SQLiteFTSBackend: an FTS5 index of SearchEntry.text (SQLite built with FTS5)
+- PostgresBackend: a GIN index of to_tsvector(SearchEntry.text) (PostgreSQL)
+- PythonBackend: an inverted index of the entries held in memory, updated
+  with the entries of the objects changed (any other database)
+
+Each source (kind of object) is searched on its own, in the order of
+SOURCES, so FullSearch can send the results of one before searching the
+next. Objects matching every term are ranked by the summed weight of the
+fields they matched in. A source taking longer than its time budget is
+abandoned and reported as timed out, so one huge log table cannot hold up
+the rest of the results.
+"""
+import abc
+import bisect
+import random
+import re
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+from django.core.cache import cache
+from django.core.paginator import Paginator
+from django.db import DatabaseError, OperationalError, connection, transaction
+from django.db.models import Q
+
+from persons.models import Person
+
+from . import caching
+from .models import Governance_Doc, Project, SearchEntry, CommentLog
+from .models import Access_Log, FileTransfer, Data_Log, Storage_Log, Software_Log
+from .models import MigrationLog
+from .oncommit import now_and_on_commit
+
+# results per page of a source searched on its own
+PAGE_SIZE = 50
+
+# results shown for each source when searching them all
+GROUP_SIZE = 10
+
+# seconds each source may take when searching them all
+SOURCE_BUDGET = 2.0
+
+# words are runs of letters and digits, as split by the FTS5 tokenizer
+WORD = re.compile(r'[^\W_]+')
+
+# FTS5 table indexing SearchEntry.text, and the triggers keeping it in sync
+FTS_TABLE = 'dc_management_searchentry_fts'
+FTS_SQL = (
+    "CREATE VIRTUAL TABLE IF NOT EXISTS {fts} USING fts5(text, "
+    "content='dc_management_searchentry', content_rowid='id')",
+    "CREATE TRIGGER IF NOT EXISTS {fts}_ai AFTER INSERT ON dc_management_searchentry "
+    "BEGIN INSERT INTO {fts}(rowid, text) VALUES (new.id, new.text); END",
+    "CREATE TRIGGER IF NOT EXISTS {fts}_ad AFTER DELETE ON dc_management_searchentry "
+    "BEGIN INSERT INTO {fts}({fts}, rowid, text) VALUES ('delete', old.id, old.text); END",
+    "CREATE TRIGGER IF NOT EXISTS {fts}_au AFTER UPDATE ON dc_management_searchentry "
+    "BEGIN INSERT INTO {fts}({fts}, rowid, text) VALUES ('delete', old.id, old.text); "
+    "INSERT INTO {fts}(rowid, text) VALUES (new.id, new.text); END",
+    "INSERT INTO {fts}({fts}) VALUES ('rebuild')",
+)
+
+# GIN index for PostgresBackend
+TSVECTOR_INDEX = 'dc_management_searchentry_tsv'
+
+# cache keys holding the version stamp of the search entries, and the objects
+# whose entries changed at each version
+SEARCH_VERSION_KEY = 'dc_management:searchindex'
+SEARCH_CHANGE_KEY = 'dc_management:searchindex:{}'
+
+# changes, and objects changed, a PythonBackend index catches up on before
+# reloading instead
+MAX_REPLAY = 200
+MAX_REPLAY_OBJECTS = 500
+
+# seconds the objects changed at each version are kept
+CHANGE_TIMEOUT = 24 * 60 * 60
+
+
+def words(text):
+    """
+    distinct lower case words of the text, in order
+    """
+    return list(dict.fromkeys(WORD.findall((text or '').lower())))
+
+
+class SearchSource:
+    """
+    A searchable model: the fields indexed for each object, with their weights,
+    the queryset results are loaded from and the template listing them. Fields
+    that are many-to-many relations to CommentLog are indexed as the text of
+    all their comments, and 'relation__field' as the field of a related
+    object.
+    """
+    def __init__(self, kind, model, fields, results=None, label=None, template=None):
+        self.kind = kind
+        self.model = model
+        self.fields = fields
+        self.results = results if results is not None else model.objects.all()
+        self.label = label or str(model._meta.verbose_name_plural).title()
+        self.template = template
+
+    def comment_fields(self):
+        return [name for name, weight in self.fields
+                if '__' not in name and self.model._meta.get_field(name).many_to_many]
+
+    def related_fields(self):
+        return [name.split('__')[0] for name, weight in self.fields if '__' in name]
+
+    def texts(self, obj):
+        """
+        (field, weight, text) of each indexed field of obj
+        """
+        comment_fields = self.comment_fields()
+        for name, weight in self.fields:
+            if name in comment_fields:
+                text = '\n'.join(c.comment for c in getattr(obj, name).all())
+            else:
+                text = obj
+                for attr in name.split('__'):
+                    text = getattr(text, attr) if text is not None else None
+            yield name, weight, str(text) if text is not None else ''
+
+    def entries(self, obj):
+        return [SearchEntry(kind=self.kind, object_id=obj.pk, field=name,
+                            weight=weight, text=text)
+                for name, weight, text in self.texts(obj) if text.strip()]
+
+    def display(self, obj):
+        """
+        What the template lists for a matching object
+        """
+        return obj
+
+
+class LogHit:
+    """
+    A matching log entry or comment, as listed by search_logs.html
+    """
+    def __init__(self, obj, date, tickets, projects, text):
+        self.obj = obj
+        self.date = date
+        self.tickets = tickets
+        self.projects = projects
+        self.text = text
+
+
+class LogSearchSource(SearchSource):
+    """
+    A log model, listed with the date, tickets and projects of each entry.
+    Indexed fields ending in 'ticket' are shown as its tickets, the others
+    as its text.
+    """
+    def __init__(self, kind, model, fields, date_field, projects=(), related=(), label=None):
+        results = model.objects.select_related(
+                        *[name for name in projects
+                          if not model._meta.get_field(name).many_to_many],
+                        *related
+                    ).prefetch_related(
+                        *[name for name in projects
+                          if model._meta.get_field(name).many_to_many])
+        super().__init__(kind, model, fields, results, label,
+                         'dc_management/search_logs.html')
+        self.date_field = date_field
+        self.projects = projects
+
+    def display(self, obj):
+        projects = []
+        for name in self.projects:
+            if self.model._meta.get_field(name).many_to_many:
+                projects.extend(getattr(obj, name).all())
+            elif getattr(obj, name) is not None:
+                projects.append(getattr(obj, name))
+        tickets = []
+        texts = []
+        for name, weight, text in self.texts(obj):
+            if text.strip():
+                (tickets if name.endswith('ticket') else texts).append(text)
+        return LogHit(obj, getattr(obj, self.date_field), tickets, projects,
+                      '\n'.join(texts))
+
+
+# kind -> SearchSource, in the order they are searched and shown
+SOURCES = {s.kind: s for s in (
+    SearchSource('project', Project,
+                 (('dc_prj_id', 10), ('nickname', 5), ('title', 3),
+                  ('dynamic_comments', 1)),
+                 Project.objects.with_user_counts(
+                                ).select_related('pi', 'prj_admin'
+                                ).prefetch_related('dynamic_comments'),
+                 template='dc_management/search_projects.html'),
+    SearchSource('govdoc', Governance_Doc,
+                 (('doc_id', 10), ('governance_type', 5), ('comments', 1),
+                  ('document_text__text', 1)),
+                 Governance_Doc.objects.with_attention(
+                                ).select_related('project'
+                                ).prefetch_related('dynamic_comments'),
+                 'Governance Docs', 'dc_management/search_govdocs.html'),
+    SearchSource('person', Person,
+                 (('cwid', 10), ('first_name', 5), ('last_name', 5), ('comments', 1)),
+                 Person.objects.prefetch_related('project_set'),
+                 'Users', 'dc_management/search_people.html'),
+    LogSearchSource('access_log', Access_Log, (('sn_ticket', 10),),
+                    'date_changed', ('prj_affected',), ('dc_user',)),
+    LogSearchSource('file_transfer', FileTransfer,
+                    (('ticket', 10), ('filenames', 3), ('filepath_dest', 3),
+                     ('comment', 1)),
+                    'change_date', ('source', 'destination')),
+    LogSearchSource('data_log', Data_Log,
+                    (('request_ticket', 10), ('transfer_ticket', 10),
+                     ('file_description', 3)),
+                    'change_date', ('project',)),
+    LogSearchSource('storage_log', Storage_Log,
+                    (('sn_ticket', 10), ('comments', 1)),
+                    'date_changed', ('project',)),
+    LogSearchSource('software_log', Software_Log,
+                    (('sn_ticket', 10), ('comments', 1)),
+                    'change_date', ('applied_to_prj',)),
+    LogSearchSource('migration_log', MigrationLog,
+                    (('access_ticket', 10), ('envt_ticket', 10), ('data_ticket', 10),
+                     ('comments', 1)),
+                    'record_creation', ('project',)),
+    LogSearchSource('comment', CommentLog, (('comment', 1),),
+                    'record_creation', ('project_comments',), ('record_author',),
+                    'Comments'),
+)}
+
+def source_for(model):
+    for source in SOURCES.values():
+        if source.model is model:
+            return source
+    return None
+
+
+#####################
+#### Maintenance ####
+
+def index_changed(kind=None, pks=None):
+    """
+    Give the search entries a new version stamp, now and when the transaction
+    commits, recording the objects of kind whose entries changed (kind=None:
+    all of them), so PythonBackend indexes catch up
+    """
+    change = (kind, list(pks)) if kind is not None else None
+    def bump():
+        try:
+            version = cache.incr(SEARCH_VERSION_KEY)
+        except ValueError:
+            # no version in the cache: start from a number no index is at
+            version = random.getrandbits(48)
+            cache.set(SEARCH_VERSION_KEY, version, caching.timeout())
+        cache.set(SEARCH_CHANGE_KEY.format(version), change, CHANGE_TIMEOUT)
+    now_and_on_commit(bump)
+
+def index_object(obj, source=None):
+    """
+    Rewrite the search entries of obj
+    """
+    source = source or source_for(type(obj))
+    with transaction.atomic():
+        SearchEntry.objects.filter(kind=source.kind, object_id=obj.pk).delete()
+        SearchEntry.objects.bulk_create(source.entries(obj))
+    index_changed(source.kind, [obj.pk])
+
+def index_objects(objs, source=None):
+    """
+    Rewrite the search entries of objects of one model saved in bulk
+    """
+    if not objs:
+        return
+    source = source or source_for(type(objs[0]))
+    with transaction.atomic():
+        SearchEntry.objects.filter(kind=source.kind,
+                                   object_id__in=[obj.pk for obj in objs]).delete()
+        SearchEntry.objects.bulk_create([e for obj in objs for e in source.entries(obj)])
+    index_changed(source.kind, [obj.pk for obj in objs])
+
+def remove_object(kind, pk):
+    SearchEntry.objects.filter(kind=kind, object_id=pk).delete()
+    index_changed(kind, [pk])
+
+def rebuild_index(batch_size=500):
+    """
+    Rewrite the search entries of every object. Returns the number of entries.
+    """
+    count = 0
+    with transaction.atomic():
+        SearchEntry.objects.all().delete()
+        for source in SOURCES.values():
+            objects = source.model.objects.order_by('pk').prefetch_related(
+                                                    *source.comment_fields(),
+                                                    *source.related_fields())
+            # batches by pk, since iterator() would not prefetch the comments
+            last = 0
+            while True:
+                batch = list(objects.filter(pk__gt=last)[:batch_size])
+                if not batch:
+                    break
+                entries = [e for obj in batch for e in source.entries(obj)]
+                SearchEntry.objects.bulk_create(entries)
+                count += len(entries)
+                last = batch[-1].pk
+    index_changed()
+    return count
+
+def install_search_index(conn):
+    """
+    Create the full-text index the database connection conn supports, if
+    any. The migration creating SearchEntry runs its own copy of this.
+    """
+    with conn.cursor() as cursor:
+        if conn.vendor == 'postgresql':
+            cursor.execute(
+                "CREATE INDEX IF NOT EXISTS {} ON dc_management_searchentry "
+                "USING GIN (to_tsvector('simple', text))".format(TSVECTOR_INDEX))
+        elif conn.vendor == 'sqlite':
+            try:
+                with transaction.atomic(using=conn.alias):
+                    for sql in FTS_SQL:
+                        cursor.execute(sql.format(fts=FTS_TABLE))
+            except DatabaseError:
+                # SQLite built without FTS5: searches use PythonBackend
+                pass
+
+def uninstall_search_index(conn):
+    with conn.cursor() as cursor:
+        if conn.vendor == 'postgresql':
+            cursor.execute("DROP INDEX IF EXISTS {}".format(TSVECTOR_INDEX))
+        elif conn.vendor == 'sqlite':
+            for trigger in ('ai', 'ad', 'au'):
+                cursor.execute("DROP TRIGGER IF EXISTS {}_{}".format(FTS_TABLE, trigger))
+            cursor.execute("DROP TABLE IF EXISTS {}".format(FTS_TABLE))
+
+
+##################
+#### Backends ####
+
+class SearchTimeout(Exception):
+    pass
+
+
+@contextmanager
+def time_budget(seconds):
+    """
+    Interrupt the queries run within once `seconds` have passed, raising
+    SearchTimeout. Yields a function telling whether the time is up, for
+    work between queries. No limit for None.
+    """
+    if seconds is None:
+        yield lambda: False
+        return
+    deadline = time.monotonic() + seconds
+    def expired():
+        return time.monotonic() >= deadline
+    try:
+        if connection.vendor == 'sqlite':
+            # the handler aborts the running statement when it returns true
+            connection.ensure_connection()
+            connection.connection.set_progress_handler(expired, 1000)
+            try:
+                yield expired
+            finally:
+                connection.connection.set_progress_handler(None, 0)
+        elif connection.vendor == 'postgresql':
+            with transaction.atomic():
+                with connection.cursor() as cursor:
+                    cursor.execute("SET LOCAL statement_timeout = %s",
+                                   [max(1, int(seconds * 1000))])
+                yield expired
+        else:
+            yield expired
+    except OperationalError as e:
+        if not expired():
+            raise
+        raise SearchTimeout() from e
+
+
+class SearchBackend(abc.ABC):
+    @abc.abstractmethod
+    def match(self, term, kind):
+        """
+        {object pk: summed weight} of the entries of kind with a word starting
+        with term
+        """
+
+    def _grouped(self, sql, params):
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            return dict(cursor.fetchall())
+
+
+class SQLiteFTSBackend(SearchBackend):
+    def match(self, term, kind):
+        return self._grouped(
+            "SELECT e.object_id, SUM(e.weight) "
+            "FROM {fts} JOIN dc_management_searchentry e ON e.id = {fts}.rowid "
+            "WHERE {fts} MATCH %s AND e.kind = %s "
+            "GROUP BY e.object_id".format(fts=FTS_TABLE),
+            ['"{}"*'.format(term), kind])
+
+
+class PostgresBackend(SearchBackend):
+    def match(self, term, kind):
+        # terms are letters and digits only, so safe in a tsquery
+        return self._grouped(
+            "SELECT object_id, SUM(weight) FROM dc_management_searchentry "
+            "WHERE to_tsvector('simple', text) @@ to_tsquery('simple', %s) "
+            "AND kind = %s GROUP BY object_id",
+            [term + ':*', kind])
+
+
+class PythonBackend(SearchBackend):
+    """
+    Inverted index (word -> entries) of the search entries of each kind,
+    shared by the process. An index behind the entries' version stamp re-reads
+    the entries of just the objects changed since, and reloads them all only
+    when it has never been loaded or has fallen too far behind (as NameIndex
+    does).
+    """
+    _lock = threading.Lock()
+    _version = None
+    # ({kind: sorted words},
+    #  {kind: {word: {entry pk: (object pk, weight)}}},
+    #  {(kind, object pk): [(entry pk, words), ...]})
+    _index = ({}, {}, {})
+
+    @classmethod
+    def current_version(cls):
+        version = cache.get(SEARCH_VERSION_KEY)
+        if version is None:
+            cache.add(SEARCH_VERSION_KEY, random.getrandbits(48), caching.timeout())
+            version = cache.get(SEARCH_VERSION_KEY)
+        return version
+
+    @classmethod
+    def _changes(cls, version):
+        """
+        {kind: object pks} whose entries changed since the index was loaded,
+        or None if the index has to be reloaded
+        """
+        if cls._version is None or not 0 < version - cls._version <= MAX_REPLAY:
+            return None
+        keys = [SEARCH_CHANGE_KEY.format(v) for v in range(cls._version + 1, version + 1)]
+        changes = cache.get_many(keys)
+        if len(changes) != len(keys) or None in changes.values():
+            return None
+        objects = defaultdict(set)
+        for kind, pks in changes.values():
+            objects[kind].update(pks)
+        if sum(len(pks) for pks in objects.values()) > MAX_REPLAY_OBJECTS:
+            return None
+        return objects
+
+    @staticmethod
+    def _add(index, pk, kind, object_id, weight, text):
+        index_words, postings, objects = index
+        entry_words = words(text)
+        objects.setdefault((kind, object_id), []).append((pk, entry_words))
+        kind_words = index_words.setdefault(kind, [])
+        kind_postings = postings.setdefault(kind, {})
+        for word in entry_words:
+            if word not in kind_postings:
+                kind_postings[word] = {}
+                bisect.insort(kind_words, word)
+            kind_postings[word][pk] = (object_id, weight)
+
+    @staticmethod
+    def _remove(index, kind, object_id):
+        index_words, postings, objects = index
+        for pk, entry_words in objects.pop((kind, object_id), ()):
+            for word in entry_words:
+                postings[kind][word].pop(pk, None)
+                if not postings[kind][word]:
+                    del postings[kind][word]
+                    kind_words = index_words[kind]
+                    del kind_words[bisect.bisect_left(kind_words, word)]
+
+    @classmethod
+    def refresh(cls):
+        """
+        Bring the index up to the current version
+        """
+        version = cls.current_version()
+        if version == cls._version:
+            return
+        with cls._lock:
+            # another thread may have caught up while this one waited
+            if version == cls._version:
+                return
+            changes = cls._changes(version)
+            entries = SearchEntry.objects.values_list('pk', 'kind', 'object_id',
+                                                      'weight', 'text')
+            if changes is None:
+                # built aside, so searches go on with the old index meanwhile
+                index = ({}, {}, {})
+                for entry in entries.iterator():
+                    cls._add(index, *entry)
+                cls._index = index
+            else:
+                query = Q(pk__in=[])
+                for kind, pks in changes.items():
+                    query |= Q(kind=kind, object_id__in=pks)
+                entries = list(entries.filter(query))
+                for kind, pks in changes.items():
+                    for pk in pks:
+                        cls._remove(cls._index, kind, pk)
+                for entry in entries:
+                    cls._add(cls._index, *entry)
+            cls._version = version
+
+    def match(self, term, kind):
+        self.refresh()
+        matched = {}
+        with self._lock:
+            index_words, postings, objects = self._index
+            kind_words = index_words.get(kind, [])
+            kind_postings = postings.get(kind, {})
+            # words starting with term sort together from term onwards
+            i = bisect.bisect_left(kind_words, term)
+            while i < len(kind_words) and kind_words[i].startswith(term):
+                matched.update(kind_postings[kind_words[i]])
+                i += 1
+        scores = defaultdict(float)
+        for object_id, weight in matched.values():
+            scores[object_id] += weight
+        return dict(scores)
+
+
+def get_backend():
+    """
+    The best backend the database supports
+    """
+    if connection.vendor == 'postgresql':
+        return PostgresBackend()
+    if (connection.vendor == 'sqlite' and
+            FTS_TABLE in connection.introspection.table_names()):
+        return SQLiteFTSBackend()
+    return PythonBackend()
+
+
+################
+#### Search ####
+
+class SearchGroup:
+    """
+    The objects of one source matching every word of the query, best first.
+    Empty, with timed_out set, if the search took longer than `budget`
+    seconds.
+    """
+    def __init__(self, source, terms, backend, budget=None):
+        self.source = source
+        self.timed_out = False
+        scores = {}
+        try:
+            with time_budget(budget) as expired:
+                for i, term in enumerate(terms):
+                    if expired():
+                        raise SearchTimeout()
+                    matched = backend.match(term, source.kind)
+                    scores = matched if i == 0 else {
+                                pk: score + matched[pk]
+                                for pk, score in scores.items() if pk in matched}
+                    if not scores:
+                        break
+        except SearchTimeout:
+            self.timed_out = True
+            scores = {}
+        self.hits = [pk for pk, score in sorted(scores.items(),
+                                                key=lambda i: (-i[1], i[0]))]
+
+    @property
+    def kind(self):
+        return self.source.kind
+
+    def page(self, number=1, size=PAGE_SIZE):
+        """
+        The Paginator page of hits, and what the source's template lists for
+        the objects on it, loaded with one query and in rank order
+        """
+        page = Paginator(self.hits, size).get_page(number)
+        pks = list(page.object_list)
+        loaded = self.source.results.in_bulk(pks) if pks else {}
+        return page, [self.source.display(loaded[pk]) for pk in pks if pk in loaded]
+
+
+class SearchResults:
+    """
+    The matches of a query in each of `kinds` (by default every source),
+    searched one source at a time with `budget` seconds each
+    """
+    def __init__(self, query, backend=None, kinds=None, budget=SOURCE_BUDGET):
+        self.query = query
+        self.terms = words(query)
+        self.backend = backend
+        self.sources = [SOURCES[kind] for kind in (kinds or SOURCES)]
+        self.budget = budget
+
+    def groups(self):
+        """
+        Generates the SearchGroup of each source, searching it when it is
+        asked for
+        """
+        backend = self.backend or (get_backend() if self.terms else None)
+        for source in self.sources:
+            yield SearchGroup(source, self.terms, backend, self.budget)
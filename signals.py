@@ -0,0 +1,165 @@
+"""
+Keep the cached rate tables, project costs, dashboard sections, search
+entries, compliance statuses and document texts up to date when anything they are computed
+from changes. Connected in DcManagementConfig.ready().
+"""
+from django.db import transaction
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete
+from django.dispatch import receiver
+
+from .compliance import schedule_scan
+from .costengine import invalidate_rates, schedule_recompute
+from .dashboard import WATCHED_MODELS, bump_generation
+from .nameindex import PERSON_INDEX, USER_INDEX
+from .oncommit import now_and_on_commit
+from .models import Project, Server, SoftwareCost, StorageCost, UserCost
+from .models import ExtraResourceCost, DatabaseCost, CommentLog, Governance_Doc
+from .models import ComplianceStatus, UserComplianceStatus
+from .search import SOURCES, index_object, index_objects, remove_object, source_for
+from .textextract import schedule_extraction
+
+
+@receiver(post_save, sender=Project)
+def project_saved(sender, instance, raw=False, **kwargs):
+    if not raw:
+        schedule_recompute([instance.pk])
+
+@receiver(m2m_changed, sender=Project.users.through)
+@receiver(m2m_changed, sender=Project.software_installed.through)
+def project_members_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if reverse:
+        # eg person.project_set.add(): pk_set holds project pks
+        if action == 'pre_clear':
+            pk_set = set(instance.project_set.values_list('pk', flat=True)
+                         if sender is Project.users.through else
+                         instance.software_installed.values_list('pk', flat=True))
+        elif action not in ('post_add', 'post_remove'):
+            return
+        schedule_recompute(pk_set)
+    elif action in ('post_add', 'post_remove', 'post_clear'):
+        schedule_recompute([instance.pk])
+
+@receiver(post_save, sender=Server)
+def server_saved(sender, instance, raw=False, **kwargs):
+    # database cost depends on the size of the database server
+    if not raw:
+        schedule_recompute(instance.db_host.values_list('pk', flat=True))
+
+@receiver(post_save, sender=UserCost)
+@receiver(post_delete, sender=UserCost)
+@receiver(post_save, sender=SoftwareCost)
+@receiver(post_delete, sender=SoftwareCost)
+@receiver(post_save, sender=StorageCost)
+@receiver(post_delete, sender=StorageCost)
+@receiver(post_save, sender=ExtraResourceCost)
+@receiver(post_delete, sender=ExtraResourceCost)
+@receiver(post_save, sender=DatabaseCost)
+@receiver(post_delete, sender=DatabaseCost)
+def rates_changed(sender, raw=False, **kwargs):
+    now_and_on_commit(invalidate_rates)
+    if not raw:
+        schedule_recompute()
+
+@receiver(post_save, sender=Project)
+@receiver(post_save, sender=Governance_Doc)
+@receiver(post_delete, sender=Governance_Doc)
+def compliance_changed(sender, instance, raw=False, **kwargs):
+    if not raw:
+        schedule_scan([instance.pk if sender is Project else instance.project_id])
+
+@receiver(m2m_changed, sender=Project.users.through)
+@receiver(m2m_changed, sender=Governance_Doc.users_permitted.through)
+def compliance_users_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    on_project = sender is Project.users.through
+    if reverse:
+        # eg person.project_set.add(): pk_set holds project (or document) pks
+        if action == 'pre_clear':
+            pk_set = set(instance.project_set.values_list('pk', flat=True)
+                         if on_project else
+                         instance.governance_doc_set.values_list('pk', flat=True))
+        elif action not in ('post_add', 'post_remove'):
+            return
+        if on_project:
+            schedule_scan(pk_set)
+        else:
+            schedule_scan(Governance_Doc.objects.filter(pk__in=pk_set
+                                        ).values_list('project_id', flat=True))
+    elif action in ('post_add', 'post_remove', 'post_clear'):
+        schedule_scan([instance.pk if on_project else instance.project_id])
+
+@receiver(post_save, sender=Governance_Doc)
+def governance_doc_saved(sender, instance, raw=False, **kwargs):
+    # the file may have changed: extraction skips the ones it has the text of
+    if not raw and (instance.documentation or instance.document_text_id):
+        schedule_extraction([instance.pk])
+
+def searchable_saved(sender, instance, raw=False, **kwargs):
+    if not raw:
+        index_object(instance)
+
+def searchable_deleted(sender, instance, **kwargs):
+    remove_object(source_for(sender).kind, instance.pk)
+
+@receiver(m2m_changed, sender=Project.dynamic_comments.through)
+def project_comments_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    if reverse:
+        # comment.project_comments.add(): pk_set holds project pks
+        for project in Project.objects.filter(pk__in=pk_set or []):
+            index_object(project)
+    else:
+        index_object(instance)
+
+@receiver(post_save, sender=CommentLog)
+def comment_saved(sender, instance, raw=False, **kwargs):
+    # edited comments change the text of the projects they are on
+    if not raw:
+        for project in instance.project_comments.all():
+            index_object(project)
+
+@receiver(pre_delete, sender=CommentLog)
+def comment_deleted(sender, instance, **kwargs):
+    # deleting a comment removes it from its projects without m2m_changed:
+    # their text changes once it is gone
+    pks = list(instance.project_comments.values_list('pk', flat=True))
+    if pks:
+        transaction.on_commit(
+            lambda: index_objects(list(Project.objects.filter(pk__in=pks))))
+
+def dashboard_changed(sender, **kwargs):
+    # the model's rows (or m2m links) changed
+    if kwargs.get('action', 'post_').startswith('post_'):
+        now_and_on_commit(lambda: bump_generation(sender))
+
+# ComplianceScan.save() bumps the generations of the statuses once per scan:
+# without delete receivers, Django deletes the replaced rows without fetching
+# them
+SCAN_MODELS = (ComplianceStatus, UserComplianceStatus)
+
+for model in WATCHED_MODELS:
+    if model._meta.auto_created:
+        m2m_changed.connect(dashboard_changed, sender=model,
+                            dispatch_uid='dashboard_changed')
+    else:
+        post_save.connect(dashboard_changed, sender=model,
+                          dispatch_uid='dashboard_changed')
+        if model not in SCAN_MODELS:
+            post_delete.connect(dashboard_changed, sender=model,
+                                dispatch_uid='dashboard_changed')
+
+for source in SOURCES.values():
+    post_save.connect(searchable_saved, sender=source.model,
+                      dispatch_uid='searchable_saved')
+    post_delete.connect(searchable_deleted, sender=source.model,
+                        dispatch_uid='searchable_deleted')
+
+NAME_INDEXES = {index.model: index for index in (PERSON_INDEX, USER_INDEX)}
+
+def names_changed(sender, instance, raw=False, **kwargs):
+    index, pk = NAME_INDEXES[sender], instance.pk
+    now_and_on_commit(lambda: index.changed(pk))
+
+for model in NAME_INDEXES:
+    post_save.connect(names_changed, sender=model, dispatch_uid='names_changed')
+    post_delete.connect(names_changed, sender=model, dispatch_uid='names_changed')
@@ -1,19 +1,59 @@
 import datetime
+import json
+import os
+import shutil
+import tempfile
+import threading
 import unittest
+import zipfile
+from unittest import mock
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO, StringIO
+from urllib.parse import parse_qs
 
 from django.test import TestCase
 from django.test import Client
+from django.test.utils import CaptureQueriesContext
+from django.test import override_settings
+from django.core.files.base import ContentFile
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.cache import cache
+from django.core.management import call_command
+from django.core.management.base import CommandError
 
-from django.db import IntegrityError
+from django.db import IntegrityError, connection, transaction
+from django.db.models import Sum
+from django.db.models.deletion import Collector
 from django.contrib.auth.models import User
 from django.urls import reverse
 
 from django.utils import timezone
 
 from .models import Server, Project, Person, Access_Log, EnvtSubtype, SubFunction
-from .models import StorageCost
+from .models import StorageCost, Software, Software_License_Type, UserCost
+from .models import ProjectBillingRecord, Governance_Doc, AccessPermission, MigrationLog
+from .models import Storage_Log, Software_Log, CommentLog
+from .models import ComplianceStatus, UserComplianceStatus, DataCoreUserAgreement
+from .models import OutboxMessage
 
-from .forms import StorageChangeForm
+from persons.models import Role
+
+from .forms import StorageChangeForm, ProjectBillingForm
+from .nodeindex import NodeUserIndex
+from .nameindex import PERSON_INDEX
+from . import caching
+from .oncommit import OnCommitBatch
+from .costengine import RATES_VERSION_KEY, ProjectCosts, RateTable, schedule_recompute
+from .dashboard import SECTION_TIMEOUT, Dashboard, generation_key
+from .compliance import ComplianceScan
+from .search import SOURCES, SearchResults, PythonBackend, SQLiteFTSBackend
+from .search import FTS_TABLE, install_search_index, uninstall_search_index, rebuild_index
+from .textextract import PdfReader, extract_documents
+from .userimport import PersonImport
+from .membership import add_users, remove_users
+from .outbox import Dispatcher, queue_email
+from .outlookservice import BATCH_LIMIT, REFRESH_MARGIN, GraphClient
 
 
 class ProjectModelTests(TestCase):
@@ -306,4 +346,1394 @@ class StorageTestCase(TestCase):
         form = StorageChangeForm({})
         self.assertFalse(form.is_valid())
     """    
-   
\ No newline at end of file
+   
+class FleetTestData:
+    """
+    shared fixtures for tests that need populated production nodes
+    """
+    @classmethod
+    def setUpTestData(cls):
+        cls.js = Person.objects.create(first_name='John', 
+                                        last_name='Smith', 
+                                        cwid='jos1234',
+                                        )
+        cls.jd = Person.objects.create(first_name='Jane', 
+                                        last_name='Doe', 
+                                        cwid='jed2001',
+                                        )
+        cls.env = EnvtSubtype.objects.create(name='cool_research')
+        cls.subfn = SubFunction.objects.create(name='impo_subfn')
+
+    def add_node(self, i):
+        """
+        create a production node with two running projects sharing one user
+        """
+        host = Server.objects.create(   status = "ON",
+                            function = "PR",
+                            node = "HPRP{:03d}".format(i),
+                            sub_function = self.subfn,
+                            name_address = "node{}.med.cornell.edu".format(i),
+                            ip_address = "10.36.217.{}".format(i),
+                            processor_num = 4,
+                            ram = 16,
+                            disk_storage = 100,
+                            other_storage = 100,   
+        )
+        for j in range(2):
+            prj = Project.objects.create( dc_prj_id = 'p{:03d}{}'.format(i, j),
+                                title = 'test project',
+                                pi = self.jd,
+                                env_subtype = self.env,
+                                expected_completion = datetime.date(2018, 7, 13),
+                                requested_launch = datetime.date(2018, 2, 13),
+                                status = 'RU',
+                                host = host,
+            )
+            prj.users.add(self.js)
+        return host
+
+class NodeUserIndexTests(FleetTestData, TestCase):
+
+    def test_duplicate_users(self):
+        host = self.add_node(1)
+        dups = host.duplicate_users()
+        self.assertEqual(list(dups), [self.js])
+        self.assertEqual(len(dups[self.js]), 2)
+        self.assertEqual(set(host.get_all_active_users()), {self.js})
+
+    def test_query_count_constant_across_fleet(self):
+        # four queries: project users, servers, people and projects
+        for n in (1, 5):
+            for i in range(n):
+                self.add_node(n * 10 + i)
+            with self.assertNumQueries(4):
+                servers = NodeUserIndex().attach(Server.objects.all())
+                for s in servers:
+                    self.assertEqual(len(s.duplicate_users()), 1)
+            with self.assertNumQueries(4):
+                fleet = NodeUserIndex().fleet_duplicates()
+            self.assertEqual(len(fleet), Server.objects.count())
+
+    def test_valid_nodes(self):
+        for i in range(3):
+            self.add_node(i)
+        empty = Server.objects.create(   status = "ON",
+                            function = "PR",
+                            node = "HPRP999",
+                            sub_function = self.subfn,
+                            name_address = "node999.med.cornell.edu",
+                            ip_address = "10.36.217.99",
+                            processor_num = 16,
+                            ram = 64,
+                            disk_storage = 100,
+                            other_storage = 100,   
+        )
+        prj = Project.objects.create( dc_prj_id = 'prj0100',
+                                title = 'migrating project',
+                                pi = self.jd,
+                                env_subtype = self.env,
+                                expected_completion = datetime.date(2018, 7, 13),
+                                requested_launch = datetime.date(2018, 2, 13),
+                                status = 'RU',
+        )
+        prj.users.add(self.js)
+        # index, project users and annotated nodes
+        with self.assertNumQueries(3):
+            nodes = prj.valid_nodes(rank=True)
+            prj.valid_nodes(rank=True)
+        self.assertEqual(nodes, [empty])
+        self.assertEqual(nodes[0].free_cpu, 16)
+
+        prj.users.remove(self.js)
+        prj = Project.objects.get(pk=prj.pk)
+        nodes = prj.valid_nodes(rank=True)
+        self.assertEqual(len(nodes), 4)
+        self.assertEqual(nodes[0], empty)
+
+class SoftwareUsageTests(FleetTestData, TestCase):
+
+    def test_with_usage(self):
+        lic = Software_License_Type.objects.create(name='site',
+                                                   user_assigned=False,
+                                                   concurrent=True,
+                                                   monitored=False,
+                                                   )
+        sw = Software.objects.create(name='stata', vendor='stata', version='15',
+                                     license_type=lic,
+                                     )
+        for i in range(3):
+            for prj in self.add_node(i).project_set.all():
+                prj.software_installed.add(sw)
+                prj.users.add(self.jd)
+        prj.status = 'CO'
+        prj.save()
+        with self.assertNumQueries(1):
+            usage = Software.objects.with_usage().get(pk=sw.pk)
+            self.assertEqual(usage.seatcount(), 10)
+        self.assertEqual(usage.user_count, 2)
+        self.assertEqual(usage.project_count, 6)
+        # without the annotation the seat count agrees with the legacy method
+        self.assertEqual(Software.objects.get(pk=sw.pk).seatcount(), 10)
+        self.assertEqual(usage.user_count, sw.swusers().count())
+
+class OnCommitBatchTests(TestCase):
+
+    def setUp(self):
+        self.runs = []
+        self.batch = OnCommitBatch(self.runs.append)
+
+    def test_merged(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.batch.add([1, None])
+            self.batch.add([2])
+        with self.captureOnCommitCallbacks(execute=True):
+            self.batch.add([3])
+            self.batch.add()
+        self.assertEqual(self.runs, [{1, 2}, None])
+
+    def test_rolled_back(self):
+        # what a rolled back transaction added is not left for the next one
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            self.batch.add([1])
+            raise IntegrityError
+        with self.captureOnCommitCallbacks(execute=True):
+            self.batch.add([2])
+        self.assertEqual(self.runs, [{2}])
+
+
+class ProjectCostsTests(FleetTestData, TestCase):
+
+    def setUp(self):
+        author = User.objects.create(username='finance')
+        for quantity, cost in ((0, 50), (1, 100), (2, 150)):
+            UserCost.objects.create(record_author=author,
+                                    user_quantity=quantity,
+                                    user_cost=cost,
+                                    )
+        for storage_type, rate in (('Primary fileshare', 0.5), ('CPU', 40)):
+            StorageCost.objects.create(record_author=author,
+                                       storage_type=storage_type,
+                                       st_cost_per_gb=rate,
+                                       )
+
+    def test_costs(self):
+        host = self.add_node(1)
+        prj, done = host.project_set.order_by('dc_prj_id')
+        prj.requested_cpu = 8
+        prj.fileshare_storage = 100
+        prj.save()
+        done.status = 'CO'
+        done.fileshare_storage = 10
+        done.save()
+        costs = ProjectCosts(Project.objects.order_by('dc_prj_id'))
+        self.assertEqual(costs.save(), 2)
+        prj.refresh_from_db()
+        self.assertEqual(prj.user_cost, 100)
+        self.assertEqual(prj.host_cost, 80)
+        self.assertEqual(prj.project_total_cost, 230)
+        self.assertEqual(costs.grand_total, 235)
+        self.assertEqual(costs.rows()[1][2], ((0, 'CPUs', 0.0), (0, 'GB RAM', 0.0)))
+        # nothing to write when the inputs have not changed
+        self.assertEqual(ProjectCosts(Project.objects.all()).save(), 0)
+
+    def test_recompute_on_change(self):
+        host = self.add_node(1)
+        prj = host.project_set.first()
+        with self.captureOnCommitCallbacks(execute=True):
+            prj.users.add(self.jd)
+        prj.refresh_from_db()
+        self.assertEqual(prj.user_cost, 150)
+        with self.captureOnCommitCallbacks(execute=True):
+            UserCost.objects.filter(user_quantity=2).update(user_cost=175)
+            UserCost.objects.get(user_quantity=1).save()
+        prj.refresh_from_db()
+        self.assertEqual(prj.project_total_cost, 175)
+        # what a rolled back transaction scheduled is not left for the next one
+        other = host.project_set.exclude(pk=prj.pk).get()
+        Project.objects.filter(host=host).update(project_total_cost=0)
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            schedule_recompute([prj.pk])
+            raise IntegrityError
+        with self.captureOnCommitCallbacks(execute=True):
+            schedule_recompute([other.pk])
+        self.assertEqual(dict(Project.objects.filter(host=host
+                                    ).values_list('pk', 'project_total_cost')),
+                         {prj.pk: 0, other.pk: 100})
+
+    def test_finances_page(self):
+        for i in range(3):
+            self.add_node(i)
+        ProjectCosts(Project.objects.all()).save()
+        self.client.force_login(User.objects.get(username='finance'))
+        response = self.client.get(reverse('dc_management:finances-active'))
+        self.assertEqual(len(response.context['prj_data']), 6)
+        self.assertEqual(response.context['grand_total_cost'], 600)
+
+    def test_query_count_constant(self):
+        # projects and installed software; the rates are already loaded
+        RateTable.current()
+        for n in (1, 5):
+            for i in range(n):
+                self.add_node(n * 10 + i)
+            with self.assertNumQueries(2):
+                costs = ProjectCosts(Project.objects.all())
+            self.assertEqual(len(costs.rows()), Project.objects.count())
+
+    def test_createinvoices(self):
+        host = self.add_node(1)
+        prj, done = host.project_set.order_by('dc_prj_id')
+        prj.requested_cpu = 8
+        prj.fileshare_storage = 100
+        prj.save()
+        done.status = 'CO'
+        done.save()
+        out = StringIO()
+        call_command('createinvoices', 'finance', '--month', '2018-03', stdout=out)
+        self.assertIn('Created 1 invoices for March 2018', out.getvalue())
+        bill = ProjectBillingRecord.objects.get()
+        self.assertEqual(bill.project, prj)
+        self.assertEqual(bill.billing_date, datetime.date(2018, 3, 1))
+        self.assertEqual(bill.base_expense, 100)
+        self.assertEqual(bill.monthly_total(), 150)
+        self.assertEqual(bill.total, 150)
+        # running again for the same month creates nothing
+        call_command('createinvoices', 'finance', '--month', '2018-03', stdout=out)
+        self.assertIn('Created 0 invoices for March 2018', out.getvalue())
+        self.assertEqual(ProjectBillingRecord.objects.count(), 1)
+        # the total is kept current on save, for summing in the database
+        bill.multiplier = 2
+        bill.save()
+        self.assertEqual(ProjectBillingRecord.objects.aggregate(Sum('total')),
+                         {'total__sum': 300})
+
+    def test_createinvoices_billed_by_hand(self):
+        by_hand, classroom = self.add_node(1).project_set.order_by('dc_prj_id')
+        ProjectBillingRecord.objects.create(record_author=User.objects.get(username='finance'),
+                                            project=by_hand,
+                                            billing_date=datetime.date(2018, 3, 15),
+                                            base_expense=100)
+        classroom.env_type = 'CL'
+        classroom.save()
+        classroom.users.clear()
+        out = StringIO()
+        call_command('createinvoices', 'finance', '--month', '2018-03', stdout=out)
+        self.assertIn('Created 1 invoices for March 2018', out.getvalue())
+        self.assertIn('(1 already invoiced)', out.getvalue())
+        # a class without users pays the single user rate only
+        bill = ProjectBillingRecord.objects.get(invoice_month=datetime.date(2018, 3, 1))
+        self.assertEqual((bill.project, bill.base_rate), (classroom, 100))
+        # one invoice per project and month
+        bill.pk = None
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            bill.save()
+
+    def test_rate_snapshot(self):
+        prj = self.add_node(1).project_set.first()
+        self.assertEqual(RateTable.current().user_rates[2], 150)
+        # project, its software and its billable user count
+        with self.assertNumQueries(3):
+            form = ProjectBillingForm(ppk=prj.pk)
+        self.assertEqual(form.fields['base_expense'].initial, 100)
+        UserCost.objects.filter(user_quantity=1).get().delete()
+        self.assertNotIn(1, RateTable.current().user_rates)
+        # a change made by another process, whose cache this one does not
+        # share, is seen once the stamp expires
+        UserCost.objects.filter(user_quantity=2).update(user_cost=175)
+        self.assertEqual(RateTable.current().user_rates[2], 150)
+        self.assertEqual(caching.timeout(), caching.LOCAL_TIMEOUT)
+        cache.delete(RATES_VERSION_KEY)
+        self.assertEqual(RateTable.current().user_rates[2], 175)
+
+    def test_billing_rollup(self):
+        prj = self.add_node(1).project_set.first()
+        author = User.objects.get(username='finance')
+        for day, expense in ((1, 100), (15, 50), (40, 25)):
+            ProjectBillingRecord.objects.create(
+                        record_author=author,
+                        project=prj,
+                        billing_date=datetime.date(2018, 3, 1) + datetime.timedelta(days=day),
+                        base_expense=expense,
+                        account='A123',
+            )
+        out = StringIO()
+        call_command('billingreport', '--end', '2018-04', stdout=out)
+        self.assertEqual(out.getvalue().splitlines(), [
+                        'Account,Project,Month,Invoices,Total,DB setup',
+                        'A123,{},2018-03,2,150.0,'.format(prj.dc_prj_id),
+                        'A123,{},2018-04,1,25.0,'.format(prj.dc_prj_id),
+                        ])
+        self.client.force_login(author)
+        response = self.client.get(reverse('dc_management:finances-rollup'),
+                                   {'start': '2018-04', 'export': 'csv'})
+        self.assertEqual(b''.join(response.streaming_content).decode().splitlines()[1],
+                         'A123,{},2018-04,1,25.0,'.format(prj.dc_prj_id))
+        response = self.client.get(reverse('dc_management:finances-rollup'))
+        self.assertContains(response, 'Mar 2018')
+        self.assertEqual(response.context['grand_total'], 175)
+
+class DashboardTests(FleetTestData, TestCase):
+
+    def setUp(self):
+        cache.clear()
+
+    def add_dashboard_items(self, i):
+        """
+        a node whose projects appear in every dashboard section
+        """
+        today = datetime.date.today()
+        author, created = User.objects.get_or_create(username='dashboard')
+        access, created = AccessPermission.objects.get_or_create(name='all')
+        host = self.add_node(i)
+        expiring, shutting = host.project_set.order_by('dc_prj_id')
+        expiring.expected_completion = today
+        expiring.save()
+        expiring.dynamic_comments.create(record_author=author, comment='soon')
+        shutting.status = 'SD'
+        shutting.save()
+        for doc_type, expiry in (('IR', 5), ('DU', -5)):
+            doc = Governance_Doc.objects.create(record_author=author,
+                                        doc_id='d{}{}'.format(i, doc_type),
+                                        date_issued=today - datetime.timedelta(days=400),
+                                        expiry_date=today + datetime.timedelta(days=expiry),
+                                        access_allowed=access,
+                                        governance_type=doc_type,
+                                        project=expiring,
+                                        )
+            doc.users_permitted.add(self.js)
+        # the governance sections read the compliance scan
+        ComplianceScan(Project.objects.all()).save()
+        onboarding = Project.objects.create(dc_prj_id='o{:03d}'.format(i),
+                                title='onboarding project',
+                                pi=self.jd,
+                                env_subtype=self.env,
+                                expected_completion=today,
+                                requested_launch=today,
+                                status='ON',
+        )
+        MigrationLog.objects.create(record_author=author,
+                                    project=onboarding,
+                                    node_destination=host,
+                                    )
+        Project.objects.create(dc_prj_id='n{:03d}'.format(i),
+                                title='new project',
+                                pi=self.jd,
+                                env_subtype=self.env,
+                                expected_completion=today,
+                                requested_launch=today,
+                                status='ON',
+        )
+
+    def test_snapshot(self):
+        snapshot = None
+        for n in (1, 5):
+            for i in range(n):
+                self.add_dashboard_items(n * 10 + i)
+            # one query per section, plus one for each prefetch (project
+            # comments, users' projects, the users of all nodes)
+            with self.assertNumQueries(18):
+                snapshot = Dashboard().snapshot()
+                for s in snapshot['server_list']:
+                    s.duplicate_users()
+                for name in ('expiring_list', 'shutting_list'):
+                    for prj in snapshot[name]:
+                        prj.billable_user_count()
+                        prj.dynamic_comments.count()
+        self.assertEqual(len(snapshot['expiring_list']), 6)
+        self.assertEqual(len(snapshot['shutting_list']), 6)
+        self.assertEqual(len(snapshot['onboarding_prj_list']), 6)
+        self.assertEqual(len(snapshot['onboarding_list']), 6)
+        self.assertEqual(len(snapshot['undocumented_list']), 18)
+        self.assertEqual(len(snapshot['irb_invalid']), 0)
+        self.assertEqual(len(snapshot['dua_invalid']), 6)
+        self.assertEqual([gd.attention for gd in snapshot['attention_docs']],
+                         ['warning', 'danger'] * 6)
+        self.assertEqual(list(snapshot['undoc_user_list']), [self.js])
+        self.assertEqual(snapshot['expiring_list'][0].billable_user_count(), 1)
+
+    def test_section_timeout(self):
+        # sections outlive the process's own cache for a short time only
+        self.assertEqual(caching.timeout(SECTION_TIMEOUT), caching.LOCAL_TIMEOUT)
+        shared = {'default': {'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+                              'LOCATION': 'dc_cache'}}
+        with self.settings(CACHES=shared):
+            self.assertEqual(caching.timeout(SECTION_TIMEOUT), SECTION_TIMEOUT)
+            self.assertIsNone(caching.timeout())
+
+    def test_cached_sections(self):
+        self.add_dashboard_items(1)
+        Dashboard().snapshot()
+        with self.assertNumQueries(0):
+            snapshot = Dashboard().snapshot()
+            for s in snapshot['server_list']:
+                s.duplicate_users()
+        self.assertEqual(len(snapshot['onboarding_list']), 1)
+        # only the sections built from migrations are rebuilt
+        prj = Project.objects.get(dc_prj_id='n001')
+        author = User.objects.get(username='dashboard')
+        node = Server.objects.get(function='PR')
+        MigrationLog.objects.create(record_author=author,
+                                    project=prj,
+                                    node_destination=node)
+        with self.assertNumQueries(3):
+            snapshot = Dashboard().snapshot()
+        self.assertEqual(len(snapshot['onboarding_list']), 2)
+        self.assertEqual(len(snapshot['onboarding_prj_list']), 0)
+        # sections are kept per day
+        with self.assertNumQueries(17):
+            Dashboard(today=datetime.date.today() + datetime.timedelta(days=1)).snapshot()
+
+    def test_attention_annotation(self):
+        self.add_dashboard_items(1)
+        today = datetime.date.today()
+        irb = Governance_Doc.objects.get(doc_id='d1IR')
+        for doc_id, doc_type, expiry in (('far', 'IR', 200), ('dcua', 'DC', 5),
+                                         ('defers', 'DU', 5), ('soon', 'DU', 50),
+                                         ('renewal', 'IR', 400)):
+            Governance_Doc.objects.create(record_author=irb.record_author,
+                                          doc_id=doc_id,
+                                          date_issued=today,
+                                          expiry_date=today + datetime.timedelta(days=expiry),
+                                          access_allowed=irb.access_allowed,
+                                          governance_type=doc_type,
+                                          project=irb.project,
+                                          defers_to_doc=irb if doc_id == 'defers' else None,
+                                          supersedes_doc=irb if doc_id == 'renewal' else None,
+                                          )
+        expected = {gd.doc_id: gd.attention_required()
+                    for gd in Governance_Doc.objects.all()}
+        self.assertEqual(expected, {'d1IR': 'safe', 'd1DU': 'danger', 'far': 'safe',
+                                    'dcua': 'safe', 'defers': 'safe', 'soon': 'primary',
+                                    'renewal': 'safe'})
+        with self.assertNumQueries(1):
+            docs = list(Governance_Doc.objects.with_attention())
+            self.assertEqual({gd.doc_id: gd.attention_required() for gd in docs},
+                             expected)
+            self.assertEqual([gd.doc_id for gd in docs if gd.is_superseded()], ['d1IR'])
+        # a document without an expiry date needs no attention
+        self.assertEqual(Governance_Doc(expiry_date=None).attention_required(), 'safe')
+
+
+class ComplianceTests(FleetTestData, TestCase):
+
+    def setUp(self):
+        self.author = User.objects.create_user('compliance')
+        self.access = AccessPermission.objects.create(name='all')
+
+    def add_doc(self, prj, doc_type, expiry, users=()):
+        doc = Governance_Doc.objects.create(record_author=self.author,
+                                doc_id='{}{}'.format(doc_type, expiry),
+                                date_issued=datetime.date.today(),
+                                expiry_date=datetime.date.today() + datetime.timedelta(days=expiry),
+                                access_allowed=self.access,
+                                governance_type=doc_type,
+                                project=prj,
+                                )
+        doc.users_permitted.add(*users)
+        return doc
+
+    def test_scan(self):
+        for n in (1, 5):
+            for i in range(n):
+                prj, other = self.add_node(n * 10 + i).project_set.order_by('dc_prj_id')
+                self.add_doc(prj, 'IR', 30, [self.js])
+                self.add_doc(prj, 'DU', -1, [self.js, self.jd])
+                self.add_doc(prj, 'DC', 30, [self.jd])
+            # projects, current document types, users and named people
+            with self.assertNumQueries(4):
+                scan = ComplianceScan(Project.objects.all())
+        statuses = {s.project_id: s for s in scan.statuses}
+        self.assertEqual(len(statuses), 12)
+        status = statuses[prj.pk]
+        self.assertEqual((status.irb_valid, status.has_dua, status.dua_valid,
+                          status.documented, status.users_without_dcua),
+                         (True, True, False, True, 1))
+        status = statuses[other.pk]
+        self.assertEqual((status.irb_valid, status.documented, status.users_without_dcua),
+                         (False, False, 1))
+        users = {(u.project_id, u.person_id): u for u in scan.user_statuses}
+        self.assertEqual(len(users), 12 + 6)
+        js, jd = users[(prj.pk, self.js.pk)], users[(prj.pk, self.jd.pk)]
+        self.assertEqual((js.on_project, js.irb, js.dua, js.dcua, js.validated),
+                         (True, True, True, False, False))
+        self.assertEqual((jd.on_project, jd.dcua_current, jd.validated),
+                         (False, True, False))
+        self.assertEqual(scan.save(), 12)
+        self.assertEqual(UserComplianceStatus.objects.count(), 18)
+        # replacing the rows bumps the dashboard generation once, not per row
+        key = generation_key(ComplianceStatus)
+        generation = cache.get(key, 0)
+        ComplianceScan(Project.objects.all()).save()
+        self.assertEqual(cache.get(key), generation + 1)
+        # and deletes them without fetching them
+        for model in (ComplianceStatus, UserComplianceStatus):
+            self.assertTrue(Collector(using='default').can_fast_delete(model.objects.all()))
+        out = StringIO()
+        call_command('scancompliance', prj.dc_prj_id, stdout=out)
+        self.assertIn('{}: no current DUA, 1 users without a current DCUA'.format(
+                                                        prj.dc_prj_id), out.getvalue())
+
+    def test_not_scanned(self):
+        prj, other = self.add_node(1).project_set.order_by('dc_prj_id')
+        self.add_doc(prj, 'IR', 30, [self.js])
+        self.assertFalse(ComplianceStatus.objects.exists())
+        # projects not scanned yet are checked against their documents
+        dashboard = Dashboard()
+        self.assertEqual(dashboard.irb_invalid(), [other])
+        self.assertEqual(dashboard.undocumented_list(), [other])
+        self.assertEqual(dashboard.dua_invalid(), [])
+        # and the project page works their compliance out without saving it
+        self.client.force_login(self.author)
+        response = self.client.get(reverse('dc_management:project', args=[prj.pk]))
+        self.assertEqual(response.context['irb_users'], [self.js])
+        self.assertFalse(ComplianceStatus.objects.exists())
+        self.assertFalse(UserComplianceStatus.objects.exists())
+
+    def test_follows_changes(self):
+        prj = self.add_node(1).project_set.order_by('dc_prj_id').first()
+        with self.captureOnCommitCallbacks(execute=True):
+            irb = self.add_doc(prj, 'IR', 30, [self.js])
+        self.assertTrue(prj.compliance.irb_valid)
+        self.assertEqual(prj.compliance.users_without_dcua, 1)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.add_doc(prj, 'DC', 30, [self.js])
+            irb.delete()
+        prj.refresh_from_db()
+        self.assertFalse(prj.compliance.irb_valid)
+        self.assertEqual(prj.compliance.users_without_dcua, 0)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.jd.project_set.add(prj)
+        self.assertEqual(ComplianceStatus.objects.get(project=prj).users_without_dcua, 1)
+
+
+class DocumentServingTests(FleetTestData, TestCase):
+
+    def setUp(self):
+        self.media = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media)
+        media = override_settings(MEDIA_ROOT=self.media)
+        media.enable()
+        self.addCleanup(media.disable)
+        prj = self.add_node(1).project_set.order_by('dc_prj_id').first()
+        author = User.objects.create_user('reader')
+        self.doc = Governance_Doc(record_author=author, doc_id='irb1',
+                                  date_issued=datetime.date.today(),
+                                  expiry_date=datetime.date.today(),
+                                  access_allowed=AccessPermission.objects.create(name='all'),
+                                  governance_type='IR', project=prj)
+        self.doc.documentation.save('packet.pdf', ContentFile(b'0123456789'))
+        self.client.force_login(author)
+        self.url = reverse('dc_management:govdoc', args=[self.doc.pk])
+
+    def test_streamed_ranges(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        self.assertEqual(b''.join(response.streaming_content), b'0123456789')
+        self.assertEqual(response['Content-Type'], 'application/pdf')
+        self.assertEqual(response['Content-Disposition'], 'inline; filename="packet.pdf"')
+        self.assertEqual(response['Accept-Ranges'], 'bytes')
+        etag = response['ETag']
+        for header, expected in (('bytes=2-5', b'2345'), ('bytes=7-', b'789'),
+                                 ('bytes=-3', b'789'), ('bytes=8-20', b'89')):
+            response = self.client.get(self.url, HTTP_RANGE=header, HTTP_IF_RANGE=etag)
+            self.assertEqual(response.status_code, 206)
+            self.assertEqual(b''.join(response.streaming_content), expected)
+        self.assertEqual(response['Content-Range'], 'bytes 8-9/10')
+        # a stale If-Range gets the whole file
+        response = self.client.get(self.url, HTTP_RANGE='bytes=2-5', HTTP_IF_RANGE='"old"')
+        self.assertEqual(response.status_code, 200)
+        response = self.client.get(self.url, HTTP_RANGE='bytes=10-')
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response['Content-Range'], 'bytes */10')
+        # an invalid range is ignored
+        response = self.client.get(self.url, HTTP_RANGE='bytes=5-3')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b''.join(response.streaming_content), b'0123456789')
+
+    def test_conditional(self):
+        response = self.client.get(self.url)
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+        response = self.client.get(self.url,
+                                   HTTP_IF_MODIFIED_SINCE=response['Last-Modified'])
+        self.assertEqual(response.status_code, 304)
+        self.doc.documentation.delete(save=True)
+        self.assertEqual(self.client.get(self.url).status_code, 404)
+
+    def test_sendfile(self):
+        with self.settings(DC_SENDFILE='X-Accel-Redirect', DC_SENDFILE_PREFIX='/protected/'):
+            response = self.client.get(self.url)
+        self.assertEqual(response['X-Accel-Redirect'], '/protected/p0010/packet.pdf')
+        self.assertEqual(response.content, b'')
+        with self.settings(DC_SENDFILE='X-Sendfile'):
+            response = self.client.get(self.url)
+        self.assertEqual(response['X-Sendfile'], self.doc.documentation.path)
+
+    def test_deduplicated_storage(self):
+        def copy(doc_id, prj):
+            doc = Governance_Doc.objects.get(pk=self.doc.pk)
+            doc.pk, doc.doc_id, doc.project = None, doc_id, prj
+            return doc
+        prj2, prj3 = self.add_node(2).project_set.order_by('dc_prj_id')[:2]
+        doc2 = copy('irb2', prj2)
+        doc2.documentation.save('copy.pdf', ContentFile(b'0123456789'))
+        self.assertEqual(doc2.documentation.name, 'p0020/copy.pdf')
+        self.assertTrue(os.path.samefile(doc2.documentation.path, self.doc.documentation.path))
+        # saving the same content under a name already linked to it reuses it
+        doc2.documentation.save('copy.pdf', ContentFile(b'0123456789'))
+        self.assertEqual(doc2.documentation.name, 'p0020/copy.pdf')
+        doc2.documentation.save('copy.pdf', ContentFile(b'changed'))
+        self.assertNotEqual(doc2.documentation.name, 'p0020/copy.pdf')
+
+        # a copy saved before the storage, and a blob left by a deleted upload
+        doc3 = copy('irb3', prj3)
+        doc3.documentation.name = 'p0021/old.pdf'
+        doc3.save()
+        os.makedirs(os.path.join(self.media, 'p0021'))
+        with open(doc3.documentation.path, 'wb') as fh:
+            fh.write(b'0123456789')
+        doc2.documentation.delete()
+        # a blob just stored may be about to be linked: it is kept for now
+        out = StringIO()
+        call_command('dedupemedia', '--dry-run', stdout=out)
+        self.assertIn('0 unreferenced blobs removed', out.getvalue())
+        for directory, dirs, files in os.walk(os.path.join(self.media, 'blobs')):
+            for filename in files:
+                os.utime(os.path.join(directory, filename), (0, 0))
+        out = StringIO()
+        call_command('dedupemedia', '--dry-run', stdout=out)
+        self.assertIn('Dry run: 2 files scanned (0 missing), 1 duplicates linked, '
+                      '1 unreferenced blobs removed: 17 bytes', out.getvalue())
+        call_command('dedupemedia', stdout=out)
+        self.assertTrue(os.path.samefile(doc3.documentation.path, self.doc.documentation.path))
+        out = StringIO()
+        call_command('dedupemedia', stdout=out)
+        self.assertIn('0 duplicates linked, 0 unreferenced blobs removed: 0 bytes',
+                      out.getvalue())
+
+
+@override_settings(DC_TEXT_EXTRACTION_WORKERS=0)
+class TextExtractionTests(FleetTestData, TestCase):
+
+    def setUp(self):
+        self.media = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media)
+        media = override_settings(MEDIA_ROOT=self.media)
+        media.enable()
+        self.addCleanup(media.disable)
+        self.projects = list(self.add_node(1).project_set.order_by('dc_prj_id'))
+        self.author = User.objects.create_user('extractor')
+        self.access = AccessPermission.objects.create(name='all')
+
+    def upload(self, doc_id, prj, filename, content):
+        doc = Governance_Doc(record_author=self.author, doc_id=doc_id,
+                             date_issued=datetime.date.today(),
+                             expiry_date=datetime.date.today(),
+                             access_allowed=self.access,
+                             governance_type='IR', project=prj)
+        with self.captureOnCommitCallbacks(execute=True):
+            doc.documentation.save(filename, ContentFile(content))
+        doc.refresh_from_db()
+        return doc
+
+    def docx(self, body, header):
+        w = 'xmlns:w="http://schemas.openxmlformats.org/wordprocessingml/2006/main"'
+        data = BytesIO()
+        with zipfile.ZipFile(data, 'w') as docx:
+            docx.writestr('word/document.xml',
+                          '<w:document {}><w:body><w:p><w:r><w:t>{}</w:t></w:r>'
+                          '<w:r><w:tab/><w:t>approved</w:t></w:r></w:p>'
+                          '</w:body></w:document>'.format(w, body))
+            docx.writestr('word/header1.xml',
+                          '<w:hdr {}><w:p><w:r><w:t>{}</w:t></w:r></w:p></w:hdr>'.format(
+                                                                            w, header))
+        return data.getvalue()
+
+    def search(self, query):
+        group = next(SearchResults(query, PythonBackend(), kinds=['govdoc']).groups())
+        return group.hits
+
+    def test_docx(self):
+        content = self.docx('Protocol 1807019456', 'PI Jane Quimby')
+        doc = self.upload('irb1', self.projects[0], 'irb.docx', content)
+        self.assertEqual(doc.document_text.text,
+                         'Protocol 1807019456\tapproved\nPI Jane Quimby')
+        self.assertEqual(self.search('1807019456'), [doc.pk])
+        self.assertEqual(self.search('quimby'), [doc.pk])
+        # the file of a document whose metadata changed is not read again
+        with mock.patch('dc_management.textextract.file_digest') as digest:
+            with self.captureOnCommitCallbacks(execute=True):
+                doc.doc_id = 'irb1a'
+                doc.save()
+        digest.assert_not_called()
+
+        # the same content for another project is not parsed again
+        other = self.upload('irb2', self.projects[1], 'copy.docx', content)
+        self.assertEqual(other.document_text, doc.document_text)
+        self.assertEqual(sorted(self.search('quimby')), [doc.pk, other.pk])
+        self.assertEqual(extract_documents(Governance_Doc.objects.all()), 0)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            other.documentation.save('new.docx', ContentFile(b'not a zip'))
+        other.refresh_from_db()
+        self.assertIn('BadZipFile', other.document_text.error)
+        self.assertEqual(self.search('quimby'), [doc.pk])
+        out = StringIO()
+        call_command('extracttext', '--retry', '--workers', '1', stdout=out, stderr=StringIO())
+        self.assertIn('1 files parsed, 1 failed, 0 unused texts removed', out.getvalue())
+
+    @unittest.skipIf(PdfReader is None, 'pypdf is not installed')
+    def test_pdf(self):
+        stream = b'BT /F1 12 Tf 72 720 Td (IRB protocol 2101023344) Tj ET'
+        objects = [b'<< /Type /Catalog /Pages 2 0 R >>',
+                   b'<< /Type /Pages /Kids [3 0 R] /Count 1 >>',
+                   b'<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] '
+                   b'/Contents 4 0 R /Resources << /Font << /F1 5 0 R >> >> >>',
+                   b'<< /Length %d >>\nstream\n%s\nendstream' % (len(stream), stream),
+                   b'<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>']
+        pdf = b'%PDF-1.4\n'
+        offsets = []
+        for i, obj in enumerate(objects, 1):
+            offsets.append(len(pdf))
+            pdf += b'%d 0 obj\n%s\nendobj\n' % (i, obj)
+        xref = len(pdf)
+        pdf += b'xref\n0 %d\n0000000000 65535 f \n' % (len(objects) + 1)
+        pdf += b''.join(b'%010d 00000 n \n' % offset for offset in offsets)
+        pdf += b'trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n' % (
+                                                                len(objects) + 1, xref)
+        doc = self.upload('irb1', self.projects[0], 'irb.pdf', pdf)
+        self.assertIn('IRB protocol 2101023344', doc.document_text.text)
+        self.assertEqual(self.search('2101023344'), [doc.pk])
+
+
+class ProjectViewTests(FleetTestData, TestCase):
+
+    def add_project_records(self, prj, i):
+        """
+        a user on the project with an access log, governance documents,
+        storage and software logs, a comment thread and a bill
+        """
+        author, created = User.objects.get_or_create(username='projectview')
+        access, created = AccessPermission.objects.get_or_create(name='all')
+        today = datetime.date.today()
+        user = Person.objects.create(first_name='User', last_name=str(i),
+                                     cwid='usr{:04d}'.format(i))
+        prj.users.add(user)
+        Access_Log.objects.create(record_author=author, date_changed=today,
+                                  dc_user=user, prj_affected=prj)
+        for doc_type in ('IR', 'DC'):
+            doc = Governance_Doc.objects.create(record_author=author,
+                                        doc_id='g{}{}'.format(i, doc_type),
+                                        date_issued=today,
+                                        expiry_date=today + datetime.timedelta(days=30),
+                                        access_allowed=access,
+                                        governance_type=doc_type,
+                                        project=prj,
+                                        )
+            doc.users_permitted.add(user)
+        storage = StorageCost.objects.create(record_author=author,
+                                             storage_type='Primary fileshare',
+                                             st_cost_per_gb=0.5)
+        Storage_Log.objects.create(record_author=author, project=prj,
+                                   storage_amount=i, storage_type=storage)
+        lic, created = Software_License_Type.objects.get_or_create(name='site',
+                                                   user_assigned=False,
+                                                   concurrent=True,
+                                                   monitored=False,
+                                                   )
+        software = Software.objects.create(name='sw{}'.format(i), license_type=lic)
+        prj.software_installed.add(software)
+        Software_Log.objects.create(record_author=author, applied_to_prj=prj,
+                                    software_changed=software)
+        comment = CommentLog.objects.create(record_author=author, comment='c')
+        prj.dynamic_comments.add(comment)
+        CommentLog.objects.create(record_author=author, comment='r',
+                                  parent_comment=comment)
+        ProjectBillingRecord.objects.create(record_author=author, project=prj,
+                                            billing_date=datetime.date(2018, 1, i))
+
+    def test_query_count_constant(self):
+        host = self.add_node(1)
+        prj = host.project_set.order_by('dc_prj_id').first()
+        self.client.force_login(User.objects.create_user('viewer'))
+        url = reverse('dc_management:project', args=[prj.pk])
+        for n in (1, 5):
+            # the changes schedule a compliance scan of the project
+            with self.captureOnCommitCallbacks(execute=True):
+                for i in range(n):
+                    self.add_project_records(prj, n * 5 + i)
+            # session and user, the project and one query per prefetched
+            # relation, node index, governance documents, compliance and bills
+            with self.assertNumQueries(20):
+                response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context['project'].billable_user_count(), 7)
+        self.assertEqual(len(response.context['fully_validated']), 6)
+        self.assertEqual(len(response.context['unconnected_users']), 0)
+        self.assertEqual(len(response.context['bill_zip']), 6)
+
+    def test_log_pages(self):
+        host = self.add_node(1)
+        prj = host.project_set.order_by('dc_prj_id').first()
+        author = User.objects.create_user('viewer')
+        self.client.force_login(author)
+        logs = [Access_Log.objects.create(record_author=author,
+                                          date_changed=datetime.date.today(),
+                                          dc_user=self.js,
+                                          prj_affected=prj,
+                                          ) for i in range(30)]
+        url = reverse('dc_management:log-page', args=['project', prj.pk, 'access'])
+        # session and user, then the page itself
+        with self.assertNumQueries(3):
+            response = self.client.get(url)
+        first = response.context['page']
+        self.assertEqual(first.rows, logs[:-26:-1])
+        response = self.client.get(response.context['next_url'])
+        self.assertEqual(response.context['page'].rows, logs[4::-1])
+        self.assertIsNone(response.context['next_url'])
+        response = self.client.get(url, {'after': 'yesterday'})
+        self.assertEqual(response.status_code, 404)
+
+class SearchTests(FleetTestData, TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        # outside the test transactions, which FTS5 tables do not survive
+        install_search_index(connection)
+        super().setUpClass()
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        uninstall_search_index(connection)
+
+    def setUp(self):
+        cache.clear()
+        host = self.add_node(1)
+        self.first, self.second = host.project_set.order_by('dc_prj_id')
+        author = User.objects.create_user('searcher')
+        self.comment = CommentLog.objects.create(record_author=author,
+                                                 comment='Radiology pilot for Smith')
+        self.second.dynamic_comments.add(self.comment)
+
+    def backends(self):
+        backends = [PythonBackend()]
+        if FTS_TABLE in connection.introspection.table_names():
+            backends.append(SQLiteFTSBackend())
+        return backends
+
+    def search(self, query, backend):
+        return [(group.kind, pk) for group in SearchResults(query, backend).groups()
+                for pk in group.hits]
+
+    def test_ranked_matches(self):
+        for backend in self.backends():
+            # a group per source, in source order
+            self.assertEqual(self.search('smith', backend),
+                             [('project', self.second.pk), ('person', self.js.pk),
+                              ('comment', self.comment.pk)])
+            # every word must match, each as a prefix
+            self.assertEqual(self.search('radio smi', backend),
+                             [('project', self.second.pk), ('comment', self.comment.pk)])
+            self.assertEqual(self.search('test p0010', backend),
+                             [('project', self.first.pk)])
+            self.assertEqual(self.search('nothing', backend), [])
+
+    def test_index_follows_changes(self):
+        self.first.title = 'renamed'
+        self.first.save()
+        self.second.dynamic_comments.clear()
+        self.js.delete()
+        for backend in self.backends():
+            self.assertEqual(self.search('renamed', backend), [('project', self.first.pk)])
+            self.assertEqual(self.search('radiology', backend),
+                             [('comment', self.comment.pk)])
+            self.assertEqual(self.search('smith', backend),
+                             [('comment', self.comment.pk)])
+        # the index only re-reads the entries of the objects changed
+        self.second.title = 'retitled'
+        self.second.save()
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(self.search('retitled', PythonBackend()),
+                             [('project', self.second.pk)])
+        reads = [q['sql'] for q in queries if 'searchentry' in q['sql']]
+        self.assertEqual(len(reads), 1)
+        self.assertIn('WHERE', reads[0])
+        rebuild_index()
+        self.assertEqual(self.search('renamed', PythonBackend()), [('project', self.first.pk)])
+        # a deleted comment no longer finds the projects it was on
+        self.second.dynamic_comments.add(self.comment)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.comment.delete()
+        for backend in self.backends():
+            self.assertEqual(self.search('radiology', backend), [])
+
+    def test_log_sources(self):
+        log = Access_Log.objects.create(record_author=self.comment.record_author,
+                                        sn_ticket='RITM0012345',
+                                        date_changed=datetime.date(2020, 1, 1),
+                                        dc_user=self.js, prj_affected=self.first)
+        for backend in self.backends():
+            self.assertEqual(self.search('ritm0012', backend), [('access_log', log.pk)])
+        group = next(SearchResults('ritm0012', kinds=['access_log']).groups())
+        page, hits = group.page()
+        self.assertEqual([(h.obj, h.tickets, h.projects) for h in hits],
+                         [(log, ['RITM0012345'], [self.first])])
+        self.client.force_login(log.record_author)
+        response = self.client.get(reverse('dc_management:full-search'),
+                                   {'srch_term': 'RITM0012345'})
+        content = b''.join(response.streaming_content).decode()
+        self.assertIn('<h2>Access Logs (1)</h2>', content)
+        self.assertIn(reverse('dc_management:project', args=[self.first.pk]), content)
+
+    def test_time_budget(self):
+        for backend in self.backends():
+            groups = list(SearchResults('smith', backend, budget=0).groups())
+            self.assertEqual(len(groups), len(SOURCES))
+            self.assertTrue(all(g.timed_out and not g.hits for g in groups))
+
+    def test_view(self):
+        self.client.force_login(User.objects.get(username='searcher'))
+        response = self.client.post(reverse('dc_management:full-search'),
+                                    {'srch_term': 'test'})
+        self.assertTrue(response.streaming)
+        content = b''.join(response.streaming_content).decode()
+        self.assertIn('<h2>Projects (2)</h2>', content)
+        self.assertIn('<h2>Users (0)</h2>', content)
+        self.assertLess(content.index('Projects (2)'), content.index('Comments (0)'))
+        response = self.client.get(reverse('dc_management:full-search'),
+                                   {'srch_term': 'j', 'kind': 'person', 'page': 2})
+        content = b''.join(response.streaming_content).decode()
+        self.assertIn('<h2>Users (2)</h2>', content)
+        self.assertNotIn('<h2>Projects', content)
+        response = self.client.get(reverse('dc_management:full-search'),
+                                   {'srch_term': 'j', 'kind': 'nothing'})
+        self.assertEqual(response.status_code, 404)
+
+
+class NameIndexTests(FleetTestData, TestCase):
+
+    def setUp(self):
+        # a fresh version, so the index reloads from this test's rows
+        cache.clear()
+
+    def test_lookup(self):
+        doe = Person.objects.create(first_name='Zed', last_name='Zulu', cwid='doe')
+        # exact identifier first, then by last name
+        self.assertEqual(PERSON_INDEX.lookup('doe'), [doe, self.jd])
+        self.assertEqual(PERSON_INDEX.lookup('J'), [self.jd, self.js])
+        self.assertEqual(PERSON_INDEX.lookup('smi jo'), [self.js])
+        self.assertEqual(PERSON_INDEX.lookup('jos1234'), [self.js])
+        self.assertEqual(PERSON_INDEX.lookup('nobody'), [])
+        self.assertEqual(PERSON_INDEX.lookup('', limit=2), [self.jd, self.js])
+
+    def test_follows_changes(self):
+        self.assertEqual(PERSON_INDEX.lookup('smith'), [self.js])
+        # what a lookup in another thread holds is not changed under it
+        keys, names = index = PERSON_INDEX._index
+        before = (list(keys), dict(names))
+        self.js.last_name = 'Jones'
+        self.js.save()
+        self.jd.delete()
+        # only the changed rows are read again
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(PERSON_INDEX.lookup('smith'), [])
+        self.assertEqual(len(queries), 1)
+        self.assertIn(' IN (', queries[0]['sql'])
+        self.assertEqual(PERSON_INDEX.lookup('jo'), [self.js])
+        self.assertEqual(PERSON_INDEX.lookup('jed'), [])
+        self.assertEqual((keys, names), before)
+        self.assertIsNot(PERSON_INDEX._index, index)
+
+    def test_view(self):
+        self.client.force_login(User.objects.create_user('typist'))
+        response = self.client.get(reverse('dc_management:autocomplete-user'),
+                                   {'q': 'jos'})
+        self.assertEqual([r['id'] for r in response.json()['results']],
+                         [str(self.js.pk)])
+        response = self.client.get(reverse('dc_management:autocomplete-djuser'),
+                                   {'q': 'TYP'})
+        self.assertEqual(len(response.json()['results']), 1)
+
+
+class PersonImportTests(FleetTestData, TestCase):
+
+    CSV = ('cwid,First Name,last_name,role,comments\r\n'
+           'abc1001,Ann,"Lee, Jr",Researcher,"first line\nsecond line"\r\n'
+           '\r\n'
+           'jos1234,John,Smithson,,\r\n'
+           'abc1002,Bob,Ray,Astronaut,\r\n'
+           'abc1001,Ann,Again,,\r\n'
+           'abc1003,,Nobody,,\r\n'
+           'abc1004,Cy,Young\r\n'
+           'abc1005,Dee,Quist,researcher,\r\n')
+
+    def setUp(self):
+        cache.clear()
+        Role.objects.create(name='Researcher')
+
+    def run_import(self, data, **kwargs):
+        with self.captureOnCommitCallbacks(execute=True):
+            return PersonImport(BytesIO(data.encode()), 'bulk', batch_size=2, **kwargs).run()
+
+    def test_import(self):
+        result = self.run_import(self.CSV)
+        self.assertEqual([(r.line, r.cwid, r.status) for r in result.rows],
+                         [(2, 'abc1001', 'created'), (5, 'jos1234', 'exists'),
+                          (6, 'abc1002', 'invalid'), (7, 'abc1001', 'invalid'),
+                          (8, 'abc1003', 'invalid'), (9, 'abc1004', 'invalid'),
+                          (10, 'abc1005', 'created')])
+        self.assertEqual(result.rows[3].message, 'cwid already on line 2')
+        self.assertIn("no role named 'Astronaut'", result.rows[2].message)
+        ann = Person.objects.get(cwid='abc1001')
+        self.assertEqual((ann.last_name, ann.role.name, ann.comments),
+                         ('Lee, Jr', 'Researcher', 'first line\nsecond line\nbulk'))
+        self.assertEqual(Person.objects.get(cwid='jos1234').last_name, 'Smith')
+        # the new people are searchable and in the autocomplete
+        self.assertEqual(PERSON_INDEX.lookup('quist'), [Person.objects.get(cwid='abc1005')])
+        group = next(SearchResults('lee', PythonBackend(), kinds=['person']).groups())
+        self.assertEqual(group.hits, [ann.pk])
+
+        result = self.run_import(self.CSV, update=True)
+        self.assertEqual(result.counts()['updated'], 3)
+        self.assertEqual(Person.objects.get(cwid='jos1234').last_name, 'Smithson')
+
+    def test_update_columns(self):
+        Person.objects.create(cwid='abc4001', first_name='Hal', last_name='Old',
+                              affiliation='WCM', role=Role.objects.get(), comments='keep me')
+        result = self.run_import('cwid,first_name,last_name\nabc4001,Hal,New\n', update=True)
+        self.assertEqual(result.counts(), {'updated': 1})
+        # the columns the file does not have are left alone, and the comment
+        # is appended to the person's
+        hal = Person.objects.get(cwid='abc4001')
+        self.assertEqual((hal.last_name, hal.affiliation, hal.role.name, hal.comments),
+                         ('New', 'WCM', 'Researcher', 'keep me\nbulk'))
+        self.assertEqual(PERSON_INDEX.lookup('new'), [hal])
+
+    def test_no_header(self):
+        result = self.run_import('Eve,Ng,abc2001,,,"a, b"\nFay,Oh,abc2002,,,\n')
+        self.assertEqual(result.counts(), {'created': 2})
+        self.assertEqual(Person.objects.get(cwid='abc2001').comments, 'a, b\nbulk')
+
+    def test_command_and_view(self):
+        with tempfile.NamedTemporaryFile('w', suffix='.csv') as csv_file:
+            csv_file.write(self.CSV)
+            csv_file.flush()
+            with self.assertRaisesMessage(CommandError, '4 invalid rows: nothing imported'):
+                call_command('importpeople', csv_file.name, '--strict',
+                             stdout=StringIO(), stderr=StringIO())
+            self.assertFalse(Person.objects.filter(cwid='abc1001').exists())
+            out = StringIO()
+            call_command('importpeople', csv_file.name, stdout=out, stderr=StringIO())
+            self.assertIn('2 created, 0 updated, 1 skipped, 4 invalid', out.getvalue())
+
+        self.client.force_login(User.objects.create_user('uploader'))
+        upload = SimpleUploadedFile('users.csv', b'Gus,Ito,abc3001,,Researcher,\n')
+        response = self.client.post(reverse('dc_management:bulkuserupload'),
+                                    {'users_csv': upload, 'comment': 'web'})
+        self.assertContains(response, '1 users created')
+        self.assertEqual(Person.objects.get(cwid='abc3001').comments, 'web')
+
+
+class MembershipTests(FleetTestData, TestCase):
+
+    def setUp(self):
+        self.author = User.objects.create_user('onboarder')
+        self.projects = list(self.add_node(1).project_set.order_by('dc_prj_id'))
+        self.students = [Person.objects.create(first_name='Student', last_name=str(i),
+                                               cwid='stu{:04d}'.format(i))
+                         for i in range(20)]
+
+    def test_add_and_remove(self):
+        # js is already on both projects of the node
+        with self.assertNumQueries(9):
+            added = add_users(self.projects, [self.js] + self.students[:2], self.author)
+        self.assertEqual(added, {prj: self.students[:2] for prj in self.projects})
+        # the same queries for ten times the users
+        with self.assertNumQueries(9):
+            add_users(self.projects, self.students[2:], self.author)
+        self.assertEqual(Access_Log.objects.filter(change_type='AA').count(), 40)
+        self.assertEqual(DataCoreUserAgreement.objects.filter(
+                                        project=self.projects[0]).count(), 20)
+
+        removed = remove_users(self.projects[:1], [self.jd] + self.students[:3], self.author)
+        self.assertEqual(removed, {self.projects[0]: self.students[:3]})
+        self.assertEqual(self.projects[0].users.count(), 18)
+        self.assertEqual(self.projects[1].users.count(), 21)
+        self.assertEqual(Access_Log.objects.filter(change_type='RA').count(), 3)
+
+    def test_view(self):
+        self.client.force_login(self.author)
+        response = self.client.post(
+                        reverse('dc_management:usertothisproject-add', args=[self.projects[0].pk]),
+                        {'dcusers': [self.js.pk, self.students[0].pk],
+                         'projects': [p.pk for p in self.projects],
+                         'locations_allowed': 'WorkArea'})
+        self.assertRedirects(response, reverse('dc_management:sendtest'),
+                             fetch_redirect_response=False)
+        email = json.loads(self.client.session['email_json'])
+        self.assertEqual(email['subject'], 'Add users to {}, {}'.format(*self.projects))
+        self.assertIn('For the following 1 users', email['body'])
+        self.assertIn('Student 0 ; WorkArea-stu0000 ; (RWX)', email['body'])
+        self.assertEqual(DataCoreUserAgreement.objects.get(
+                            project=self.projects[1]).locations_allowed, 'WorkArea')
+
+        response = self.client.post(
+                        reverse('dc_management:usertothisproject-remove', args=[self.projects[0].pk]),
+                        {'dcusers': [self.students[0].pk],
+                         'projects': [p.pk for p in self.projects]})
+        email = json.loads(self.client.session['email_json'])
+        self.assertEqual(email['body'].count('Student 0'), 2)
+        self.assertFalse(Project.users.through.objects.filter(person=self.students[0]).exists())
+
+
+class StubGraphHandler(BaseHTTPRequestHandler):
+    """
+    The token, /me, sendMail and $batch endpoints. Tokens are numbered and
+    expire in server.expires_in seconds (refresh token grants get a new
+    refresh token too); tokens in server.revoked get a 401.
+    Messages with a subject starting 'busy' get a 503 the first time, 'bad'
+    a 400.
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def respond(self, status, payload=None):
+        payload = json.dumps(payload).encode() if payload is not None else b''
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def send_mail(self, url, message):
+        self.server.sent.append(url)
+        subject = message['message']['subject']
+        status = 202
+        if subject.startswith('bad'):
+            status = 400
+        elif subject.startswith('busy') and subject not in self.server.seen:
+            status = 503
+        self.server.seen.add(subject)
+        return status
+
+    def revoked(self):
+        return self.headers.get('Authorization', '')[len('Bearer '):] in self.server.revoked
+
+    def do_GET(self):
+        self.server.calls.append((self.path.split('?')[0], self.headers.get('Authorization'),
+                                  self.client_address))
+        if self.revoked():
+            return self.respond(401, {'error': {'code': 'InvalidAuthenticationToken'}})
+        self.respond(200, {'displayName': 'Ops', 'mail': 'ops@example.org'})
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        self.server.calls.append((self.path, self.headers.get('Authorization'),
+                                  self.client_address))
+        if self.path == '/token':
+            if self.server.barrier:
+                self.server.barrier.wait()
+            with self.server.lock:
+                self.server.tokens += 1
+                token = 'tok{}'.format(self.server.tokens)
+            payload = {'access_token': token, 'expires_in': self.server.expires_in}
+            if parse_qs(body.decode()).get('grant_type') == ['refresh_token']:
+                payload['refresh_token'] = 'refresh{}'.format(self.server.tokens)
+            return self.respond(200, payload)
+        if self.revoked():
+            return self.respond(401, {'error': {'code': 'InvalidAuthenticationToken'}})
+        if self.path != '/$batch':
+            return self.respond(self.send_mail(self.path, json.loads(body)))
+        responses = []
+        for request in json.loads(body)['requests']:
+            status = self.send_mail(request['url'], request['body'])
+            response = {'id': request['id'], 'status': status, 'headers': {}}
+            if status == 503:
+                response['headers'] = {'Retry-After': '5'}
+                response['body'] = {'error': {'code': 'ServiceUnavailable'}}
+            responses.append(response)
+        # answered in any order
+        self.respond(200, {'responses': responses[::-1]})
+
+    def log_message(self, *args):
+        pass
+
+
+class StubGraphTestCase(TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), StubGraphHandler)
+        self.server.calls = []
+        self.server.sent = []
+        self.server.seen = set()
+        self.server.revoked = set()
+        self.server.tokens = 0
+        self.server.expires_in = 3600
+        self.server.barrier = None
+        self.server.lock = threading.Lock()
+        thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        thread.start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        url = 'http://127.0.0.1:{}'.format(self.server.server_port)
+        self.graph = GraphClient(endpoint=url, token_url=url + '/token')
+
+    def paths(self):
+        return [c[0] for c in self.server.calls]
+
+
+class GraphClientTests(StubGraphTestCase):
+
+    def message(self, subject):
+        return {'message': {'subject': subject}}
+
+    def test_token_cache(self):
+        # eight threads wanting a token at once get the same one
+        with ThreadPoolExecutor(8) as pool:
+            tokens = set(pool.map(lambda i: self.graph.app_token(), range(8)))
+        self.assertEqual(tokens, {'tok1'})
+        self.graph.call('GET', '/me')
+        self.assertEqual(self.paths().count('/token'), 1)
+        self.assertEqual(self.server.calls[-1][1], 'Bearer tok1')
+
+        # a token within REFRESH_MARGIN of its expiry is renewed before use
+        self.server.expires_in = REFRESH_MARGIN
+        self.graph.app_token(renew=True)
+        self.graph.call('GET', '/me')
+        self.assertEqual(self.server.calls[-1][1], 'Bearer tok3')
+
+        # one revoked early is renewed once
+        self.server.expires_in = 3600
+        self.graph.app_token(renew=True)
+        self.server.revoked.add('tok4')
+        r = self.graph.call('POST', '/users/ops@example.org/sendMail',
+                            payload=self.message('ok'))
+        self.assertEqual(r.status_code, 202)
+        self.assertEqual(self.server.calls[-1][1], 'Bearer tok5')
+        # but a user's token is not
+        r = self.graph.call('GET', '/me', token='tok4')
+        self.assertEqual(r.status_code, 401)
+        self.assertEqual({name: timing['calls'] for name, timing in self.graph.stats().items()},
+                         {'token': 5, 'me': 3, 'sendMail': 2})
+
+    def test_user_token(self):
+        grant = {'grant_type': 'refresh_token', 'refresh_token': 'refresh0'}
+        # eight requests of a user refreshing at once get the same token
+        with ThreadPoolExecutor(8) as pool:
+            tokens = list(pool.map(lambda i: self.graph.user_token(grant), range(8)))
+        self.assertEqual({t['access_token'] for t in tokens}, {'tok1'})
+        self.assertEqual(self.paths(), ['/token'])
+        self.assertLessEqual(tokens[0]['expires_in'], 3600)
+        # the refresh token given back finds it as well
+        token = self.graph.user_token(dict(grant, refresh_token=tokens[0]['refresh_token']))
+        self.assertEqual(token['access_token'], 'tok1')
+        # another user's is their own
+        token = self.graph.user_token(dict(grant, refresh_token='other'))
+        self.assertEqual(token['access_token'], 'tok2')
+        # and one within REFRESH_MARGIN of its expiry is refreshed
+        self.server.expires_in = REFRESH_MARGIN
+        self.graph.user_token(dict(grant, refresh_token='short'))
+        token = self.graph.user_token(dict(grant, refresh_token='short'))
+        self.assertEqual(token['access_token'], 'tok4')
+        self.assertEqual(self.graph.stats()['token']['calls'], 4)
+        # two users refresh at the same time, not one after the other
+        self.server.barrier = threading.Barrier(2, timeout=5)
+        with ThreadPoolExecutor(2) as pool:
+            tokens = list(pool.map(lambda user: self.graph.user_token(
+                                            dict(grant, refresh_token=user))['access_token'],
+                                   ['ann', 'bob']))
+        self.assertEqual(sorted(tokens), ['tok5', 'tok6'])
+
+    def test_batch(self):
+        messages = [self.message('ok {}'.format(i)) for i in range(BATCH_LIMIT + 1)]
+        messages[3] = self.message('bad')
+        responses = self.graph.send_mails('ops@example.org', messages)
+        self.assertEqual([r['status'] for r in responses],
+                         [202] * 3 + [400] + [202] * (BATCH_LIMIT - 3))
+        self.assertEqual(self.paths(), ['/token', '/$batch', '/$batch'])
+        self.assertEqual(len(self.server.sent), BATCH_LIMIT + 1)
+        stats = self.graph.stats()
+        self.assertEqual({name: timing['calls'] for name, timing in stats.items()},
+                         {'token': 1, '$batch': 2})
+        self.assertGreater(stats['$batch']['seconds'], 0)
+        # one connection for the lot
+        self.assertEqual(len({c[2] for c in self.server.calls}), 1)
+
+
+@override_settings(DC_OUTBOX_SENDER='ops@example.org')
+class OutboxTests(FleetTestData, StubGraphTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.dispatcher = Dispatcher(client=self.graph, workers=2)
+
+    def queue(self, subject):
+        return queue_email({'subject': subject, 'body': 'Dear OPs',
+                            'to_email': 'dcore-ticket@med.cornell.edu'})
+
+    def test_dispatch(self):
+        for subject in ('ok 1', 'ok 2', 'busy', 'bad'):
+            self.queue(subject)
+        sent = {m.subject: m for m in self.dispatcher.dispatch()}
+        self.assertEqual({s: m.status for s, m in sent.items()},
+                         {'ok 1': 'DE', 'ok 2': 'DE', 'busy': 'PE', 'bad': 'FA'})
+        self.assertTrue(sent['busy'].last_error.startswith('503'))
+        self.assertGreater(sent['busy'].next_attempt, timezone.now())
+        # nothing is due until the backoff has passed
+        self.assertEqual(self.dispatcher.dispatch(), [])
+        OutboxMessage.objects.filter(subject='busy').update(next_attempt=timezone.now())
+        retried, = self.dispatcher.dispatch()
+        self.assertEqual((retried.status, retried.attempts), ('DE', 2))
+
+        # one token for the run, one $batch per dispatch, one connection
+        self.assertEqual(self.paths(), ['/token', '/$batch', '/$batch'])
+        self.assertEqual({c[1] for c in self.server.calls[1:]}, {'Bearer tok1'})
+        self.assertEqual(len(self.server.sent), 5)
+        self.assertEqual(set(self.server.sent), {'/users/ops@example.org/sendMail'})
+        self.assertEqual(len({c[2] for c in self.server.calls}), 1)
+
+    def test_view(self):
+        prj, other = self.add_node(1).project_set.order_by('dc_prj_id')
+        self.client.force_login(User.objects.create_user('onboarder'))
+        self.client.post(reverse('dc_management:usertothisproject-add', args=[prj.pk]),
+                         {'dcusers': [self.jd.pk], 'projects': [prj.pk]})
+        message = OutboxMessage.objects.get()
+        self.assertEqual(message.subject, 'Add users to {}'.format(prj))
+        response = self.client.get(reverse('dc_management:sendtest'))
+        self.assertContains(response, 'Email queued')
+        self.assertContains(response, 'Pending')
+        # shown again, it is still not offered to send by hand
+        response = self.client.get(reverse('dc_management:sendtest'))
+        self.assertContains(response, 'Email queued')
+        self.assertNotContains(response, 'Send as email')
+        with self.settings(DC_OUTBOX_SENDER=None):
+            self.client.post(reverse('dc_management:usertothisproject-add', args=[prj.pk]),
+                             {'dcusers': [self.js.pk], 'projects': [prj.pk]})
+        self.assertEqual(OutboxMessage.objects.count(), 1)
+        # users are not added when their email cannot be queued
+        with mock.patch('dc_management.views.queue_email', side_effect=IntegrityError):
+            with self.assertRaises(IntegrityError):
+                self.client.post(reverse('dc_management:usertothisproject-add',
+                                         args=[other.pk]),
+                                 {'dcusers': [self.jd.pk], 'projects': [other.pk]})
+        self.assertFalse(other.users.filter(pk=self.jd.pk).exists())
+
+    def test_queued_with_change(self):
+        prj = self.add_node(1).project_set.first()
+        lic = Software_License_Type.objects.create(name='site', user_assigned=False,
+                                                   concurrent=True, monitored=False)
+        sw = Software.objects.create(name='stata', license_type=lic)
+        self.client.force_login(User.objects.create_user('installer'))
+        data = {'software_changed': sw.pk, 'applied_to_prj': prj.pk, 'change_type': 'AA'}
+        # a change that fails to save queues nothing
+        with mock.patch.object(Software_Log, 'save', side_effect=IntegrityError):
+            with self.assertRaises(IntegrityError):
+                self.client.post(reverse('dc_management:change_software'), data)
+        self.assertFalse(OutboxMessage.objects.exists())
+        self.assertFalse(prj.software_installed.exists())
+
+        self.client.post(reverse('dc_management:change_software'), data)
+        message = OutboxMessage.objects.get()
+        self.assertEqual(message.subject, 'install software {} to {}'.format(sw, prj.dc_prj_id))
+        self.assertEqual(Software_Log.objects.get().software_changed, sw)
@@ -0,0 +1,196 @@
+"""
+Text of the governance document files, for search.
+
+The text of PDF (with pypdf) and DOCX (from the XML of the document, headers
+and footers) files is extracted into a DocumentText per distinct content,
+found by its sha256, so a file uploaded again or to another project is never
+extracted twice. search.py indexes it as a field of the document, so an IRB
+can be found by a protocol number or PI name that only appears in its file.
+
+Extraction is kept off the request path: saving a document schedules it
+for when the transaction commits, and it then runs in a pool of
+DC_TEXT_EXTRACTION_WORKERS threads (in the committing thread if 0).
+`manage.py extracttext` extracts every document, parsing in worker
+processes.
+"""
+import logging
+import os
+import re
+import threading
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from xml.etree import ElementTree
+
+from django.conf import settings
+from django.db import connection
+
+try:
+    from pypdf import PdfReader
+except ImportError:
+    # PDFs are recorded as not extracted until pypdf is installed
+    PdfReader = None
+
+from .blobstore import ContentAddressedStorage, file_digest
+from .models import DocumentText, Governance_Doc
+from .oncommit import OnCommitBatch
+from .search import index_object
+
+logger = logging.getLogger(__name__)
+
+# characters of a document's text kept
+MAX_TEXT = 1000000
+
+# background extraction threads, unless settings.DC_TEXT_EXTRACTION_WORKERS
+WORKERS = 2
+
+# WordprocessingML namespace
+W = '{http://schemas.openxmlformats.org/wordprocessingml/2006/main}'
+
+# parts of a DOCX holding text, besides word/document.xml
+DOCX_PARTS = re.compile(r'^word/(header|footer)\d*\.xml$')
+
+
+class ExtractionError(Exception):
+    pass
+
+
+def docx_text(path):
+    with zipfile.ZipFile(path) as docx:
+        parts = ['word/document.xml'] + sorted(name for name in docx.namelist()
+                                               if DOCX_PARTS.match(name))
+        lines = []
+        for part in parts:
+            with docx.open(part) as xml:
+                paragraph = []
+                for event, element in ElementTree.iterparse(xml):
+                    if element.tag == W + 't':
+                        paragraph.append(element.text or '')
+                    elif element.tag == W + 'tab':
+                        paragraph.append('\t')
+                    elif element.tag in (W + 'br', W + 'cr'):
+                        paragraph.append('\n')
+                    elif element.tag == W + 'p':
+                        lines.append(''.join(paragraph))
+                        paragraph = []
+                        element.clear()
+        return '\n'.join(lines)
+
+def pdf_text(path):
+    if PdfReader is None:
+        raise ExtractionError('pypdf is not installed')
+    reader = PdfReader(path)
+    if reader.is_encrypted:
+        # most "protected" PDFs only restrict editing, with an empty password
+        reader.decrypt('')
+    return '\n'.join(page.extract_text() or '' for page in reader.pages)
+
+# file extension -> function returning the text of such a file
+EXTRACTORS = {
+    '.docx': docx_text,
+    '.pdf': pdf_text,
+}
+
+def extractable(name):
+    return os.path.splitext(name or '')[1].lower() in EXTRACTORS
+
+def extract_file(path):
+    """
+    (text, error) of the file at path. Runs in worker processes, so does
+    not touch the database.
+    """
+    extractor = EXTRACTORS[os.path.splitext(path)[1].lower()]
+    try:
+        text = extractor(path)
+    except Exception as e:
+        return '', '{}: {}'.format(type(e).__name__, e)[:255]
+    # PostgreSQL text cannot hold NUL characters
+    return text.replace('\x00', '')[:MAX_TEXT], ''
+
+
+def document_digest(doc):
+    """
+    The sha256 of a document's file: the digest of its DocumentText while
+    the file is still a link to that content's blob (see blobstore.py), or
+    else read from the file
+    """
+    storage = doc.documentation.storage
+    if doc.document_text_id is not None and isinstance(storage, ContentAddressedStorage):
+        digest = doc.document_text.digest
+        if storage.refers_to(doc.documentation.name, storage.blob_name(digest)):
+            return digest
+    return file_digest(doc.documentation.path)
+
+def extract_documents(docs, pool=None):
+    """
+    Bring the DocumentText of each document in a queryset up to date with its
+    file, parsing the contents with no DocumentText yet (with pool.map, if
+    given), and reindex the documents whose text changed. Returns the
+    number of contents parsed.
+    """
+    # digest -> (path, documents with that content)
+    pending = {}
+    for doc in docs.select_related('document_text'):
+        if not extractable(doc.documentation.name):
+            if doc.document_text_id is not None:
+                pending.setdefault(None, (None, []))[1].append(doc)
+            continue
+        try:
+            digest = document_digest(doc)
+        except FileNotFoundError:
+            continue
+        if doc.document_text_id is None or doc.document_text.digest != digest:
+            pending.setdefault(digest, (doc.documentation.path, []))[1].append(doc)
+
+    texts = DocumentText.objects.in_bulk([d for d in pending if d], field_name='digest')
+    texts[None] = None
+    parse = [(digest, path) for digest, (path, documents) in pending.items()
+             if digest not in texts]
+    parsed = (pool.map if pool else map)(extract_file, [path for digest, path in parse])
+    for (digest, path), (text, error) in zip(parse, parsed):
+        texts[digest], created = DocumentText.objects.get_or_create(
+                                        digest=digest,
+                                        defaults={'text': text, 'error': error})
+
+    for digest, (path, documents) in pending.items():
+        for doc in documents:
+            # update() sends no post_save, which would schedule another run
+            Governance_Doc.objects.filter(pk=doc.pk).update(document_text=texts[digest])
+            doc.document_text = texts[digest]
+            index_object(doc)
+    return len(parse)
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+def _extract(pks):
+    global _executor
+    workers = getattr(settings, 'DC_TEXT_EXTRACTION_WORKERS', WORKERS)
+    if not workers:
+        extract_documents(Governance_Doc.objects.filter(pk__in=pks))
+        return
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(workers, thread_name_prefix='textextract')
+    _executor.submit(_extract_in_background, pks)
+
+# documents waiting for extraction
+_pending = OnCommitBatch(_extract)
+
+def schedule_extraction(doc_pks):
+    """
+    Extract the text of the documents once the current transaction commits
+    (immediately under autocommit), in the background. Requests made within
+    one transaction are merged; those of a transaction rolled back are
+    dropped.
+    """
+    _pending.add(doc_pks)
+
+def _extract_in_background(pks):
+    try:
+        extract_documents(Governance_Doc.objects.filter(pk__in=pks))
+    except Exception:
+        logger.exception('Text extraction of governance documents %s failed', sorted(pks))
+    finally:
+        # the thread's own connection, outside any request cycle
+        connection.close()
@@ -171,6 +171,10 @@ urlpatterns = [
         
     # finance views:
     url(r'finances/$', views.ActiveProjectFinances.as_view(), name='finances-active'),
+    path('finances/rollup',
+         views.BillingRollupView.as_view(),
+         name='finances-rollup',
+    ),
     path('finances/<int:pk>',
          views.ProjectMonthlyBillView.as_view(),
          name='project-bill',
@@ -210,6 +214,10 @@ urlpatterns = [
             views.MigrationDetailView.as_view(), 
             name='migration-info',
     ),
+    path('logs/<str:owner>/<int:pk>/<str:log>', 
+            views.LogPageView.as_view(), 
+            name='log-page',
+    ),
     
     # comment views
     path('comment/add/<int:inst_pk>/<str:model_type>/<str:comment_type>', 
@@ -0,0 +1,252 @@
+"""
+Creating people in bulk from a CSV file, for BulkUserUpload and
+`manage.py importpeople`.
+
+PersonImport reads the file through csv.reader, so quoted commas and line
+breaks survive, and reads it twice without holding it in memory: first to
+validate every row, then to insert the valid ones with bulk_create in
+batches of BATCH_SIZE, in one transaction. People whose cwid is already
+taken are left alone, or, with `update`, updated from the columns the file
+has. Every row gets an ImportRow in the report.
+
+Files may start with a header naming their columns (in any order, among
+COLUMNS); without one the columns are COLUMNS, in that order.
+"""
+import csv
+import io
+from collections import Counter
+
+from django.core.exceptions import ValidationError
+from django.db import transaction
+
+from persons.models import Person, Role
+
+from .dashboard import bump_generation
+from .nameindex import PERSON_INDEX
+from .oncommit import now_and_on_commit
+from .search import index_objects
+
+# columns of a file without a header
+COLUMNS = ('first_name', 'last_name', 'cwid', 'affiliation', 'role', 'comments')
+
+# other header names accepted for the columns (lower case, '_' for spaces)
+HEADER_ALIASES = {
+    'first': 'first_name',
+    'last': 'last_name',
+    'comment': 'comments',
+}
+
+# people inserted per query
+BATCH_SIZE = 500
+
+# ImportRow statuses
+CREATED = 'created'
+UPDATED = 'updated'
+EXISTS = 'exists'
+INVALID = 'invalid'
+
+
+class ImportRow:
+    """
+    What became of one row of the file
+    """
+    def __init__(self, line, cwid, status, message=''):
+        self.line = line
+        self.cwid = cwid
+        self.status = status
+        self.message = message
+
+    def __repr__(self):
+        return '<ImportRow {} {} {}>'.format(self.line, self.cwid, self.status)
+
+
+class PersonImport:
+    """
+    Import of the people in a CSV file: a binary file object that can be
+    seeked back to the start (an upload, or an open() file). `comment` is
+    added to the comments of every person.
+    """
+    def __init__(self, file, comment='', update=False, batch_size=BATCH_SIZE):
+        self.file = file
+        self.comment = comment.strip()
+        self.update = update
+        self.batch_size = batch_size
+        # columns of the file, once read
+        self.columns = COLUMNS
+        # ImportRow of every row, in file order, once run
+        self.rows = []
+        self.roles = {role.name.lower(): role for role in Role.objects.all()}
+        self.affiliations = {}
+        for code, label in Person._meta.get_field('affiliation').choices or ():
+            self.affiliations[str(code).lower()] = code
+            self.affiliations[str(label).lower()] = code
+
+    #### Reading ####
+
+    def _records(self):
+        """
+        Generates (line number, {column: value}, error) of each row that
+        is not blank
+        """
+        self.file.seek(0)
+        text = io.TextIOWrapper(self.file, encoding='utf-8-sig', newline='')
+        try:
+            reader = csv.reader(text)
+            columns = None
+            # line the row starts on (a quoted value may span lines)
+            line = 1
+            for row in reader:
+                next_line = reader.line_num + 1
+                cells = [cell.strip() for cell in row]
+                if not any(cells):
+                    line = next_line
+                    continue
+                if columns is None:
+                    header = [HEADER_ALIASES.get(c, c)
+                              for c in (cell.lower().replace(' ', '_') for cell in cells)]
+                    columns = self.columns = COLUMNS
+                    if 'cwid' in header:
+                        columns = self.columns = header
+                        unknown = [c for c in header if c not in COLUMNS]
+                        if unknown:
+                            yield line, {}, 'unknown columns: {}'.format(
+                                                                    ', '.join(unknown))
+                        line = next_line
+                        continue
+                error = ''
+                if len(cells) != len(columns):
+                    error = 'expected {} columns, found {}'.format(len(columns), len(cells))
+                yield line, dict(zip(columns, cells)), error
+                line = next_line
+        except (UnicodeDecodeError, csv.Error) as e:
+            yield line, {}, 'unreadable: {}'.format(e)
+        finally:
+            text.detach()
+
+    def person(self, values):
+        """
+        The unsaved Person a row describes. Raises ValidationError if it is
+        not valid.
+        """
+        errors = {}
+        role = None
+        if values.get('role'):
+            role = self.roles.get(values['role'].lower())
+            if role is None:
+                errors['role'] = ['no role named {!r}'.format(values['role'])]
+        affiliation = values.get('affiliation') or None
+        if affiliation and self.affiliations:
+            affiliation = self.affiliations.get(affiliation.lower(), affiliation)
+        comments = '\n'.join(c for c in (values.get('comments'), self.comment) if c)
+        person = Person(first_name=values.get('first_name', ''),
+                        last_name=values.get('last_name', ''),
+                        cwid=values.get('cwid', ''),
+                        affiliation=affiliation,
+                        role=role,
+                        comments=comments or None,
+                        )
+        try:
+            person.full_clean(validate_unique=False)
+        except ValidationError as e:
+            errors.update(e.message_dict)
+        if errors:
+            raise ValidationError(errors)
+        return person
+
+    #### Import ####
+
+    def validate(self):
+        """
+        First pass: the ImportRow of every invalid row, and the set of the
+        lines of the valid ones
+        """
+        invalid = []
+        valid = set()
+        cwid_lines = {}
+        for line, values, error in self._records():
+            cwid = values.get('cwid', '')
+            if not error:
+                try:
+                    self.person(values)
+                except ValidationError as e:
+                    error = '; '.join('{}: {}'.format(field, ' '.join(messages))
+                                      for field, messages in e.message_dict.items())
+            if not error and cwid in cwid_lines:
+                error = 'cwid already on line {}'.format(cwid_lines[cwid])
+            if error:
+                invalid.append(ImportRow(line, cwid, INVALID, error))
+            else:
+                cwid_lines[cwid] = line
+                valid.add(line)
+        return invalid, valid
+
+    def run(self, strict=False):
+        """
+        Validate the file, then (unless strict and some rows are invalid)
+        import the valid rows. Returns self, with `rows` filled in.
+        """
+        invalid, valid = self.validate()
+        self.rows = invalid
+        if strict and invalid:
+            return self
+        changed = []
+        with transaction.atomic():
+            batch = []
+            for line, values, error in self._records():
+                if line in valid:
+                    batch.append((line, self.person(values)))
+                if len(batch) >= self.batch_size:
+                    changed.extend(self._save(batch))
+                    batch = []
+            changed.extend(self._save(batch))
+        self.rows.sort(key=lambda row: row.line)
+        if changed:
+            # bulk queries send no signals: update what signals.py would have
+            def bump():
+                PERSON_INDEX.changed_many(changed)
+                bump_generation(Person)
+            now_and_on_commit(bump)
+        return self
+
+    def _save(self, batch):
+        """
+        Insert (or update) the people of a batch of (line, Person). Returns
+        the pks of the people changed.
+        """
+        if not batch:
+            return []
+        existing = {cwid: (pk, comments) for cwid, pk, comments in
+                    Person.objects.filter(cwid__in=[p.cwid for line, p in batch]
+                                          ).values_list('cwid', 'pk', 'comments')}
+        new = [p for line, p in batch if p.cwid not in existing]
+        # a cwid taken since the lookup is left to the other insert
+        Person.objects.bulk_create(new, ignore_conflicts=True)
+        updated = []
+        if self.update:
+            # only the columns the file has
+            fields = [f for f in COLUMNS if f in self.columns and f != 'cwid']
+            if self.comment and 'comments' not in fields:
+                fields.append('comments')
+            for line, p in batch:
+                if p.cwid in existing:
+                    p.pk, comments = existing[p.cwid]
+                    if 'comments' not in self.columns:
+                        # the comment is appended to the person's own
+                        p.comments = '\n'.join(c for c in (comments, self.comment) if c) or None
+                    updated.append(p)
+            if fields:
+                Person.objects.bulk_update(updated, fields)
+        status = UPDATED if self.update else EXISTS
+        for line, p in batch:
+            self.rows.append(ImportRow(line, p.cwid, status if p.cwid in existing else CREATED))
+        # bulk_create() does not set the pks on every database, and the
+        # people updated are indexed with the columns the file left alone
+        changed = list(Person.objects.filter(cwid__in=[p.cwid for p in new + updated]))
+        index_objects(changed)
+        return [p.pk for p in changed]
+
+    def counts(self):
+        """
+        {status: number of rows}
+        """
+        return Counter(row.status for row in self.rows)
@@ -1,7 +1,8 @@
+import csv
 import json
 import os
 import re
-from datetime import date, timedelta
+from datetime import date, datetime, timedelta
 import time
 from urllib.parse import quote
 from mimetypes import guess_type
@@ -13,33 +14,43 @@ from django.views import generic
 from django.views.generic.edit import CreateView, UpdateView, FormView
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.mixins import LoginRequiredMixin, PermissionRequiredMixin
-from django.contrib.auth.models import User
-
-from django.core.exceptions import ObjectDoesNotExist
 
 from django.core.mail import send_mail
 
 from django.urls import reverse
 
-from django.http import HttpResponse, Http404, FileResponse
+from django.http import Http404, StreamingHttpResponse
 
 from django.urls import reverse_lazy
-from django.shortcuts import render, redirect
+from django.shortcuts import get_object_or_404, render, redirect
+from django.template.loader import render_to_string
 
-from django.db.models import Q, Sum
-from django.db.utils import IntegrityError, DataError
+from django.db import transaction
+from django.db.models import Prefetch, Q, Sum
 
 from dc_management.authhelper import get_signin_url, get_token_from_code
 from dc_management.outlookservice import get_me
+from dc_management.nodeindex import NodeUserIndex
+from dc_management.nameindex import PERSON_INDEX, USER_INDEX
+from dc_management.dashboard import Dashboard
+from dc_management.logpages import LOG_TABLES, parse_cursor
+from dc_management.search import GROUP_SIZE, PAGE_SIZE, SOURCES, SearchResults
+from dc_management.costengine import ProjectCosts
+from dc_management.compliance import project_compliance
+from dc_management.downloads import file_response
+from dc_management.billing import billing_records, billing_rollup, rollup_csv_rows
+from dc_management.userimport import PersonImport
+from dc_management.membership import add_users, remove_users
+from dc_management.outbox import queue_email
 
 from .models import Server, Project, Access_Log, Governance_Doc
 from .models import Software, Software_Log, Storage_Log, Storage
 from .models import UserCost, SoftwareCost, StorageCost, DCUAGenerator, DatabaseCost
 from .models import FileTransfer, MigrationLog, CommentLog
 from .models import ProjectBillingRecord, ExtraResourceCost
-from .models import DataCoreUserAgreement, SFTP
+from .models import DataCoreUserAgreement, SFTP, OutboxMessage
 
-from persons.models import Person
+from persons.models import Person, Role
 from datacatalog.models import Dataset, DataUseAgreement, DataAccess
 
 from .forms import AddUserToProjectForm, RemoveUserFromProjectForm
@@ -114,31 +125,12 @@ class CommentView(LoginRequiredMixin, CreateView):
 ####################################
 class DjangoUserAutocomplete(LoginRequiredMixin, autocomplete.Select2QuerySetView):
     def get_queryset(self):
-        qs = User.objects.all()
-
-        if self.q:
-            qs = qs.filter(
-                            Q(username__istartswith=self.q) |
-                            Q(first_name__istartswith=self.q) |
-                            Q(last_name__istartswith=self.q)
-                            )
-            #qs = qs.filter(cwid__istartswith=self.q)
-
-        return qs
+        # served from the in-memory name index (see nameindex.py)
+        return USER_INDEX.lookup(self.q)
 
 class DCUserAutocomplete(LoginRequiredMixin, autocomplete.Select2QuerySetView):
     def get_queryset(self):
-        qs = Person.objects.all()
-
-        if self.q:
-            qs = qs.filter(
-                            Q(cwid__istartswith=self.q) | 
-                            Q(first_name__istartswith=self.q) |
-                            Q(last_name__istartswith=self.q)
-                            )
-            #qs = qs.filter(cwid__istartswith=self.q)
-
-        return qs
+        return PERSON_INDEX.lookup(self.q)
 
 class ProjectAutocomplete(LoginRequiredMixin, autocomplete.Select2QuerySetView):
     def get_queryset(self):
@@ -238,6 +230,20 @@ class ResetOutlookTokens(LoginRequiredMixin, generic.TemplateView):
         context.update({'reset':"TRUE"})
         return context
         
+def stash_email(request, email_dict):
+    """
+    Keep the email in the session for SendMail to show, and queue it in the
+    outbox (when configured) to be sent in the background. Call it once the
+    change is saved, in the same transaction, so an email is only queued for
+    a change that is committed.
+    """
+    message = queue_email(email_dict, request.user)
+    if message:
+        # SendMail must not offer to send it by hand as well
+        email_dict = dict(email_dict, queued=True)
+        request.session['outbox_ids'] = request.session.get('outbox_ids', []) + [message.pk]
+    request.session['email_json'] = json.dumps(email_dict)
+
 class OutlookConnection(LoginRequiredMixin, generic.TemplateView):
     template_name = 'dc_management/email_outlook.html'
     
@@ -289,47 +295,17 @@ class GetToken(LoginRequiredMixin, generic.TemplateView):
 class SendMail(LoginRequiredMixin, generic.TemplateView):
     template_name = 'dc_management/email_result.html'
     def get_context_data(self, **kwargs):
-        # disabling until SSL can be configured.
-        #access_token = get_access_token(
-        #                    self.request,
-        #                    self.request.build_absolute_uri(
-        #                                reverse('dc_management:gettoken'))
-        #                                )
-        access_token = 'disabled temporarily'
-        user_email = "disabled@disabled"  #self.request.session['outlook_user_email']
-        
         # get email parameters from session info (saved as json)
         email_details = json.loads(self.request.session['email_json'])
-        
-        payload = {
-                  "Message": {
-                    "Subject": email_details['subject'],
-                    "Body": {
-                      "ContentType": "Text",
-                      "Content": email_details['body']
-                    },
-                    "ToRecipients": [
-                      {
-                        "EmailAddress": {
-                          "Address": email_details['to_email']
-                        }
-                      }
-                    ],
-                    #"Attachments": [
-                    #  {
-                    #    "@odata.type": "#Microsoft.OutlookServices.FileAttachment",
-                    #    "Name": "menu.txt",
-                    #    "ContentBytes": "bWFjIGFuZCBjaGVlc2UgdG9kYXk="
-                    #  }
-                    #]
-                  },
-                  "SaveToSentItems": "true"
-                  }
+
+        # the emails queued by the change, sent by `manage.py sendoutbox`
+        outbox = OutboxMessage.objects.filter(
+                            pk__in=self.request.session.pop('outbox_ids', [])
+                            ).order_by('pk')
 
         context = super(SendMail, self).get_context_data(**kwargs)
         context.update({'email_details':email_details,
-                        'gettoken': access_token,
-                        'sendtest': "Email has been temporarily disabled." #send_message(access_token,user_email,payload),
+                        'outbox': list(outbox),
         })
         return context
 
@@ -396,10 +372,10 @@ class IndexSoftwareView(LoginRequiredMixin, generic.ListView):
     context_object_name = 'sw_list'
 
     def get_queryset(self):
-        """Return  all software."""
-        swqs = Software.objects.all()
-        swqs = sorted(swqs, key=lambda i: i.seatcount(), reverse=True)
-        return  swqs
+        """Return  all software, most used first."""
+        return Software.objects.with_usage(
+                                ).select_related('license_type'
+                                ).order_by('-seat_count', 'name')
 
     def get_context_data(self, **kwargs):
         context = super(IndexSoftwareView, self).get_context_data(**kwargs)
@@ -450,82 +426,12 @@ class IndexView(PermissionRequiredMixin, generic.ListView):
         return Project.objects.filter(status="RU").order_by('dc_prj_id')
     
     def get_context_data(self, **kwargs):
-        # all projects running and without a completed date
-        still_running = Project.objects.filter(status='RU',
-                                                completion_date__isnull=True,
-                                                ).order_by('expected_completion'
-                                                )
-        # for the expiring list
-        expiring_soon = [ p for p in still_running if p.days_to_completion() <= 60 ]
-        
-        # all projects with valid IRB documentation
-        irb_valid_projects = Project.objects.filter(
-                                Q(governance_doc__governance_type='IR',
-                                  governance_doc__expiry_date__gte=date.today()) |
-                                Q(governance_doc__governance_type='IX')
-                                            )
-        irb_invalid_projects = still_running.difference(irb_valid_projects)
-        
-        # get all projects with expired DUAs that DON'T have currently valid DUAs
-        dua_invalid_projects = Project.objects.filter(
-                                    ~Q(governance_doc__expiry_date__gte=date.today()) &
-                                    Q(governance_doc__governance_type='DU')
-                                ).exclude(
-                                    governance_doc__expiry_date__gte=date.today(),
-                                    governance_doc__governance_type='DU'
-                                ).exclude(
-                                    status='CO',
-                                ).distinct()
-        
-        swqs = Software.objects.all()
-        swqs = sorted(swqs, key=lambda i: i.seatcount(), reverse=True)
-        
+        dashboard = Dashboard(self.request)
         context = super(IndexView, self).get_context_data(**kwargs)
+        context.update(dashboard.snapshot())
         context.update({
-            'expiring_list'     : expiring_soon,  
-            'onboarding_list'   : MigrationLog.objects.filter(
-                                        Q(access_date__isnull=True) |
-                                        Q(envt_date__isnull=True)   |
-                                        Q(data_date__isnull=True)
-                                        ).filter(
-                                        project__status='ON'
-                                        ).order_by('record_creation'),
-            'migration_list'    : MigrationLog.objects.filter(
-                                        Q(access_date__isnull=True) |
-                                        Q(envt_date__isnull=True) |
-                                        Q(data_date__isnull=True)
-                                        ).exclude(
-                                            project__status='ON'
-                                        ).exclude(
-                                            project__status='SU'
-                                        ).order_by('record_creation'),
-            'onboarding_prj_list': Project.objects.filter(
-                                        status='ON',
-                                        migrationlog=None,
-                                        ).order_by('requested_launch'),                            
-            'irb_invalid'       : irb_invalid_projects,
-            'dua_invalid'       : dua_invalid_projects,
-            'undocumented_list' : Project.objects.filter(
-                                        governance_doc__isnull=True,
-                                        ).order_by('dc_prj_id'),                           
-            'shutting_list'     : Project.objects.filter(
-                                        status='SD',
-                                        completion_date__isnull=True,
-                                        ).order_by('expected_completion'),                            
-            # for finding users assigned more than once:
-            'server_list'       : Server.objects.filter(
-                                        status="ON"
-                                        ).filter(
-                                            function="PR"
-                                        ).order_by('node'),
+            'sw_list'           : dashboard.sw_list(),
             'unsigned_user_list':[],
-            'undoc_user_list'   :Person.objects.exclude(
-                governance_doc__date_issued__gte=date.today()-timedelta(days=360),
-                                        ).filter(
-                project__status__in=['RU', 'SD'],
-                                        ).distinct(
-                                        ).order_by('first_name'
-                                        ),
         })
         return context
 
@@ -541,6 +447,13 @@ class DCUserView(LoginRequiredMixin, generic.DetailView):
     model = Person
     template_name = 'dc_management/dcuser.html'
 
+    def get_queryset(self):
+        return Person.objects.prefetch_related(
+                    Prefetch('governance_doc_set',
+                             queryset=Governance_Doc.objects.with_attention(
+                                        ).select_related('project'
+                                        ).prefetch_related('dynamic_comments')))
+
 class PersonCreate(LoginRequiredMixin, CreateView):
     model = Person
     fields = ['first_name', 'last_name', 'cwid', 'affiliation', 'role', 'comments']
@@ -572,16 +485,51 @@ class ProjectView(LoginRequiredMixin, generic.DetailView):
     model = Project
     template_name = 'dc_management/project.html'
 
+    def get_queryset(self):
+        # everything the page shows is loaded here, one query per relation,
+        # so the page costs the same number of queries however many users
+        # and bills the project has. Logs are loaded by LogPageView.
+        comments = CommentLog.objects.select_related('record_author', 'parent_comment')
+        return Project.objects.with_user_counts(
+                    ).select_related('host', 'db', 'pi', 'prj_admin', 'env_subtype'
+                    ).prefetch_related(
+                        Prefetch('users', queryset=Person.objects.select_related('role'
+                                                    ).prefetch_related('project_set')),
+                        Prefetch('software_installed',
+                                 queryset=Software.objects.select_related('license_type')),
+                        Prefetch('software_requested',
+                                 queryset=Software.objects.select_related('license_type')),
+                        Prefetch('storage',
+                                 queryset=DataAccess.objects.select_related('storage_type'
+                                                    ).prefetch_related('dc_project')),
+                        'sftp_set',
+                        Prefetch('dynamic_comments',
+                                 queryset=comments.prefetch_related(
+                                            Prefetch('commentlog_set', queryset=comments))),
+                    )
+
+    def user_compliance(self):
+        """
+        The project's UserComplianceStatus rows (see compliance.py), with
+        their people, by person pk
+        """
+        status, user_compliance = project_compliance(self.object)
+        return user_compliance
+
     def get_context_data(self, **kwargs):
         # get project cost
         project_costs = []
         
+        # migration candidates share the request's node user index
+        self.object._node_user_index = NodeUserIndex.for_request(self.request)
+        migration_nodes = self.object.valid_nodes(rank=True)
+
         # get all software installed on the node, and thus available to the prj
         node=self.object.host
         if node:
             available_sw = node.software_installed.exclude(
-                                            pk__in=self.object.software_installed.all()
-            )
+                                            pk__in=[sw.pk for sw in self.object.software_installed.all()]
+                                            ).select_related('license_type')
         else:
             available_sw = []            
         
@@ -590,58 +538,42 @@ class ProjectView(LoginRequiredMixin, generic.DetailView):
                                 ).distinct()
         
         # create other lists for display:
-        current_gov_docs = self.object.governance_doc_set.all(
-                                ).exclude(superseded_by__isnull=False
+        current_gov_docs = list(self.object.governance_doc_set.with_attention(
+                                ).exclude(superseded=True
                                 ).exclude(defers_to_doc__isnull=False
-                                )
-        irb_users = Person.objects.filter(Q(governance_doc__governance_type='IR') &
-                                         Q(governance_doc__project=self.object.pk)
-                                ).distinct()
-        dcua_users = Person.objects.filter(Q(governance_doc__governance_type='DC') &
-                                         Q(governance_doc__project=self.object.pk)
-                                ).distinct()
-        dua_users = Person.objects.filter(Q(governance_doc__governance_type='DU') &
-                                         Q(governance_doc__project=self.object.pk)
-                                ).distinct()
+                                ).select_related('project'
+                                ).prefetch_related('dynamic_comments'))
+
+        # who is named on which documents, as of the last compliance scan
+        user_compliance = self.user_compliance()
         
         project_bills = ProjectBillingRecord.objects.filter(project=self.object.pk
                                 ).order_by('-billing_date')
-        # calculate monthly bill totals and zip them with the monthly bill.
-        bill_zip = zip(project_bills, [ pb.monthly_total() for pb in project_bills ])
-        
-        try:
-            latest_bill = project_bills.latest('billing_date')
-        except ProjectBillingRecord.DoesNotExist:
-            latest_bill = None
+        # zip the monthly bills with their stored totals.
+        bill_zip = [ (pb, pb.total) for pb in project_bills ]
         
-        if latest_bill:
-            bill_total = latest_bill.monthly_total()
+        if bill_zip:
+            latest_bill, bill_total = bill_zip[0]
         else:
+            latest_bill = None
             bill_total = 0
         
-        if current_gov_docs.filter(governance_type='IX').count() >= 1:
-            fully_validated = dcua_users
-        elif current_gov_docs.filter(governance_type='DU').count() == 0:
-            fully_validated = irb_users & dcua_users
-        else:
-            fully_validated = irb_users & dua_users & dcua_users
-        
-        partially_validated = dcua_users | dua_users | irb_users
-        unconnected_users = fully_validated.exclude(pk__in=self.object.users.all())
-        
         ## update context        
         context = super(ProjectView, self).get_context_data(**kwargs)
         context.update({
                         'project_costs': project_costs,
+                        'migration_nodes': migration_nodes,
                         'available_software':available_sw,
                         'prj_governance':prj_governance,
                         'current_gov_docs':current_gov_docs,
-                        'fully_validated':fully_validated,
-                        'partially_validated':partially_validated,
-                        'irb_users':irb_users,
-                        'dua_users':dua_users,
-                        'dcua_users':dcua_users,
-                        'unconnected_users':unconnected_users,
+                        'fully_validated':[u.person for u in user_compliance if u.validated],
+                        'partially_validated':[u.person for u in user_compliance
+                                               if u.irb or u.dua or u.dcua],
+                        'irb_users':[u.person for u in user_compliance if u.irb],
+                        'dua_users':[u.person for u in user_compliance if u.dua],
+                        'dcua_users':[u.person for u in user_compliance if u.dcua],
+                        'unconnected_users':[u.person for u in user_compliance
+                                             if u.validated and not u.on_project],
                         'bill':latest_bill,
                         'bill_total':bill_total,
                         'all_bills':project_bills,
@@ -649,10 +581,36 @@ class ProjectView(LoginRequiredMixin, generic.DetailView):
         })
         return context
 
+class LogPageView(LoginRequiredMixin, generic.View):
+    """
+    One page of a log table of a project, person or server, for its log tab.
+    The page after it is requested with ?after=<cursor>.
+    """
+    def get(self, request, owner, pk, log):
+        try:
+            table = LOG_TABLES[owner][log]
+            page = table.page(pk, parse_cursor(request.GET.get('after')))
+        except (KeyError, ValueError):
+            raise Http404("No such log page")
+        next_url = None
+        if page.next_cursor:
+            next_url = '{}?after={}'.format(request.path, page.next_cursor)
+        return render(request, table.template, {'owner': owner,
+                                                'page': page,
+                                                'next_url': next_url,
+                                                })
+
 class AllProjectGovDocsView(LoginRequiredMixin, generic.DetailView):
     model = Project
     template_name = 'dc_management/gov_docs_all.html'
 
+    def get_queryset(self):
+        return Project.objects.prefetch_related(
+                    Prefetch('governance_doc_set',
+                             queryset=Governance_Doc.objects.with_attention(
+                                        ).select_related('project'
+                                        ).prefetch_related('dynamic_comments')))
+
 class AllProjectsView(LoginRequiredMixin, generic.ListView):
     template_name = 'dc_management/projects_all.html'
     context_object_name = 'project_list'
@@ -664,45 +622,20 @@ class AllProjectsView(LoginRequiredMixin, generic.ListView):
 class BulkUserUpload(LoginRequiredMixin, FormView):
     template_name = 'dc_management/bulkuseruploadform.html'
     form_class = BulkUserUploadForm
-    success_url = reverse_lazy('dc_management:index')
-    
+
+    def get_context_data(self, **kwargs):
+        context = super(BulkUserUpload, self).get_context_data(**kwargs)
+        context['roles'] = Role.objects.order_by('name')
+        return context
+
     def form_valid(self, form):
-        # This method is called when valid form data has been POSTed.
-        # It should return an HttpResponse.
-        post_data = self.request.POST
-        
-        # Check if user in project, then connect user to project
-        users_csv_field = form.cleaned_data['users_csv']
-        users_csv = self.request.FILES['users_csv']
-        extra_comment = form.cleaned_data['comment']
-        
-        #form.instance.record_author = self.request.user
-
-        # read file and create users.
-        chunks = users_csv.chunks() # open(users_csv, "r")
-        for handle in chunks:
-            for line in str(handle).split('\\n'):
-                print(line)
-                if len(line.strip().split(',')) == 6:
-                    fn,ln,cw,af,ro,co = line.strip().split(',')
-                    print("First:{}\nLast:{}\nCWID:{}\nAffil:{}\nRole:{}\nComments:{}".format(fn,ln,cw,af,ro,co))
-                    if fn[:2] == "b'":      # from conversion of bytes to str
-                        fn = fn[2:]
-                    try:
-                        u = Person(first_name=fn.strip(), 
-                                    last_name=ln.strip(), 
-                                    cwid=cw.strip(), 
-                                    affiliation=af.strip(), 
-                                    role=ro.strip(),
-                                    comments="\n".join([co,extra_comment]),
-                                    )
-                        u.save()
-                    except DataError:       # eg role has more than 2 chars
-                        print("USER DATA ERROR ENCOUNTERED FOR {}. SKIPPING".format(cw))
-                    except IntegrityError:  # eg CWID already exists
-                        print("USER INTEGRITY ERROR ENCOUNTERED FOR {}. SKIPPING".format(cw))               
-                        
-        return super(BulkUserUpload, self).form_valid(form)    
+        # validates every row, then creates the valid users in batches
+        result = PersonImport(form.cleaned_data['users_csv'],
+                              form.cleaned_data['comment'],
+                              update=form.cleaned_data['update_existing'],
+                              ).run()
+        return render(self.request, 'dc_management/bulkuserupload_report.html',
+                      {'result': result, 'counts': result.counts()})
   
 class ProjectCreate(LoginRequiredMixin, CreateView):
     model = Project
@@ -755,6 +688,8 @@ class StorageChange(LoginRequiredMixin, CreateView):
         else:
             return reverse('dc_management:project', args=[self.project_pk])
                 
+    # the change and its email are saved together, or not at all
+    @transaction.atomic
     def form_valid(self, form):
         # clear email fields in session
         email_details = {   'subject'       :"na",
@@ -866,7 +801,7 @@ Kind regards,
                                 'body_html'     :quote(body_msg),
                 }
         
-                self.request.session['email_json'] = json.dumps(email_dict)
+                stash_email(self.request, email_dict)
 
         return super(StorageChange, self).form_valid(form)
 
@@ -1061,7 +996,7 @@ class UpdateSoftware(LoginRequiredMixin, FormView):
 
     def email_change_project_software(self, changestr, prj, sw):
         """
-        send request to add/remove software to node:
+        request to add/remove software to node:
         """
         sbj_str = '{} software {} to {}'
         body_str = 'Please {} {} for project {} (node {}, {}).'
@@ -1080,11 +1015,11 @@ class UpdateSoftware(LoginRequiredMixin, FormView):
                       'body_html': quote(body_msg),
                       }
         
-        self.request.session['email_json'] = json.dumps(email_dict)
+        return email_dict
     
     def email_change_node_software(self, changestr, node, sw):
         """
-        send request to add/remove software to node:
+        request to add/remove software to node:
         """
         sbj_str = '{} software {} to {}'
         body_str = 'Please install {} on node {} ({}).'
@@ -1101,7 +1036,7 @@ class UpdateSoftware(LoginRequiredMixin, FormView):
                       'body_html': quote(body_msg),
                       }
         
-        self.request.session['email_json'] = json.dumps(email_dict)
+        return email_dict
 
     def form_valid(self, form):
         # clear email fields in session
@@ -1122,61 +1057,66 @@ class UpdateSoftware(LoginRequiredMixin, FormView):
         
         form.instance.record_author = self.request.user
         
-        if change == "AA":
-            changestr = "install" # set language for emails:
+        # the emails are queued with the change, once it is saved
+        emails = []
+        with transaction.atomic():
+            if change == "AA":
+                changestr = "install" # set language for emails:
             
-            # if project specified, and not already installed:
-            if prj and prj.host and not sw in prj.software_installed.all():
-                # add sw to prj
-                prj.software_installed.add(sw)
-                prj.software_requested.add(sw)
+                # if project specified, and not already installed:
+                if prj and prj.host and not sw in prj.software_installed.all():
+                    # add sw to prj
+                    prj.software_installed.add(sw)
+                    prj.software_requested.add(sw)
 
-                self.email_change_project_software(changestr, prj, sw)
+                    emails.append(self.email_change_project_software(changestr, prj, sw))
             
-                # add to node if not already:
-                # check to see if any changes have been applied to the node:
-                node = prj.host
-                if sw not in node.software_installed.all():
-                    form.instance.applied_to_node = node
-                    node.software_installed.add(sw)  
-            # if node specified (and not a project), and not already on node:
-            elif node and not prj:
-                # check to see if any changes have been applied to the node:
-                if sw not in node.software_installed.all():                    
-                    self.email_change_node_software(changestr, node, sw)
-                    node.software_installed.add(sw)
-            else:
-                return redirect('dc_management:index')
+                    # add to node if not already:
+                    # check to see if any changes have been applied to the node:
+                    node = prj.host
+                    if sw not in node.software_installed.all():
+                        form.instance.applied_to_node = node
+                        node.software_installed.add(sw)  
+                # if node specified (and not a project), and not already on node:
+                elif node and not prj:
+                    # check to see if any changes have been applied to the node:
+                    if sw not in node.software_installed.all():                    
+                        emails.append(self.email_change_node_software(changestr, node, sw))
+                        node.software_installed.add(sw)
+                else:
+                    return redirect('dc_management:index')
                 
-        elif change == "RA":
-            changestr = "uninstall" # set language for emails:
-            # if project specified, and not already uninstalled:
-            if prj and prj.host and sw in prj.software_installed.all():
-                # remove sw to prj
-                prj.software_installed.remove(sw)
-                prj.software_requested.remove(sw)
-
-                self.email_change_project_software(changestr, prj, sw)
+            elif change == "RA":
+                changestr = "uninstall" # set language for emails:
+                # if project specified, and not already uninstalled:
+                if prj and prj.host and sw in prj.software_installed.all():
+                    # remove sw to prj
+                    prj.software_installed.remove(sw)
+                    prj.software_requested.remove(sw)
+
+                    emails.append(self.email_change_project_software(changestr, prj, sw))
             
-                # remove from node if only project requiring it, and it is licensed.
-                node = prj.host
-                qs = Project.objects.all()
-                qs_wsw = qs.filter(software_requested=sw)
+                    # remove from node if only project requiring it, and it is licensed.
+                    node = prj.host
+                    qs = Project.objects.all()
+                    qs_wsw = qs.filter(software_requested=sw)
                                         
-                if not qs_wsw or len(qs_wsw) == 0:  
-                    form.instance.applied_to_node = node
-                    node.software_requested.remove(sw)
+                    if not qs_wsw or len(qs_wsw) == 0:  
+                        form.instance.applied_to_node = node
+                        node.software_requested.remove(sw)
         
-            # if node specified (and not a project), and sw still on node:
-            if node and not prj:
-                if sw in node.software_installed.all():
-                    self.email_change_node_software(changestr, node, sw)
-                    node.software_requested.remove(sw)
+                # if node specified (and not a project), and sw still on node:
+                if node and not prj:
+                    if sw in node.software_installed.all():
+                        emails.append(self.email_change_node_software(changestr, node, sw))
+                        node.software_requested.remove(sw)
 
-        else:
-            changestr = "confirm presence of" # innocuous, not intended to be used.
+            else:
+                changestr = "confirm presence of" # innocuous, not intended to be used.
                      
-        form.save()                
+            form.save()
+            for email_dict in emails:
+                stash_email(self.request, email_dict)
                 
         return super(UpdateSoftware, self).form_valid(form)    
 
@@ -1188,6 +1128,7 @@ class EmailResults(LoginRequiredMixin, generic.TemplateView):
 class SoftwareView(LoginRequiredMixin, generic.DetailView):
     model = Software
     template_name = 'dc_management/software.html'
+    queryset = Software.objects.with_usage().select_related('license_type')
 
 # ############################# #
 # #####  USER PAGE VIEWS  ##### #
@@ -1236,11 +1177,21 @@ class UserProjectListView(LoginRequiredMixin, generic.ListView):
 ######  UPDATE USER - PROJECT RELATIONSHIP ######
 #################################################
 
+def project_host(prj):
+    """
+    node and IP address of the project's host, for the ServiceNow emails
+    """
+    if prj.host:
+        return prj.host.node, prj.host.ip_address
+    return "not mounted", ""
+
 class AddUserToProject(LoginRequiredMixin, FormView):
     template_name = 'dc_management/addusertoproject.html'
     form_class = AddUserToProjectForm
     success_url = reverse_lazy('dc_management:sendtest')
     
+    # the change and its email are saved together, or not at all
+    @transaction.atomic
     def form_valid(self, form):
         # clear email fields in session
         email_details = {   'subject'       :"na",
@@ -1251,74 +1202,39 @@ class AddUserToProject(LoginRequiredMixin, FormView):
         }
         self.request.session['email_json'] = json.dumps(email_details)
              
-        # Check if user in project, then connect user to project
-        
-        prj = form.cleaned_data['project']
-        newusers = form.cleaned_data['dcusers']
+        # connect the users not in each project yet to it
+        projects = list(form.cleaned_data['projects'].select_related('host'))
+        added = add_users(projects,
+                          list(form.cleaned_data['dcusers']),
+                          self.request.user,
+                          form.cleaned_data['locations_allowed'],
+                          )
         email_comment = form.cleaned_data['email_comment']
-        locations_allowed = form.cleaned_data['locations_allowed']
-        oldusers = prj.users.all()
-        record_author = self.request.user
-        
-        userlist = []
-        for newuser in newusers:
-            if newuser in oldusers:
-                # report user is already added to project
-                pass
-            else:
-                prj.users.add(newuser)
-                userlist.append(newuser)
-                
-                # save access log instance
-                self.logger = Access_Log(
-                            record_author=record_author,
-                            date_changed=date.today(),
-                            dc_user=newuser,
-                            prj_affected=prj,
-                            change_type="AA",
-                )
-                self.logger.save()
-                
-                # create DCUA for signing by user
-                new_dcua = DataCoreUserAgreement(
-                                    record_creation=date.today(),
-                                    record_update=date.today(),
-                                    record_author=record_author,
-                                    attestee=newuser,
-                                    project=prj,
-                                    start_date=date.today(),
-                                    end_date=date.today()+timedelta(days=365), 
-                                    locations_allowed=locations_allowed,
-                            )
-                new_dcua.save()
                 
         # send email
-        if prj.host:
-            node = prj.host.node
-            ip = prj.host.ip_address
-        else:
-            node = "not mounted"
-            ip = ""
         subject_str = 'Add users to {}'
         body_str = '''Dear OPs, 
         
 This ticket refers to SOP "HowTo: Add or remove a user to a Data Core project"
 https://nexus.weill.cornell.edu/display/ops/HowTo%3A+Add+or+remove+a+user+to+a+Data+Core+project+group
 
-For the following {4} users, please add them to the AD group for project {0} ({1}, {2}) and create their corresponding fileshare directory (permissions indicated):
-
-{3}
+{0}
 
-{6}
+{2}
 
 Kind regards,
-{5}'''
-        subj_msg = subject_str.format(str(prj))
-        body_msg = body_str.format(prj.dc_prj_id,
-                            node,
-                            ip,
-                            '\n'.join(["{} ; WorkArea-{} ; (RWX)".format(u,u.cwid) for u in userlist]),
-                            len(userlist),
+{1}'''
+        project_str = '''For the following {4} users, please add them to the AD group for project {0} ({1}, {2}) and create their corresponding fileshare directory (permissions indicated):
+
+{3}'''
+        subj_msg = subject_str.format(', '.join(str(prj) for prj in projects))
+        body_msg = body_str.format('\n\n'.join(
+                            project_str.format(prj.dc_prj_id,
+                                *project_host(prj),
+                                '\n'.join(["{} ; WorkArea-{} ; (RWX)".format(u,u.cwid)
+                                           for u in added[prj]]),
+                                len(added[prj]))
+                            for prj in projects),
                             self.request.user.get_short_name(),
                             email_comment,
                             )
@@ -1330,7 +1246,7 @@ Kind regards,
                         'body_html'     :quote(body_msg),
         }
         
-        self.request.session['email_json'] = json.dumps(email_dict)
+        stash_email(self.request, email_dict)
                 
         return super(AddUserToProject, self).form_valid(form)
 
@@ -1346,7 +1262,7 @@ class AddThisUserToProject(AddUserToProject):
         # get the user from the url
         chosen_user = Person.objects.get(pk=self.kwargs['pk'])
         # update initial field defaults with custom set default values:
-        initial.update({'dcuser': chosen_user, })
+        initial.update({'dcusers': [chosen_user], })
         return initial
 
 class AddUserToThisProject(AddUserToProject):
@@ -1359,7 +1275,7 @@ class AddUserToThisProject(AddUserToProject):
         # get the user from the url
         chosen_project = Project.objects.get(pk=self.kwargs['pk'])
         # update initial field defaults with custom set default values:
-        initial.update({'project': chosen_project, })
+        initial.update({'projects': [chosen_project], })
         return initial
 
 class DCUAView(LoginRequiredMixin, generic.DetailView):
@@ -1417,10 +1333,11 @@ class RemoveUserFromProject(LoginRequiredMixin, FormView ):
     form_class = RemoveUserFromProjectForm
     success_url = reverse_lazy('dc_management:sendtest')
     
+    # the change and its email are saved together, or not at all
+    @transaction.atomic
     def form_valid(self, form):
         # This method is called when valid form data has been POSTed.
         # It should return an HttpResponse.
-        post_data = self.request.POST
         
         # clear email fields in session
         email_details = {   'subject'       :"na",
@@ -1431,59 +1348,36 @@ class RemoveUserFromProject(LoginRequiredMixin, FormView ):
         }
         self.request.session['email_json'] = json.dumps(email_details)
                 
-        # Check if user in project, then remove user from project
-        prj = form.cleaned_data['project']
-        newusers = form.cleaned_data['dcusers']
-        oldusers = prj.users.all()
-        record_author = self.request.user
+        # remove the users from each project they are in
+        projects = list(form.cleaned_data['projects'].select_related('host'))
+        removed = remove_users(projects,
+                               list(form.cleaned_data['dcusers']),
+                               self.request.user,
+                               )
         email_comment = form.cleaned_data['email_comment']
-        
-        userlist = []
-        for newuser in newusers:
-            if newuser not in oldusers:
-                # report user is not in project
-                pass
-            else:
-                prj.users.remove(newuser)
-                userlist.append(newuser)
-                
-                # save access log instance
-                self.logger = Access_Log(
-                            record_author=record_author,
-                            date_changed=date.today(),
-                            dc_user=newuser,
-                            prj_affected=prj,
-                            change_type="RA",
-                )
-                self.logger.save()
 
         # send email
-        if prj.host:
-            node = prj.host.node
-            ip = prj.host.ip_address
-        else:
-            node = "not mounted"
-            ip = ""
-
         subject_str = 'Remove users from {}'
         body_str = '''Dear OPs, 
         
 This ticket refers to SOP "HowTo: Add or remove a user to a Data Core project"
 https://nexus.weill.cornell.edu/display/ops/HowTo%3A+Add+or+remove+a+user+to+a+Data+Core+project+group
 
-Please remove the following users from project {0} ({1}, {2}):
-
-{3}
+{0}
 
-{5}
+{2}
 
 Kind regards,
-{4}'''
-        subj_msg = subject_str.format(str(prj))
-        body_msg = body_str.format(prj.dc_prj_id,
-                            node,
-                            ip,
-                            '\n'.join([str(u) for u in userlist]),
+{1}'''
+        project_str = '''Please remove the following users from project {0} ({1}, {2}):
+
+{3}'''
+        subj_msg = subject_str.format(', '.join(str(prj) for prj in projects))
+        body_msg = body_str.format('\n\n'.join(
+                            project_str.format(prj.dc_prj_id,
+                                *project_host(prj),
+                                '\n'.join([str(u) for u in removed[prj]]))
+                            for prj in projects),
                             self.request.user.get_short_name(),
                             email_comment,
                             )
@@ -1495,7 +1389,7 @@ Kind regards,
                         'body_html'     :quote(body_msg),
         }
         
-        self.request.session['email_json'] = json.dumps(email_dict)
+        stash_email(self.request, email_dict)
 
 
         return super(RemoveUserFromProject, self).form_valid(form)
@@ -1518,7 +1412,7 @@ class RemoveUserFromThisProject(RemoveUserFromProject):
         # get the user from the url
         chosen_project = Project.objects.get(pk=self.kwargs['pk'])
         # update initial field defaults with custom set default values:
-        initial.update({'project': chosen_project, })
+        initial.update({'projects': [chosen_project], })
         return initial
 
 ###### Onboarding views #######
@@ -1675,7 +1569,7 @@ class ExportFromThisProject(ExportRequest):
         # get the user from the url
         chosen_user = Person.objects.get(pk=self.kwargs['pk'])
         # update initial field defaults with custom set default values:
-        initial.update({'dcuser': chosen_user, })
+        initial.update({'dcusers': [chosen_user], })
         return initial
     
 ########################################
@@ -1685,48 +1579,30 @@ class ExportFromThisProject(ExportRequest):
 
 @login_required()
 def pdf_view(request, pk):
-    gov_doc = Governance_Doc.objects.get(pk=pk)
+    gov_doc = get_object_or_404(Governance_Doc, pk=pk)
     # check to see if file is associated:
     try:
-        gd_file = gov_doc.documentation.file
-    except (FileNotFoundError, ValueError):
+        path = gov_doc.documentation.path
+    except ValueError:
         raise Http404()
 
     # get standardized extension name to evaluate how to display:
     extension_raw = os.path.splitext(gov_doc.documentation.name)
     extension = extension_raw[1][1:].lower()
 
-    # serve pdfs for viewing in the browser
+    # serve pdfs and docx files for viewing in the browser, and download all
+    # other files for handling by the user.
     if extension == "pdf":
-        try:
-            return FileResponse(gov_doc.documentation.file,
-                                content_type='application/pdf',
-                                )
-        except FileNotFoundError:
-            raise Http404()
-
-    # viewing of docx files
+        content_type, disposition = 'application/pdf', 'inline'
     elif extension == "docx":
-        try:
-            with open(str(gov_doc.documentation.file), 'rb') as fh:
-                response = HttpResponse(fh.read(),
-                                        content_type="application/vnd.ms-word",
-                                        )
-                response['Content-Disposition'] = f'inline; filename={os.path.basename(str(gov_doc.documentation.file))}'
-                return response
-            
-        except FileNotFoundError:
-            raise Http404()
-
-    # download all other files for handling by the user.
+        content_type, disposition = 'application/vnd.ms-word', 'inline'
     else:
-        mime_type = guess_type(gov_doc.documentation.name)
-        with open(str(gov_doc.documentation.file), 'rb') as fh:
-            response = HttpResponse(fh.read(),
-                                    content_type=mime_type,
-                                    )
-            response['Content-Disposition'] = f'attachment; filename={os.path.basename(str(gov_doc.documentation.file))}'
-            return response
+        content_type = guess_type(gov_doc.documentation.name)[0] or 'application/octet-stream'
+        disposition = 'attachment'
+    try:
+        return file_response(request, path, content_type, disposition)
+    except FileNotFoundError:
+        raise Http404()
 
 
 class GovernanceView(LoginRequiredMixin, generic.DetailView):
@@ -2016,208 +1892,81 @@ class ProjectMonthlyBillUpdate(LoginRequiredMixin, CreateView):
 class ActiveProjectFinances(LoginRequiredMixin, generic.ListView):
     template_name = 'dc_management/finances_global.html'
     context_object_name = 'project_list'
+    paginate_by = 100
 
     def get_queryset(self):
         """Return  all active projects."""
         return Project.objects.all().order_by('dc_prj_id')
     
     def get_context_data(self, **kwargs):
-        all_prjs = Project.objects.all().order_by('dc_prj_id')
-        user_costs = UserCost.objects.all()
-        sw_costs = SoftwareCost.objects.all()
-        storage_costs = StorageCost.objects.all()
-        
-        # lists for passing to template:
-        sw_list = []
-        compute_list = []
-
-        # get user costs before cycling through all projects, so we only touch this 
-        # table once:
-        #maxquant = user_costs.aggregate(Max('user_quantity'))
-        max_rego = user_costs.order_by('-user_quantity')[0]
-        set_cost = max_rego.user_cost
-        set_cnt = max_rego.user_quantity
-
-        # get the cost of adding additional users beyond the maximum number priced
-        try:
-            xtr_cost = user_costs.get(user_quantity=0).user_cost    
-        except ObjectDoesNotExist:
-            xtr_cost = 0
-        
-        for prj in all_prjs:
-            # get costs for Primary data storage
-            try:
-                fs_rate = storage_costs.get(
-                                storage_type__icontains="primary"
-                                            ).st_cost_per_gb
-            except ObjectDoesNotExist:
-                fs_rate = 0          
-            if prj.fileshare_storage:
-                fss = prj.fileshare_storage
-            else:
-                fss = 0
-            prj.fileshare_cost = fss * fs_rate
+        # the stored costs are kept current by the cost engine when their inputs
+        # change, so this page only reads them; the software and compute
+        # breakdowns are only worked out for the projects on the page
+        context = super(ActiveProjectFinances, self).get_context_data(**kwargs)
+        shown = [prj.pk for prj in context['project_list']]
+        costs = ProjectCosts(Project.objects.filter(pk__in=shown).order_by('dc_prj_id'))
+        context.update({
+            'prj_data': costs.rows(),
+            'grand_total_cost': Project.objects.aggregate(
+                                        total=Sum('project_total_cost'))['total'] or 0,
+        })
+        return context
+
+class Echo:
+    """
+    File-like object for csv.writer that hands back each row written to it, so
+    that rows can be streamed as they are produced.
+    """
+    def write(self, value):
+        return value
 
-            # get costs for derivative data storage
+class BillingRollupView(LoginRequiredMixin, generic.ListView):
+    """
+    Invoice totals by account, project and month. Filter with ?start=YYYY-MM,
+    ?end=YYYY-MM and ?account=, and add ?export=csv to download every row.
+    """
+    template_name = 'dc_management/billing_rollup.html'
+    context_object_name = 'rollup'
+    paginate_by = 100
+
+    def get_filters(self):
+        # get month limits and account from the query string
+        filters = {'account': self.request.GET.get('account') or None}
+        for key in ('start', 'end'):
             try:
-                bkp_rate = storage_costs.get(
-                                storage_type__icontains="derivative"
-                                            ).st_cost_per_gb
-            except ObjectDoesNotExist:
-                bkp_rate = 0          
-        
-            if prj.fileshare_derivative:
-                bs = prj.fileshare_derivative
-            else:
-                bs = 0
-            prj.backup_cost = bs * bkp_rate
-            
-            # completed projects only have storage costs, ie no compute costs:
-            if prj.status == 'CO':
-                prj.direct_attach_cost = 0
-                prj.user_cost = 0
-                prj.software_cost = 0
-                prj.db_cost = 0
-                prj.host_cost = 0
-                sw_list.append([]) # to keep the sw list in sync
-                compute_list.append(((0, 'CPUs', 0.0), (0, 'GB RAM', 0.0)))
-            else:
-                # get cost for users.
-                user_num = len(prj.users.all())
-                
-                # if a classroom, rate is set at the zero user rate for all users after PI
-                if prj.env_type == 'CL':
-                    # get the PI cost
-                    try:
-                        pi_cost = user_costs.get(user_quantity=1).user_cost    
-                    except ObjectDoesNotExist:
-                        pi_cost = 0
-                    
-                    # calculate total user cost for classroom:
-                    ucost = (user_num - 1) * xtr_cost + pi_cost
-                
-                else:  # not a classroom
-                    try:
-                        ucost = user_costs.get(user_quantity=user_num).user_cost
-                    except ObjectDoesNotExist:
-                    
-                        ucost = set_cost + xtr_cost * set_cnt
-                
-                prj.user_cost = ucost
-            
-                    
-                # get cost for storage
-                # direct attach
-                try:
-                    direct_rate = storage_costs.get(
-                                    storage_type__icontains="direct"
-                                                ).st_cost_per_gb
-                except ObjectDoesNotExist:
-                    direct_rate = 0          
-            
-                if not prj.direct_attach_storage:
-                    das = 0
-                else:
-                    das = prj.direct_attach_storage
-                prj.direct_attach_cost = das * direct_rate
-            
-                
-            
-                # get costs for software:
-                prj_sw_list = []
-                prj_sw_total = 0
-                for sw in prj.software_installed.all():
-                    try:
-                        sw_cost = sw_costs.get(software=sw).software_cost
-                    except ObjectDoesNotExist:
-                        sw_cost = 0
-                    prj_sw_list.append((sw.name, sw_cost * user_num))
-                    prj_sw_total += sw_cost * user_num
-                prj.software_cost = prj_sw_total
-                sw_list.append(prj_sw_list)
-            
-            
-                # db cost
-                try:
-                    db_rate = storage_costs.get(
-                                    storage_type__icontains="db"
-                                                ).st_cost_per_gb
-                except ObjectDoesNotExist:
-                    db_rate = 0          
-            
-                if prj.db:
-                    db_size = prj.db.processor_num / 2
-                else:
-                    db_size = 0
-                            
-                prj.db_cost = db_size * db_rate
-
-                # server cost
-                try:
-                    server_CPU_rate = storage_costs.get(
-                                    storage_type__icontains="CPU"
-                                                ).st_cost_per_gb
-                except ObjectDoesNotExist:
-                    server_CPU_rate = 0
-                try:
-                    server_RAM_rate = storage_costs.get(
-                                    storage_type__icontains="RAM"
-                                                ).st_cost_per_gb
-                except ObjectDoesNotExist:
-                    server_RAM_rate = 0          
-            
-                if prj.host and prj.requested_cpu:
-                    xtra_cpu = prj.requested_cpu - 4
-                    if xtra_cpu < 0:
-                        xtra_cpu = 0
-                else:
-                    xtra_cpu = 0
-                if prj.host and prj.requested_ram:
-                    xtra_ram = prj.requested_ram - 16
-                    if xtra_ram < 0:
-                        xtra_ram = 0
-                    total_xtra_ram = xtra_ram
-                    xtra_ram = xtra_ram - xtra_cpu * 4 
-                else: 
-                    xtra_ram = 0
-                    total_xtra_ram = 0
-                prj.host_cost = max(xtra_cpu / 2 *
-                                    server_CPU_rate,
-                                    total_xtra_ram / 8 * 
-                                    server_RAM_rate
-                                )
-                compute_list.append(((  xtra_cpu, 
-                                        "CPUs", 
-                                        xtra_cpu / 2 * server_CPU_rate
-                                        ),
-                                    (total_xtra_ram, 
-                                    "GB RAM", 
-                                    total_xtra_ram / 8 * server_RAM_rate),
-                                    )
-                )
-                
-            # update total cost:
-            prj.project_total_cost = (  prj.backup_cost + 
-                                         prj.fileshare_cost +
-                                         prj.direct_attach_cost +
-                                         prj.user_cost +
-                                         prj.software_cost +
-                                         prj.db_cost +
-                                         prj.host_cost
-            )
-            
-            #### SAVE ####
-            
-            prj.save()
-           
-        prj_data = list(zip(all_prjs, sw_list, compute_list))
-        grand_total = list(Project.objects.all().aggregate(
-                                            Sum('project_total_cost')
-                        ).values())[0]   
-        context = super(ActiveProjectFinances, self).get_context_data(**kwargs)
+                month = datetime.strptime(self.request.GET.get(key, ''), '%Y-%m').date()
+            except ValueError:
+                month = None
+            if month and key == 'end':
+                # last day of the month
+                month = (month + timedelta(days=31)).replace(day=1) - timedelta(days=1)
+            filters[key] = month
+        return filters
+
+    def get_queryset(self):
+        return billing_rollup(**self.get_filters())
+
+    def get(self, request, *args, **kwargs):
+        if request.GET.get('export') == 'csv':
+            writer = csv.writer(Echo())
+            rows = rollup_csv_rows(self.get_queryset())
+            response = StreamingHttpResponse((writer.writerow(row) for row in rows),
+                                             content_type='text/csv',
+                                             )
+            response['Content-Disposition'] = 'attachment; filename="billing_rollup.csv"'
+            return response
+        return super(BillingRollupView, self).get(request, *args, **kwargs)
+
+    def get_context_data(self, **kwargs):
+        filters = self.get_filters()
+        query = self.request.GET.copy()
+        query.pop('page', None)
+        context = super(BillingRollupView, self).get_context_data(**kwargs)
         context.update({
-            'prj_data': prj_data,
-            'grand_total_cost': grand_total,
+            'filters': filters,
+            'query_string': query.urlencode(),
+            'grand_total': billing_records(**filters
+                                ).aggregate(Sum('total'))['total__sum'],
         })
         return context
 
@@ -2313,11 +2062,11 @@ Kind regards,
                         'body_html'     :quote(body_msg),
         }
         
-        self.request.session['email_json'] = json.dumps(email_dict)
-        
-        
-        self.object = form.save(commit=False)
-        return super(FileTransferCreate, self).form_valid(form)
+        # queue the email once the transfer is saved, with it
+        with transaction.atomic():
+            response = super(FileTransferCreate, self).form_valid(form)
+            stash_email(self.request, email_dict)
+        return response
 
 class MigrationCreate(LoginRequiredMixin, CreateView):
     model = MigrationLog
@@ -2387,31 +2136,56 @@ class AddProjectComment(CreateView):
 ##############################
 
 class FullSearch(LoginRequiredMixin, generic.TemplateView):
+    """
+    Search results, a section per source. The page is streamed: each section
+    is sent as soon as its source has been searched, so the first results
+    show while the slower log tables are still being searched. With `kind`,
+    lists the matches of that source alone, a page at a time and without
+    the time budget.
+    """
     template_name = 'dc_management/search_results.html'
+    section_template = 'dc_management/search_section.html'
+    # where the page template takes the sections
+    sections_marker = '<!-- search sections -->'
+
+    def results(self, request, st, kind=None, page_number=None):
+        if kind is not None and kind not in SOURCES:
+            raise Http404("No such search source")
+        if kind is None:
+            results = SearchResults(st)
+        else:
+            results = SearchResults(st, kinds=[kind], budget=None)
+        page = render_to_string(self.template_name,
+                                {"search_str": st, "kind": kind}, request)
+        head, tail = page.split(self.sections_marker)
+
+        def sections():
+            yield head
+            for group in results.groups():
+                if kind is None:
+                    page_obj, objects = group.page(1, GROUP_SIZE)
+                else:
+                    page_obj, objects = group.page(page_number, PAGE_SIZE)
+                yield render_to_string(self.section_template,
+                                       {"search_str": st,
+                                        "kind": kind,
+                                        "group": group,
+                                        "source": group.source,
+                                        "count": len(group.hits),
+                                        "objects": objects,
+                                        "page_obj": page_obj,
+                                        }, request)
+            yield tail
+
+        return StreamingHttpResponse(sections())
+
+    def get(self, request, *args, **kwargs):
+        return self.results(request,
+                            request.GET.get('srch_term', ''),
+                            request.GET.get('kind') or None,
+                            request.GET.get('page'))
+
     def post(self, request, *args, **kwargs):
-        st = request.POST['srch_term']
-        qs_prj = Project.objects.all()
-        qs_prj =  qs_prj.filter(Q(dc_prj_id__icontains=st) | 
-                                Q(title__icontains=st) | 
-                                Q(nickname__icontains=st) |
-                                Q(dynamic_comments__comment__icontains=st)
-        ).order_by('dc_prj_id').distinct()
-        qs_usr = Person.objects.all()
-        qs_usr = qs_usr.filter( Q(first_name__icontains=st) |
-                                Q(last_name__icontains=st) |
-                                Q(cwid__icontains=st) |
-                                Q(comments__icontains=st)
-        ).order_by('pk').distinct()
-        qs_gov = Governance_Doc.objects.all()
-        qs_gov = qs_gov.filter( Q(doc_id__icontains=st) |
-                                Q(governance_type=st) |
-                                Q(comments__icontains=st)
-        ).order_by('pk').distinct()
-        context = { "search_str" : st,
-                    "qs_prj": qs_prj,
-                    "qs_usr": qs_usr,
-                    "qs_gov": qs_gov,
-        }
-        return render(request, self.template_name, context)
+        return self.results(request, request.POST['srch_term'])
         
     